@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""Benchmark the phases of internxt_backup.py (local walk, remote check, upload) on synthetic trees.
+
+Generates source trees for several scenarios and backs each one up twice against
+benchmarks/fake_internxt.py: a first run that uploads everything and a second run with nothing
+changed. The timings of the phases and the peak memory usage (from --stats-json) are printed as
+JSON, so they can be compared between commits.
+
+Scenarios:
+    wide      one folder with many files
+    deep      a long chain of nested folders with one file each
+    tiny      many folders with many tiny files
+    huge      a few huge (sparse) files
+    ignored   folders of which half contain a .internxtignore file and a large subtree
+    unicode   non-ASCII names (umlauts, NFD-decomposed names, CJK, emoji, "&") like those in tests/2019
+
+Examples:
+    python benchmarks/bench_backup.py --scale 0.1
+    python benchmarks/bench_backup.py --scenario wide --scenario tiny --scale 10 --jobs 8 --output after.json
+    python benchmarks/bench_backup.py --scenario unicode --backup-args="--content-hash --trust-manifest"
+"""
+
+import argparse
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKUP_SCRIPT = os.path.join(BENCH_DIR, os.pardir, "internxt_backup.py")
+FAKE_CLI = os.path.join(BENCH_DIR, "fake_internxt.py")
+
+UNICODE_NAMES = ["Käfer", "bad_char_Özge", "Ka\u0308fer_nfd", "日本語", "emoji_\U0001F600", "bad_char_abc&def", "with space", "ñandú"]
+
+def write_file(path, size=2):
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+
+def generate_wide(src_dir, scale):
+    for i in range(max(1, int(5000 * scale))):
+        write_file(os.path.join(src_dir, f"file_{i:07d}.txt"))
+
+def generate_deep(src_dir, scale):
+    cur_dir = src_dir
+    for i in range(max(1, int(200 * scale))):
+        cur_dir = os.path.join(cur_dir, f"d{i}")
+        os.makedirs(cur_dir)
+        write_file(os.path.join(cur_dir, f"file_{i}.txt"))
+
+def generate_tiny(src_dir, scale):
+    for i in range(max(1, int(100 * scale))):
+        folder = os.path.join(src_dir, f"folder_{i:05d}")
+        os.makedirs(folder)
+        for j in range(100):
+            write_file(os.path.join(folder, f"tiny_{j:03d}.txt"), 1)
+
+def generate_huge(src_dir, scale):
+    # Sparse files: large on paper, cheap to create.
+    for i in range(4):
+        with open(os.path.join(src_dir, f"huge_{i}.bin"), "wb") as f:
+            f.truncate(max(1, int(1024 ** 3 * scale)))
+
+def generate_ignored(src_dir, scale):
+    for i in range(max(2, int(50 * scale))):
+        folder = os.path.join(src_dir, f"folder_{i:05d}")
+        os.makedirs(folder)
+        for j in range(20):
+            write_file(os.path.join(folder, f"file_{j:03d}.txt"))
+        if i % 2 == 0:
+            open(os.path.join(folder, ".internxtignore"), "w").close()
+            for k in range(5):
+                subfolder = os.path.join(folder, f"ignored_{k}")
+                os.makedirs(subfolder)
+                for j in range(20):
+                    write_file(os.path.join(subfolder, f"file_{j:03d}.txt"))
+
+def generate_unicode(src_dir, scale):
+    for i in range(max(1, int(20 * scale))):
+        folder = os.path.join(src_dir, f"{UNICODE_NAMES[i % len(UNICODE_NAMES)]}_{i}")
+        os.makedirs(folder)
+        for j in range(50):
+            write_file(os.path.join(folder, f"{UNICODE_NAMES[j % len(UNICODE_NAMES)]}_{j}.txt"))
+
+SCENARIOS = {
+    "wide": generate_wide,
+    "deep": generate_deep,
+    "tiny": generate_tiny,
+    "huge": generate_huge,
+    "ignored": generate_ignored,
+    "unicode": generate_unicode,
+}
+
+def run_backup(scenario_dir, run_name, args):
+    """Run one backup of <scenario_dir>/src, returns its --stats-json output plus the wall time."""
+    stats_path = os.path.join(scenario_dir, f"stats_{run_name}.json")
+    cmd = [sys.executable, BACKUP_SCRIPT, "-s", "src", "-t", "", "-d", "-j", str(args.jobs), "-m", "manifest.sqlite", "--stats-json", stats_path]
+    if not args.no_bridge:
+        cmd += ["--cli-bridge", shlex.join([sys.executable, FAKE_CLI, "--bridge"])]
+    cmd += shlex.split(args.backup_args)
+    env = dict(os.environ, INTERNXT_CLI_BINARY=FAKE_CLI, FAKE_INTERNXT_STATE=os.path.join(scenario_dir, "fake_state.sqlite"),
+               FAKE_INTERNXT_STORE_CONTENT="0", FAKE_INTERNXT_LATENCY_SECONDS=str(args.latency))
+    start = time.time()
+    subprocess.run(cmd, cwd=scenario_dir, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.time() - start
+    with open(stats_path, encoding="utf-8") as f:
+        stats = json.load(f)
+    stats["wall_seconds"] = round(elapsed, 3)
+    return stats
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the phases of internxt_backup.py on synthetic trees.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="Scenario to run, can be repeated (default: all)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Scale factor for the number of files/folders (default: 1.0)")
+    parser.add_argument("--jobs", type=int, default=4, help="--jobs of the backup (default: 4)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency per CLI command in seconds (default: 0)")
+    parser.add_argument("--no-bridge", action="store_true", help="Start a fake CLI process per command instead of using --cli-bridge")
+    parser.add_argument("--backup-args", default="", help="Additional arguments for internxt_backup.py (use --backup-args=\"...\")")
+    parser.add_argument("--output", help="Write the results to this file instead of stdout")
+    parser.add_argument("--keep", help="Generate the trees in this directory and keep them, instead of a temporary directory")
+    args = parser.parse_args()
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "scale": args.scale,
+        "jobs": args.jobs,
+        "latency": args.latency,
+        "bridge": not args.no_bridge,
+        "backup_args": args.backup_args,
+        "scenarios": {},
+    }
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.keep or temp_dir
+        for scenario in args.scenario or SCENARIOS:
+            scenario_dir = os.path.join(work_dir, scenario)
+            src_dir = os.path.join(scenario_dir, "src")
+            os.makedirs(src_dir)
+            start = time.time()
+            SCENARIOS[scenario](src_dir, args.scale)
+            print(f"{scenario}: generated in {time.time() - start:.1f}s", file=sys.stderr)
+            results["scenarios"][scenario] = {run_name: run_backup(scenario_dir, run_name, args) for run_name in ("initial", "unchanged")}
+            print(f"{scenario}: {json.dumps({run_name: run['phases'] for run_name, run in results['scenarios'][scenario].items()})}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""Compare CLI commands/second with one process per command and with a persistent CLI bridge.
+
+Runs internxt_backup.py against benchmarks/fake_internxt.py on a generated source folder, once spawning
+the fake CLI for every command and once through --cli-bridge, and prints the results as JSON. Every
+fake CLI process pays a simulated startup cost (Node.js startup + loading the credentials).
+
+Example:
+    python benchmarks/bench_cli_bridge.py --files 200 --jobs 4
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKUP_SCRIPT = os.path.join(BENCH_DIR, os.pardir, "internxt_backup.py")
+FAKE_CLI = os.path.join(BENCH_DIR, "fake_internxt.py")
+
+def run_backup(work_dir, src_dir, jobs, bridge, startup_seconds):
+    """Run one backup, returns (number of CLI commands, elapsed seconds)."""
+    cmd = [sys.executable, BACKUP_SCRIPT, "-s", src_dir, "-t", "", "-v", "-j", str(jobs), "-m", os.path.join(work_dir, f"manifest_{bridge}.sqlite")]
+    if bridge:
+        cmd += ["--cli-bridge", f"{sys.executable} {FAKE_CLI} --bridge"]
+    env = dict(os.environ, INTERNXT_CLI_BINARY=FAKE_CLI, FAKE_INTERNXT_STATE=os.path.join(work_dir, f"fake_state_{bridge}.sqlite"),
+               FAKE_INTERNXT_STORE_CONTENT="0", FAKE_INTERNXT_STARTUP_SECONDS=str(startup_seconds))
+    start = time.time()
+    subprocess.run(cmd, cwd=work_dir, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.time() - start
+
+    # Count the commands in the (verbose) log file of this run.
+    log_files = sorted(f for f in os.listdir(work_dir) if f.startswith("backup_") and f.endswith(".log"))
+    log_path = os.path.join(work_dir, log_files[-1])
+    with open(log_path, encoding="utf-8") as f:
+        num_commands = sum(1 for line in f if "Running command" in line)
+    os.remove(log_path)
+    return num_commands, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI bridge benchmark.")
+    parser.add_argument("--files", type=int, default=200, help="Number of files to upload (default: 200)")
+    parser.add_argument("--jobs", type=int, default=1, help="Number of parallel CLI commands (default: 1)")
+    parser.add_argument("--startup-seconds", type=float, default=0.3, help="Simulated startup cost per CLI process (default: 0.3)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        src_dir = os.path.join(work_dir, "src")
+        os.makedirs(src_dir)
+        for i in range(args.files):
+            with open(os.path.join(src_dir, f"file_{i:06d}.txt"), "w") as f:
+                f.write(f"{i}\n")
+
+        results = {"files": args.files, "jobs": args.jobs}
+        for mode, bridge in (("spawn", False), ("bridge", True)):
+            num_commands, elapsed = run_backup(work_dir, src_dir, args.jobs, bridge, args.startup_seconds)
+            results[mode] = {"commands": num_commands, "seconds": round(elapsed, 3), "commands_per_second": round(num_commands / elapsed, 2)}
+
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
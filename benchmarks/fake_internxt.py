@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""Fake internxt CLI for load testing internxt_backup.py without an account.
+
+Keeps a remote folder tree in a SQLite file and answers the commands used by the backup script with
+the same JSON shapes as the real CLI (see the examples in README.md). Point the script at it with
+INTERNXT_CLI_BINARY=/path/to/benchmarks/fake_internxt.py. With --bridge it speaks the JSON-lines
+protocol of internxt_bridge.js, for --cli-bridge "python benchmarks/fake_internxt.py --bridge".
+
+The root folder has the UUID "root" (an empty --id also refers to it).
+
+Environment:
+    FAKE_INTERNXT_STATE              SQLite file with the remote tree (default: fake_internxt_state.sqlite in the temp dir)
+    FAKE_INTERNXT_STORE_CONTENT      store uploaded file contents next to the state file, needed for download-file (default: 1)
+    FAKE_INTERNXT_STARTUP_SECONDS    simulated startup cost per process (Node.js + loading credentials, default: 0)
+    FAKE_INTERNXT_LATENCY_SECONDS    simulated latency per command (default: 0)
+    FAKE_INTERNXT_BANDWIDTH          upload/download bandwidth cap in bytes/second (default: 0 = unlimited)
+    FAKE_INTERNXT_FAILURE_RATE       probability that a command fails with {"success": false} (default: 0)
+    FAKE_INTERNXT_NON_JSON_RATE      probability that a command prints non-JSON garbage and exits with 1 (default: 0)
+    FAKE_INTERNXT_SEED               seed for the random failures, makes them reproducible for the same sequence of commands
+    FAKE_INTERNXT_NAME_FORM          Unicode normalization form (NFC, NFD, ...) applied to the names of new files/folders, like a
+                                     server that normalizes names (default: names are stored as given)
+    FAKE_INTERNXT_GHOST_RATE         probability that an upload succeeds but the file is not stored: it is listed without a
+                                     fileId (the "reported as existing but not in the web client" case, default: 0)
+"""
+
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import unicodedata
+import uuid
+
+STATE_PATH = os.environ.get("FAKE_INTERNXT_STATE", os.path.join(tempfile.gettempdir(), "fake_internxt_state.sqlite"))
+STORE_CONTENT = os.environ.get("FAKE_INTERNXT_STORE_CONTENT", "1") == "1"
+STARTUP_SECONDS = float(os.environ.get("FAKE_INTERNXT_STARTUP_SECONDS", "0"))
+LATENCY_SECONDS = float(os.environ.get("FAKE_INTERNXT_LATENCY_SECONDS", "0"))
+BANDWIDTH = float(os.environ.get("FAKE_INTERNXT_BANDWIDTH", "0"))
+FAILURE_RATE = float(os.environ.get("FAKE_INTERNXT_FAILURE_RATE", "0"))
+NON_JSON_RATE = float(os.environ.get("FAKE_INTERNXT_NON_JSON_RATE", "0"))
+NAME_FORM = os.environ.get("FAKE_INTERNXT_NAME_FORM")
+GHOST_RATE = float(os.environ.get("FAKE_INTERNXT_GHOST_RATE", "0"))
+ROOT_UUID = "root"
+
+SEED = os.environ.get("FAKE_INTERNXT_SEED")
+
+# Short and long option names of the real CLI.
+OPTION_ALIASES = {"i": "id", "f": "file", "n": "name", "d": "destination", "e": "email", "p": "password", "w": "twofactor"}
+FLAGS = {"x", "non-interactive", "json", "o", "overwrite", "extended"}
+
+class CommandError(Exception):
+    pass
+
+def parse_options(args):
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("-"):
+            key = arg.lstrip("-")
+            if "=" in key:
+                key, value = key.split("=", 1)
+            elif key in FLAGS:
+                value = True
+            else:
+                i += 1
+                value = args[i] if i < len(args) else ""
+            options[OPTION_ALIASES.get(key, key)] = value.strip('"') if isinstance(value, str) else value
+        i += 1
+    return options
+
+def connect():
+    conn = sqlite3.connect(STATE_PATH, timeout=60, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS nodes (uuid TEXT PRIMARY KEY, id INTEGER, parent TEXT, name TEXT, type TEXT, size INTEGER, created TEXT, modified TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent)")
+    conn.execute("CREATE TABLE IF NOT EXISTS ghosts (uuid TEXT PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS session (logged_in INTEGER, num_commands INTEGER)")
+    conn.execute("INSERT INTO session SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM session)")
+    return conn
+
+def blob_path(file_uuid):
+    return os.path.join(STATE_PATH + ".blobs", file_uuid)
+
+def timestamp():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+def throttle(num_bytes):
+    if BANDWIDTH > 0:
+        time.sleep(num_bytes / BANDWIDTH)
+
+def node_json(conn, node_uuid):
+    row = conn.execute("SELECT uuid, id, parent, name, type, size, created, modified FROM nodes WHERE uuid=?", (node_uuid,)).fetchone()
+    if row is None:
+        raise CommandError(f"Item {node_uuid} not found")
+    node_uuid, node_id, parent, name, node_type, size, created, modified = row
+    common = {"id": node_id, "uuid": node_uuid, "name": uuid.uuid5(uuid.NAMESPACE_OID, node_uuid).hex, "plainName": name,
+              "bucket": None, "userId": 1234567, "encryptVersion": "03-aes", "deleted": False, "deletedAt": None,
+              "createdAt": created, "updatedAt": modified, "creationTime": created, "modificationTime": modified,
+              "removed": False, "removedAt": None, "status": "EXISTS"}
+    if node_type == "folder":
+        return dict(common, type="folder", parentId=None, parentUuid=parent, parent=None, user=None, size=0, sharings=[])
+    file_id = None if conn.execute("SELECT 1 FROM ghosts WHERE uuid=?", (node_uuid,)).fetchone() else node_uuid
+    return dict(common, type=node_type, size=str(size), fileId=file_id, folderId=None, folder=None, folderUuid=parent, user=None, thumbnails=[], sharings=[])
+
+def folder_uuid_option(options, key):
+    return options.get(key) or ROOT_UUID
+
+def require_folder(conn, folder_uuid):
+    if folder_uuid != ROOT_UUID and conn.execute("SELECT 1 FROM nodes WHERE uuid=? AND type='folder'", (folder_uuid,)).fetchone() is None:
+        raise CommandError(f"Folder {folder_uuid} not found")
+
+def insert_node(conn, parent, name, node_type, size):
+    node_uuid = str(uuid.uuid4())
+    now = timestamp()
+    conn.execute("INSERT INTO nodes VALUES (?, (SELECT COALESCE(MAX(id), 0) + 1 FROM nodes), ?, ?, ?, ?, ?, ?)", (node_uuid, parent, name, node_type, size, now, now))
+    return node_uuid
+
+def delete_tree(conn, node_uuid):
+    for (child,) in conn.execute("SELECT uuid FROM nodes WHERE parent=?", (node_uuid,)).fetchall():
+        delete_tree(conn, child)
+    conn.execute("DELETE FROM nodes WHERE uuid=?", (node_uuid,))
+    conn.execute("DELETE FROM ghosts WHERE uuid=?", (node_uuid,))
+    if os.path.exists(blob_path(node_uuid)):
+        os.remove(blob_path(node_uuid))
+
+def stored_name(name):
+    return unicodedata.normalize(NAME_FORM, name) if NAME_FORM else name
+
+def split_name(file_name):
+    base, ext = os.path.splitext(file_name)
+    return base, ext[1:]
+
+def run_command(args):
+    """Run one command, returns (stdout, returncode)."""
+    time.sleep(LATENCY_SECONDS)
+    command = args[0] if args else ""
+    options = parse_options(args[1:])
+    conn = connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        # Every command gets its own random number generator, seeded with a command counter if a seed is set.
+        conn.execute("UPDATE session SET num_commands=num_commands+1")
+        num_commands = conn.execute("SELECT num_commands FROM session").fetchone()[0]
+        rng = random.Random(f"{SEED}:{num_commands}" if SEED is not None else None)
+        if NON_JSON_RATE and rng.random() < NON_JSON_RATE:
+            conn.execute("COMMIT")
+            return "Error: socket hang up\n    at connResetException (node:internal/errors:720:14)", 1
+        if FAILURE_RATE and rng.random() < FAILURE_RATE:
+            conn.execute("COMMIT")
+            return json.dumps({"success": False, "message": "Fake failure (FAKE_INTERNXT_FAILURE_RATE)"}), 1
+        out = execute(conn, command, options, rng)
+        conn.execute("COMMIT")
+        return json.dumps(out), 0
+    except CommandError as e:
+        conn.execute("ROLLBACK")
+        return json.dumps({"success": False, "message": str(e)}), 1
+    finally:
+        conn.close()
+
+def execute(conn, command, options, rng):
+    logged_in = conn.execute("SELECT logged_in FROM session").fetchone()[0]
+    if command == "login":
+        conn.execute("UPDATE session SET logged_in=1")
+        return {"success": True, "message": f"Succesfully logged in to: {options.get('email')}"}
+    if command == "logout":
+        conn.execute("UPDATE session SET logged_in=0")
+        return {"success": True, "message": "User logged out successfully."}
+    if not logged_in:
+        raise CommandError("You are not logged in.")
+
+    if command == "whoami":
+        return {"success": True, "message": "You are logged in as: fake@example.com.", "login": {"user": {"email": "fake@example.com"}}}
+
+    if command == "list":
+        folder_uuid = folder_uuid_option(options, "id")
+        require_folder(conn, folder_uuid)
+        folders, files = [], []
+        for node_uuid, node_type in conn.execute("SELECT uuid, type FROM nodes WHERE parent=? ORDER BY id", (folder_uuid,)).fetchall():
+            (folders if node_type == "folder" else files).append(node_json(conn, node_uuid))
+        return {"success": True, "list": {"folders": folders, "files": files}}
+
+    if command == "create-folder":
+        parent = folder_uuid_option(options, "id")
+        require_folder(conn, parent)
+        name = stored_name(options.get("name", ""))
+        if conn.execute("SELECT 1 FROM nodes WHERE parent=? AND name=? AND type='folder'", (parent, name)).fetchone():
+            raise CommandError("Folder with the same name already exists")
+        folder_uuid = insert_node(conn, parent, name, "folder", 0)
+        return {"success": True, "message": f"Folder {name} created successfully, view it at https://drive.internxt.com/folder/{folder_uuid}", "folder": node_json(conn, folder_uuid)}
+
+    if command == "upload-file":
+        path = options.get("file", "")
+        parent = folder_uuid_option(options, "destination")
+        require_folder(conn, parent)
+        if not os.path.isfile(path):
+            raise CommandError(f"File {path} not found")
+        base, ext = split_name(stored_name(os.path.basename(path)))
+        if conn.execute("SELECT 1 FROM nodes WHERE parent=? AND name=? AND type=?", (parent, base, ext)).fetchone():
+            raise CommandError("File already exists")
+        size = os.path.getsize(path)
+        start = time.time()
+        throttle(size)
+        file_uuid = insert_node(conn, parent, base, ext, size)
+        if GHOST_RATE and rng.random() < GHOST_RATE:
+            conn.execute("INSERT INTO ghosts VALUES (?)", (file_uuid,))
+        elif STORE_CONTENT:
+            os.makedirs(STATE_PATH + ".blobs", exist_ok=True)
+            shutil.copyfile(path, blob_path(file_uuid))
+        file_json = node_json(conn, file_uuid)
+        file_json["name"] = base
+        return {"success": True, "message": f"File uploaded in {int((time.time() - start) * 1000)}ms, view it at https://drive.internxt.com/file/{file_uuid}", "file": file_json}
+
+    if command == "download-file":
+        file_json = node_json(conn, options.get("id", ""))
+        if file_json["type"] == "folder":
+            raise CommandError("Item is a folder")
+        file_name = file_json["plainName"] + ("." + file_json["type"] if file_json["type"] else "")
+        path = os.path.join(options.get("directory") or ".", file_name)
+        if os.path.exists(path) and not options.get("overwrite"):
+            raise CommandError(f"File {path} already exists")
+        throttle(int(file_json["size"]))
+        if STORE_CONTENT and os.path.exists(blob_path(file_json["uuid"])):
+            shutil.copyfile(blob_path(file_json["uuid"]), path)
+        else:
+            with open(path, "wb") as f:
+                f.truncate(int(file_json["size"]))
+        return {"success": True, "message": f"File downloaded successfully to {path}", "path": path}
+
+    if command in ("delete-permanently-file", "delete-permanently-folder", "trash-file", "trash-folder"):
+        node_uuid = options.get("id", "")
+        node_json(conn, node_uuid)  # Fails if it doesn't exist.
+        delete_tree(conn, node_uuid)
+        return {"success": True, "message": f"{command} {node_uuid} done"}
+
+    if command in ("move-file", "move-folder"):
+        node_uuid = options.get("id", "")
+        destination = folder_uuid_option(options, "destination")
+        require_folder(conn, destination)
+        node_json(conn, node_uuid)
+        conn.execute("UPDATE nodes SET parent=?, modified=? WHERE uuid=?", (destination, timestamp(), node_uuid))
+        kind = command.split("-")[1]
+        return {"success": True, "message": f"{kind.capitalize()} moved successfully", kind: node_json(conn, node_uuid)}
+
+    if command in ("rename-file", "rename-folder"):
+        node_uuid = options.get("id", "")
+        node_json(conn, node_uuid)
+        conn.execute("UPDATE nodes SET name=?, modified=? WHERE uuid=?", (options.get("name", ""), timestamp(), node_uuid))
+        return {"success": True, "message": f"Renamed successfully to {options.get('name')}"}
+
+    raise CommandError(f"Command {command} not supported by the fake CLI")
+
+def main():
+    time.sleep(STARTUP_SECONDS)
+    if sys.argv[1:] == ["--bridge"]:
+        print(json.dumps({"ready": True}), flush=True)
+        for line in sys.stdin:
+            stdout, returncode = run_command(json.loads(line)["args"])
+            print(json.dumps({"stdout": stdout, "stderr": "", "returncode": returncode}), flush=True)
+        return
+    stdout, returncode = run_command(sys.argv[1:])
+    print(stdout)
+    sys.exit(returncode)
+
+if __name__ == "__main__":
+    main()
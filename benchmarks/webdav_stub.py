@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Minimal in-memory WebDAV server for exercising internxt_backup.py --transport webdav without an account.
+
+Supports PROPFIND (Depth 0/1), MKCOL, PUT, GET, DELETE and MOVE over HTTP/1.1 keep-alive connections.
+It can be started in-process (start_server()) or standalone:
+
+    python benchmarks/webdav_stub.py --port 3005
+    python internxt_backup.py -s /path/to/source -t "" --transport webdav --webdav-url http://127.0.0.1:3005
+"""
+
+import argparse
+import threading
+import urllib.parse
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+class WebDavTree:
+    """Folders are stored as paths with a trailing slash, files as path -> content."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.folders = {"/"}
+        self.files = {}
+        self.num_requests = 0
+
+    def children(self, folder):
+        depth = folder.count("/")
+        folders = [f for f in self.folders if f != folder and f.startswith(folder) and f.count("/") == depth + 1]
+        files = [f for f in self.files if f.startswith(folder) and f.count("/") == depth]
+        return folders, files
+
+class WebDavHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    tree = None  # Set by start_server()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _path(self):
+        return urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+
+    def _reply(self, status, body=b"", content_type="text/plain"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def _count(self):
+        with self.tree.lock:
+            self.tree.num_requests += 1
+
+    def do_PROPFIND(self):
+        self._count()
+        self._read_body()
+        path = self._path()
+        folder = path if path.endswith("/") else path + "/"
+        with self.tree.lock:
+            if folder in self.tree.folders:
+                entries = [(folder, None)]
+                if self.headers.get("Depth", "1") != "0":
+                    folders, files = self.tree.children(folder)
+                    entries += [(f, None) for f in sorted(folders)] + [(f, len(self.tree.files[f])) for f in sorted(files)]
+            elif path in self.tree.files:
+                entries = [(path, len(self.tree.files[path]))]
+            else:
+                return self._reply(404)
+        responses = []
+        for entry_path, size in entries:
+            if size is None:
+                props = "<d:resourcetype><d:collection/></d:resourcetype>"
+            else:
+                props = f"<d:resourcetype/><d:getcontentlength>{size}</d:getcontentlength>"
+            props += f"<d:getlastmodified>{formatdate(usegmt=True)}</d:getlastmodified>"
+            responses.append(f"<d:response><d:href>{escape(urllib.parse.quote(entry_path))}</d:href><d:propstat><d:prop>{props}</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>")
+        body = '<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:">' + "".join(responses) + "</d:multistatus>"
+        self._reply(207, body.encode("utf-8"), "application/xml; charset=utf-8")
+
+    def do_MKCOL(self):
+        self._count()
+        self._read_body()
+        folder = self._path().rstrip("/") + "/"
+        parent = folder.rstrip("/").rsplit("/", 1)[0] + "/"
+        with self.tree.lock:
+            if folder in self.tree.folders:
+                return self._reply(405)
+            if parent not in self.tree.folders:
+                return self._reply(409)
+            self.tree.folders.add(folder)
+        self._reply(201)
+
+    def do_PUT(self):
+        self._count()
+        data = self._read_body()
+        path = self._path()
+        parent = path.rsplit("/", 1)[0] + "/"
+        with self.tree.lock:
+            if parent not in self.tree.folders:
+                return self._reply(409)
+            existed = path in self.tree.files
+            self.tree.files[path] = data
+        self._reply(204 if existed else 201)
+
+    def do_GET(self):
+        self._count()
+        with self.tree.lock:
+            data = self.tree.files.get(self._path())
+        if data is None:
+            return self._reply(404)
+        self._reply(200, data, "application/octet-stream")
+
+    def do_DELETE(self):
+        self._count()
+        path = self._path()
+        with self.tree.lock:
+            if path in self.tree.files:
+                del self.tree.files[path]
+            elif path.rstrip("/") + "/" in self.tree.folders:
+                folder = path.rstrip("/") + "/"
+                self.tree.folders = {f for f in self.tree.folders if not f.startswith(folder)}
+                self.tree.files = {f: d for f, d in self.tree.files.items() if not f.startswith(folder)}
+            else:
+                return self._reply(404)
+        self._reply(204)
+
+    def do_MOVE(self):
+        self._count()
+        source = self._path()
+        destination = urllib.parse.unquote(urllib.parse.urlsplit(self.headers["Destination"]).path)
+        with self.tree.lock:
+            if source in self.tree.files:
+                self.tree.files[destination] = self.tree.files.pop(source)
+            elif source.rstrip("/") + "/" in self.tree.folders:
+                old, new = source.rstrip("/") + "/", destination.rstrip("/") + "/"
+                self.tree.folders = {new + f[len(old):] if f.startswith(old) else f for f in self.tree.folders}
+                self.tree.files = {new + f[len(old):] if f.startswith(old) else f: d for f, d in self.tree.files.items()}
+            else:
+                return self._reply(404)
+        self._reply(201)
+
+def start_server(host="127.0.0.1", port=0):
+    """Start the stub server in a background thread, returns (server, tree, url)."""
+    tree = WebDavTree()
+    handler = type("StubWebDavHandler", (WebDavHandler,), {"tree": tree})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, tree, f"http://{host}:{server.server_address[1]}"
+
+def main():
+    parser = argparse.ArgumentParser(description="In-memory WebDAV stub server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=3005)
+    args = parser.parse_args()
+    server, _, url = start_server(args.host, args.port)
+    print(f"Serving WebDAV stub at {url}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
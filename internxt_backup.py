@@ -11,17 +11,59 @@ import platform
 import signal
 import atexit
 import getpass
-from collections import defaultdict
+import http.client
+import ssl
+import urllib.parse
+import xml.etree.ElementTree as ElementTree
+import shlex
+import queue
+import threading
+import sqlite3
+import hashlib
+import heapq
+import bisect
+import functools
+import unicodedata
+import itertools
+import random
+import mmap
+import tarfile
+import tempfile
+import shutil
+import select
+import struct
+import ctypes
+import errno
+from array import array
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+try:
+    import resource # Not available on Windows, only used for the peak memory usage in --stats-json.
+except ImportError:
+    resource = None
 
-# TODO: Validate that all files have been uploaded using "list"
 # TODO: This is written against @internxt/cli/1.5.4 win32-x64 node-v22.18.0, validate version
 # TODO: Validate sufficient remote space ("config" lists available / used space)
 
 start_time = time.time()
+phase_timings = {} # Elapsed seconds per phase, written by --stats-json
 
-INTERNXT_CLI_BINARY = r"internxt"
+INTERNXT_CLI_BINARY = os.environ.get("INTERNXT_CLI_BINARY", r"internxt")
 IGNOREFILE_NAME = ".internxtignore"
 FILE_SIZE_UPLOAD_LIMIT_BYTES = 21474836480
+HASH_MMAP_THRESHOLD_BYTES = 64 * 1024 * 1024 # Files at least this large are hashed through mmap
+HASH_READ_BUFFER_BYTES = 1024 * 1024
+# hashlib releases the GIL while hashing, so threads use all cores.
+# (A process pool would re-run this script in each worker on platforms that spawn processes.)
+HASH_WORKERS = os.cpu_count() or 1
+PACK_BUNDLE_PREFIX = "internxt_pack_" # Remote name prefix of the tar bundles of --pack-small-files
+PACK_BUNDLE_MAX_BYTES = 8 * 1024 * 1024 # Changing one packed file re-uploads at most this much
+PARTS_FOLDER_PREFIX = ".internxt_parts_" # Remote folder with the parts of a file uploaded with --split-size
+RESTORE_TEMP_PREFIX = ".internxt_restore_" # Local name prefix of the incomplete downloads of --restore
+NAME_CACHE_SIZE = 65536 # Number of memoized canonical names, see canonical_name()
+WATCH_DEBOUNCE_SECONDS = 2 # With --watch, changes are synced once no event arrived for this long...
+WATCH_MAX_DELAY_SECONDS = 30 # ...or at the latest this long after the first event
+WATCH_LOGGED_IN_ENV = "INTERNXT_BACKUP_WATCH_LOGGED_IN" # Passed to the full runs of --watch, see restart_full_run()
 
 # Git bash has problems with the password input.
 if 'MSYSTEM' in os.environ and os.environ['MSYSTEM'].startswith(('MINGW', 'MSYS')):
@@ -40,13 +82,100 @@ parser.add_argument("-v", "--verbose", dest="verbose_mode", action='store_true',
 parser.add_argument("-l", "--full-console-log", dest="full_console_log", action='store_true', help="log everything that is logged to file to the console as well")
 parser.add_argument("-r", "--max_num_retries", dest="max_num_retries", required=False, default=5, type=int, help="Set the maximum number of retries for internxt CLI commands (default: 5)")
 parser.add_argument("-w", "--retry_wait_seconds", dest="retry_wait_seconds", required=False, default=3, type=int, help="Set N, where N^{retry attempt} is the number of seconds to wait before the next retry (default: 3)")
+parser.add_argument("--breaker-failures", dest="breaker_failures", required=False, default=10, type=int, help="Pause all CLI/WebDAV traffic after this many consecutive failed commands, the service is probably down (default: 10)")
+parser.add_argument("--breaker-cooldown", dest="breaker_cooldown", required=False, default=30, type=int, help="Seconds to pause after --breaker-failures consecutive failures, doubled each time the first command afterwards fails as well (default: 30)")
 parser.add_argument("-d", "--allow_delete", dest="allow_delete", action='store_true', help="Delete remote files/folders if they do not exist locally or are ignored")
+parser.add_argument("--use-trash", dest="use_trash", action='store_true', help="Move remote files/folders to the Internxt trash (trash-file, trash-folder) instead of deleting them permanently, so they can still be restored from the trash")
+parser.add_argument("-j", "--jobs", dest="jobs", required=False, default=1, type=int, help="Number of CLI commands (uploads, folder listings, folder creation) to run in parallel (default: 1)")
+parser.add_argument("-m", "--manifest", dest="manifest", required=False, default="internxt_manifest.sqlite", help="SQLite file that stores the known remote state between runs (default: internxt_manifest.sqlite)")
+parser.add_argument("--trust-manifest", dest="trust_manifest", action='store_true', help="Don't list remote folders whose local contents have not changed since the last run, use the manifest instead")
+parser.add_argument("--refresh-remote", dest="refresh_remote", action='store_true', help="Discard the manifest for this target and list all remote folders again")
+parser.add_argument("--rescan-local", dest="rescan_local", action='store_true', help="Read all local folders again instead of reusing the file list of the snapshot for folders whose modification time did not change (the files themselves are always checked)")
+parser.add_argument("--content-hash", dest="content_hash", action='store_true', help="Detect changed files by content hash (SHA-256) instead of size and modification time")
+parser.add_argument("--detect-moves", dest="detect_moves", action='store_true', help="Move/rename remote files and folders that were moved locally instead of deleting and re-uploading them (requires --allow_delete)")
+parser.add_argument("--cli-bridge", dest="cli_bridge", required=False, help="Command that starts a long-lived CLI bridge process (e.g. \"node internxt_bridge.js\"). Commands are sent to it instead of starting a new CLI process each time. Falls back to one process per command if the bridge doesn't work")
+parser.add_argument("--transport", dest="transport", choices=["cli", "webdav"], default="cli", help="How to talk to Internxt: the CLI (default) or the CLI's WebDAV server (see 'internxt webdav enable'). With webdav, --target is a folder path instead of a UUID")
+parser.add_argument("--webdav-url", dest="webdav_url", default="https://127.0.0.1:3005", help="URL of the WebDAV server (default: https://127.0.0.1:3005)")
+parser.add_argument("--adaptive-jobs", dest="adaptive_jobs", action='store_true', help="Treat --jobs as the maximum and adjust the number of parallel uploads and folder listings to the observed throughput and failures (see the log for the decisions)")
+parser.add_argument("--walk-jobs", dest="walk_jobs", required=False, default=1, type=int, help="Number of local folders to read in parallel (default: 1). Helps on network file systems, where each folder read waits for the server")
+parser.add_argument("--pipeline", dest="pipeline", action='store_true', help="Start uploading the files of each folder as soon as its remote listing has been checked, instead of after the remote check of all folders")
+parser.add_argument("--pack-small-files", dest="pack_small_files", action='store_true', help="Upload the small files of each folder in tar bundles instead of one by one (requires --allow_delete, outdated bundles are replaced)")
+parser.add_argument("--pack-threshold", dest="pack_threshold", required=False, default=65536, type=int, help="Files smaller than this many bytes are packed with --pack-small-files (default: 65536)")
+parser.add_argument("--schedule", dest="schedule", choices=["walk", "small-first", "large-first", "mixed"], default="walk", help="Order of the uploads: as the folders were read (default), smallest or largest files first, or mixed, which alternates between the largest and the smallest files so both are uploading at the same time")
+parser.add_argument("--priority-file", dest="priority_file", required=False, help="File with lines '<priority> <folder>' (relative to --source, '#' starts a comment). Files of folders with a higher priority are uploaded first, subfolders inherit the priority (default: 0). Within a priority, --schedule applies")
+parser.add_argument("--split-size", dest="split_size", required=False, type=int, help="Upload files larger than this many bytes (including files above the 20 GB upload limit) in parts of this size, in parallel. Must be a multiple of 1 MiB. Each upload job needs one part of temporary disk space (requires --allow_delete, changed parts are replaced)")
+parser.add_argument("--verify", dest="verify", action='store_true', help="After the upload, compare the remote tree with the local files (reusing the listings of the remote check, only modified folders are listed again) and write the discrepancies to --verify-report. Exits with status 2 if there are any")
+parser.add_argument("--verify-report", dest="verify_report", required=False, default="internxt_verify.json", help="JSON file for the discrepancies found by --verify (default: internxt_verify.json)")
+parser.add_argument("--watch", dest="watch", action='store_true', help="Linux only: after the backup, keep watching the source folder (inotify) and sync changed files and folders right away. A full run is started again every --watch-reconcile seconds to catch missed changes")
+parser.add_argument("--watch-reconcile", dest="watch_reconcile", required=False, default=86400, type=int, help="Seconds between the full runs of --watch (default: 86400)")
+parser.add_argument("--restore", dest="restore", action='store_true', help="Download the backup of --source from --target into --source instead of uploading. Files that exist locally with the same size are skipped (others are replaced), so an interrupted restore continues where it stopped. Bundles are extracted and split files joined")
+parser.add_argument("--stats-json", dest="stats_json", required=False, help="Write the duration of each phase, counters and the peak memory usage to this JSON file (used by benchmarks/bench_backup.py)")
+parser.add_argument("--prometheus-file", dest="prometheus_file", required=False, help="Write the command latency histograms, phase durations and file counters to this file in the Prometheus text format (for the node_exporter textfile collector)")
+parser.add_argument("--trace-json", dest="trace_json", required=False, help="Write a Chrome trace event file with one span per CLI command / WebDAV request and per phase (open it in chrome://tracing or ui.perfetto.dev)")
+parser.add_argument("--assume-logged-in", dest="assume_logged_in", action='store_true', help="Don't check the login with 'whoami' (used by internxt_daemon.py, which logs in once for all backup sets)")
 parser.add_argument("-e", "--email", dest="email", required=False, help="Email for Internxt login")
 parser.add_argument("-p", "--password", dest="password", required=False, help="Password for Internxt login (not recommended to use on CLI)")
 args = parser.parse_args()
 
+if args.jobs < 1:
+    parser.error("--jobs must be at least 1")
+if args.breaker_failures < 1:
+    parser.error("--breaker-failures must be at least 1")
+if args.walk_jobs < 1:
+    parser.error("--walk-jobs must be at least 1")
+if args.use_trash and args.transport != "cli":
+    parser.error("--use-trash requires --transport cli (WebDAV has no separate trash operation)")
+if args.detect_moves and not args.allow_delete:
+    parser.error("--detect-moves requires --allow_delete")
+if args.pack_small_files and not args.allow_delete:
+    parser.error("--pack-small-files requires --allow_delete (outdated bundles are replaced)")
+if args.split_size is not None:
+    if not args.allow_delete:
+        parser.error("--split-size requires --allow_delete (changed parts are replaced)")
+    if args.split_size <= 0 or args.split_size % (1024 * 1024) or args.split_size > FILE_SIZE_UPLOAD_LIMIT_BYTES:
+        parser.error("--split-size must be a positive multiple of 1 MiB (1048576) and at most the upload limit")
+if args.pipeline and args.detect_moves:
+    parser.error("--pipeline can't be combined with --detect-moves (moved files would be uploaded before they are matched)")
+if args.watch:
+    if platform.system() != "Linux":
+        parser.error("--watch requires Linux (inotify)")
+    if args.pack_small_files or args.split_size is not None:
+        parser.error("--watch can't be combined with --pack-small-files or --split-size (changed files are uploaded one by one)")
+    if args.watch_reconcile < 60:
+        parser.error("--watch-reconcile must be at least 60 seconds")
+if args.restore and args.watch:
+    parser.error("--restore can't be combined with --watch")
+if args.pipeline and args.priority_file:
+    parser.error("--pipeline can't be combined with --priority-file (each folder is uploaded as soon as it is checked)")
+
+# --priority-file: (folder, priority) rules, the longest matching folder applies.
+folder_priority_rules = []
+if args.priority_file:
+    try:
+        with open(args.priority_file, encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line:
+                    continue
+                fields = line.split(None, 1)
+                try:
+                    folder_priority_rules.append((os.path.normpath(fields[1]), int(fields[0])))
+                except (IndexError, ValueError):
+                    parser.error(f"--priority-file line {line_number}: expected '<priority> <folder>', got '{line}'")
+    except OSError as e:
+        parser.error(f"--priority-file: {e}")
+
+# With --pipeline the remote check and the uploads run at the same time and share the CLI bridges / WebDAV connections.
+# With --allow_delete, the deletions run alongside the remote check as well.
+NUM_REMOTE_CONNECTIONS = args.jobs * (1 + args.pipeline + args.allow_delete)
+
 MAX_NUM_RETRIES = args.max_num_retries
 RETRY_SLEEP_BASE_SECONDS = args.retry_wait_seconds # 2 = wait for 2, 4, 8, 16, 32 seconds; 3 = 3, 9, 27, 81, 243 seconds ; 4 = wait for 4, 16, 64, 256, 1024 seconds
+CIRCUIT_BREAKER_MAX_COOLDOWN_SECONDS = 600
+CIRCUIT_BREAKER_PROBE_TIMEOUT_SECONDS = 600 # Another probe is let through if the last one did not report back (e.g. a very long upload)
+ADAPTIVE_WINDOW_SECONDS = 2 # Minimum duration of a measurement window of --adaptive-jobs
+ADAPTIVE_MIN_IMPROVEMENT = 1.05 # Throughput must improve by 5% to keep raising the concurrency
+ADAPTIVE_MAX_FAILURE_RATE = 0.1 # More failures than this (within a window) halve the concurrency
 
 ################################################################################
 # Logging
@@ -129,11 +258,22 @@ def format_hhmmss(seconds):
     s = total % 60
     return f"{h:02d}:{m:02d}:{s:02d}"
 
+def peak_rss_bytes():
+    """Peak resident set size of this process, None if unknown (Windows)."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # macOS reports bytes, Linux kilobytes
+
 # Prevent names such as ".\\mydir", return "mydir" instead
 def normalize_rel_path(parent, name):
     return name if parent == "." else os.path.join(parent, name)
 
 def normalize_encoding(text):
+    # ASCII is the same in all of the encodings below.
+    if text.isascii():
+        return text
+
     # Try treating the input as Latin1 encoded UTF-8
     try:
         text_fixed = text.encode("latin1").decode("utf8")
@@ -154,6 +294,161 @@ def normalize_encoding(text):
 
     return text  # Last resort, return as-is
 
+@functools.lru_cache(maxsize=NAME_CACHE_SIZE)
+def canonical_name(name):
+    """The form in which local and remote names are compared: encoding repaired (see normalize_encoding()) and in Unicode NFC.
+
+    macOS and some remote clients use decomposed (NFD) names, e.g. "Ka\u0308fer" for "Käfer", which look the same
+    but don't compare equal. Memoized, as the same names are normalized during the walk, the listing and the check.
+    """
+    if name.isascii():
+        return name
+    fixed = normalize_encoding(name)
+    canonical = unicodedata.normalize("NFC", fixed)
+    if canonical != fixed:
+        logging.debug(f"Unicode normalization changed (NFC): {fixed!r} -> {canonical!r}", extra={'suppress_console': ENABLE_SUPPRESS})
+    return canonical
+
+# Names that differ from their canonical form, and names that are only unique before normalization.
+name_stats = {"local_normalized": 0, "remote_normalized": 0, "local_collisions": 0, "remote_collisions": 0}
+name_stats_lock = threading.Lock()
+
+def add_canonical_name(index, raw_name, value, side, folder):
+    """Add value to the {canonical name: value} index of a local or remote (side) folder, returns the canonical name.
+
+    Returns None for a name that is the same as one already in the index after normalization (it is reported and left out).
+    """
+    name = canonical_name(raw_name)
+    with name_stats_lock:
+        if name in index:
+            name_stats[f"{side}_collisions"] += 1
+            logging.warning(f"The {side} name '{raw_name}' in '{folder}' is the same as another name after Unicode/encoding normalization ('{name}'), skipping it")
+            return None
+        if name != raw_name:
+            name_stats[f"{side}_normalized"] += 1
+    index[name] = value
+    return name
+
+################################################################################
+# Metrics
+# Every CLI command and WebDAV request is timed. The latency histograms, failures
+# and retries per command type are written to --stats-json and --prometheus-file,
+# with --trace-json every command and phase is also kept as a span.
+################################################################################
+
+METRICS_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600) # Upper bounds in seconds
+
+class CommandMetrics:
+    def __init__(self, keep_spans):
+        self.lock = threading.Lock()
+        self.commands = {} # Command -> {"count", "failures", "retries", "seconds", "max", "buckets"}
+        self.upload_bytes = 0
+        self.upload_seconds = 0.0 # Summed over the parallel uploads
+        self.spans = [] if keep_spans else None # (name, category, start, duration, thread name, args)
+
+    def record(self, command, start, duration, success, attempt, details=None):
+        """Record one attempt of a command (started at start = time.time())."""
+        with self.lock:
+            stats = self.commands.get(command)
+            if stats is None:
+                stats = self.commands[command] = {"count": 0, "failures": 0, "retries": 0, "seconds": 0.0, "max": 0.0, "buckets": [0] * (len(METRICS_LATENCY_BUCKETS) + 1)}
+            stats["count"] += 1
+            stats["failures"] += not success
+            stats["retries"] += attempt > 1
+            stats["seconds"] += duration
+            stats["max"] = max(stats["max"], duration)
+            stats["buckets"][bisect.bisect_left(METRICS_LATENCY_BUCKETS, duration)] += 1
+            if self.spans is not None:
+                self.spans.append((command, "command", start, duration, threading.current_thread().name, dict(details or {}, attempt=attempt, success=success)))
+
+    def record_upload(self, num_bytes, seconds):
+        with self.lock:
+            self.upload_bytes += num_bytes
+            self.upload_seconds += seconds
+
+    def record_phase(self, phase, start):
+        """Record the duration of a phase that started at start (time.time()) and ends now."""
+        end = time.time()
+        phase_timings[phase] = end - start
+        with self.lock:
+            if self.spans is not None:
+                self.spans.append((phase, "phase", start, end - start, "phases", {}))
+
+    @staticmethod
+    def quantile(stats, q):
+        """Upper bound of the histogram bucket that contains the q-quantile (the maximum for the last bucket)."""
+        cumulative = 0
+        for bound, count in zip(METRICS_LATENCY_BUCKETS, stats["buckets"]):
+            cumulative += count
+            if cumulative >= q * stats["count"]:
+                return bound
+        return round(stats["max"], 3)
+
+    def summary(self):
+        """The per-command stats for --stats-json."""
+        with self.lock:
+            return {command: {
+                "count": stats["count"],
+                "failures": stats["failures"],
+                "retries": stats["retries"],
+                "seconds_total": round(stats["seconds"], 3),
+                "seconds_mean": round(stats["seconds"] / stats["count"], 3),
+                "seconds_max": round(stats["max"], 3),
+                "seconds_p50": self.quantile(stats, 0.5),
+                "seconds_p90": self.quantile(stats, 0.9),
+                "seconds_p99": self.quantile(stats, 0.99),
+                "buckets": dict(zip([str(bound) for bound in METRICS_LATENCY_BUCKETS] + ["+Inf"], stats["buckets"])),
+            } for command, stats in sorted(self.commands.items())}
+
+    def write_prometheus(self, path, gauges):
+        """Write the histograms and the given {(name, help): {labels: value}} gauges in the Prometheus text format.
+
+        The file is replaced atomically, so the textfile collector never reads a partial file.
+        """
+        lines = [
+            "# HELP internxt_backup_command_duration_seconds Duration of the CLI commands / WebDAV requests (each attempt).",
+            "# TYPE internxt_backup_command_duration_seconds histogram",
+        ]
+        with self.lock:
+            for command, stats in sorted(self.commands.items()):
+                for bound, cumulative in zip([str(bound) for bound in METRICS_LATENCY_BUCKETS] + ["+Inf"], itertools.accumulate(stats["buckets"])):
+                    lines.append(f'internxt_backup_command_duration_seconds_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+                lines.append(f'internxt_backup_command_duration_seconds_sum{{command="{command}"}} {stats["seconds"]:.6f}')
+                lines.append(f'internxt_backup_command_duration_seconds_count{{command="{command}"}} {stats["count"]}')
+            for name, help_text, key in (("failures", "Failed attempts", "failures"), ("retries", "Retried attempts", "retries")):
+                lines.append(f"# HELP internxt_backup_command_{name}_total {help_text} of the CLI commands / WebDAV requests.")
+                lines.append(f"# TYPE internxt_backup_command_{name}_total counter")
+                lines.extend(f'internxt_backup_command_{name}_total{{command="{command}"}} {stats[key]}' for command, stats in sorted(self.commands.items()))
+        for (name, help_text), values in gauges.items():
+            if not values:
+                continue
+            lines.append(f"# HELP internxt_backup_{name} {help_text}")
+            lines.append(f"# TYPE internxt_backup_{name} gauge")
+            for labels, value in values.items():
+                label_str = "{" + ",".join(f'{key}="{label}"' for key, label in labels) + "}" if labels else ""
+                lines.append(f"internxt_backup_{name}{label_str} {value}")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def write_trace(self, path):
+        """Write the spans as Chrome trace events, one row per thread."""
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+        with self.lock:
+            spans = list(self.spans or ())
+        for name, category, start, duration, thread_name, span_args in spans:
+            if thread_name not in thread_ids:
+                thread_ids[thread_name] = len(thread_ids)
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_ids[thread_name], "args": {"name": thread_name}})
+            events.append({"name": name, "cat": category, "ph": "X", "pid": pid, "tid": thread_ids[thread_name],
+                           "ts": round((start - start_time) * 1e6), "dur": round(duration * 1e6), "args": span_args})
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+command_metrics = CommandMetrics(keep_spans=bool(args.trace_json))
+
 ################################################################################
 # Internxt CLI
 ################################################################################
@@ -182,6 +477,175 @@ def sanitize_command_for_logging(cmd):
 
     return sanitized_cmd
 
+class CliBridge:
+    """A long-lived bridge process that keeps the CLI loaded and runs commands sent as JSON lines.
+
+    Protocol: the bridge writes {"ready": true} once it has started. Each request {"args": [...]} is answered by
+    {"stdout": "...", "stderr": "...", "returncode": N}. One command is processed at a time.
+    """
+    def __init__(self, command):
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding="utf-8", bufsize=1)
+        ready = self.process.stdout.readline()
+        if not ready or json.loads(ready).get("ready") is not True:
+            self.close()
+            raise RuntimeError(f"bridge did not start: {ready!r}")
+
+    def run(self, cli_args):
+        self.process.stdin.write(json.dumps({"args": cli_args}) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise RuntimeError("bridge exited")
+        response = json.loads(line)
+        return subprocess.CompletedProcess(cli_args, response.get("returncode", 1), response.get("stdout", ""), response.get("stderr", ""))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except Exception:
+            self.process.kill()
+
+class CliBridgePool:
+    """Up to 'size' bridges, one per concurrently running command. run() returns None if no bridge is available."""
+    def __init__(self, command, size):
+        self.command = command
+        self.size = size
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.num_bridges = 0
+        self.start_failed = False
+
+    def run(self, cli_args):
+        try:
+            bridge = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_start = not self.start_failed and self.num_bridges < self.size
+                if can_start:
+                    self.num_bridges += 1
+                no_bridges = self.start_failed and self.num_bridges == 0
+            if no_bridges:
+                return None
+            if can_start:
+                try:
+                    bridge_start = time.time()
+                    bridge = CliBridge(self.command)
+                    command_metrics.record("bridge-start", bridge_start, time.time() - bridge_start, True, 1)
+                except Exception as e:
+                    logging.warning(f"Could not start CLI bridge, starting one CLI process per command instead: {e}")
+                    with self.lock:
+                        self.start_failed = True
+                        self.num_bridges -= 1
+                    return None
+            else:
+                bridge = self.idle.get()
+
+        try:
+            result = bridge.run(cli_args)
+        except Exception as e:
+            # The next command starts a new bridge, this one is run as a separate process.
+            logging.warning(f"CLI bridge failed, restarting it: {e}")
+            bridge.close()
+            with self.lock:
+                self.num_bridges -= 1
+            return None
+        self.idle.put(bridge)
+        return result
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+cli_bridge_pool = CliBridgePool(shlex.split(args.cli_bridge), NUM_REMOTE_CONNECTIONS) if args.cli_bridge else None
+if cli_bridge_pool is not None:
+    atexit.register(cli_bridge_pool.close)
+
+def retry_delay(attempt):
+    """Seconds to wait before the retry after the given attempt: RETRY_SLEEP_BASE_SECONDS ** attempt with +-50% jitter,
+    so operations that failed at the same time don't all retry at the same time."""
+    return RETRY_SLEEP_BASE_SECONDS ** attempt * random.uniform(0.5, 1.5)
+
+class CircuitBreaker:
+    """Pauses all remote operations while the service is down.
+
+    After 'threshold' consecutive failed commands the breaker opens: every operation waits for the cooldown
+    instead of failing (and using up its retries) on its own. Afterwards a single operation is let through as a
+    probe. If it succeeds, traffic resumes. If it fails, the breaker opens again with twice the cooldown.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.cond = threading.Condition()
+        self.state = "closed"
+        self.open_until = 0
+        self.probing = False
+        self.probe_started = 0
+        self.consecutive_failures = 0
+        self.num_trips = 0
+
+    def before(self):
+        """Wait until an operation may be sent."""
+        with self.cond:
+            while True:
+                if self.state == "closed":
+                    return
+                if self.state == "open":
+                    remaining = self.open_until - time.monotonic()
+                    if remaining > 0:
+                        self.cond.wait(remaining)
+                        continue
+                    self.state = "half_open"
+                    self.probing = False
+                probe_remaining = self.probe_started + CIRCUIT_BREAKER_PROBE_TIMEOUT_SECONDS - time.monotonic()
+                if not self.probing or probe_remaining <= 0:
+                    if self.probing:
+                        logging.warning("The probe command did not report back, letting another one through.")
+                    self.probing = True
+                    self.probe_started = time.monotonic()
+                    return
+                self.cond.wait(probe_remaining)
+
+    def after(self, success):
+        """Record the outcome of an operation."""
+        with self.cond:
+            if success:
+                if self.state != "closed":
+                    logging.info("Remote service is responding again, resuming.")
+                self.state = "closed"
+                self.consecutive_failures = 0
+                self.cooldown = self.base_cooldown
+                self.cond.notify_all()
+            elif self.state == "half_open" or (self.state == "closed" and self.consecutive_failures + 1 >= self.threshold):
+                self.state = "open"
+                self.open_until = time.monotonic() + self.cooldown
+                self.num_trips += 1
+                self.consecutive_failures = 0
+                logging.warning(f"Remote service seems to be down, pausing all commands for {self.cooldown}s.")
+                self.cooldown = min(self.cooldown * 2, CIRCUIT_BREAKER_MAX_COOLDOWN_SECONDS)
+                self.cond.notify_all()
+            elif self.state == "closed":
+                self.consecutive_failures += 1
+
+circuit_breaker = CircuitBreaker(args.breaker_failures, args.breaker_cooldown)
+
+def execute_cli(cmd, force_interactive):
+    """Run a single CLI command, through the bridge if available."""
+    # Interactive commands and login/logout always get their own process.
+    if cli_bridge_pool is not None and not force_interactive and cmd[1] not in ("login", "logout"):
+        result = cli_bridge_pool.run(cmd[1:])
+        if result is not None:
+            return result
+
+    # Use shell=True on Windows to get proper command resolution (e.g., internxt -> internxt.cmd)
+    if platform.system() == "Windows":
+        return subprocess.run(' '.join(cmd), shell=True, capture_output=True, text=True)
+    return subprocess.run(cmd, capture_output=True, text=True)
+
 def run_cli(args, force_interactive=False, stop_on_message=None, override_num_retries=None, suppress_console_errors=False):
     """Run the CLI with args and return parsed JSON output."""
     cmd = [INTERNXT_CLI_BINARY] + args + ["--json"] + ([] if force_interactive else ["-x"])
@@ -194,12 +658,20 @@ def run_cli(args, force_interactive=False, stop_on_message=None, override_num_re
         sanitized_cmd = sanitize_command_for_logging(cmd)
         logging.debug(f"Running command (attempt {attempt}): {' '.join(sanitized_cmd)}", extra={'suppress_console': suppress_console_errors})
 
-        # Attempt the command
-        # Use shell=True on Windows to get proper command resolution (e.g., internxt -> internxt.cmd)
-        if platform.system() == "Windows":
-            result = subprocess.run(' '.join(cmd), shell=True, capture_output=True, text=True)
-        else:
-            result = subprocess.run(cmd, capture_output=True, text=True)
+        # Attempt the command, unless the service is down.
+        circuit_breaker.before()
+        attempt_start = time.time()
+        try:
+            result = execute_cli(cmd, force_interactive)
+        except BaseException:
+            # Report the attempt, otherwise a probe would never be finished and everything else would wait for it.
+            circuit_breaker.after(False)
+            raise
+        attempt_duration = time.time() - attempt_start
+
+        def finish_attempt(success):
+            circuit_breaker.after(success)
+            command_metrics.record(args[0], attempt_start, attempt_duration, success, attempt, {"command": ' '.join(sanitized_cmd)})
 
         num_retries = attempt - 1
 
@@ -209,8 +681,9 @@ def run_cli(args, force_interactive=False, stop_on_message=None, override_num_re
             logging.error(f"Command failed (exception during JSON parsing) (attempt {attempt}): {' '.join(sanitized_cmd)}", extra={'suppress_console': suppress_console_errors})
             logging.error(result.stderr, extra={'suppress_console': suppress_console_errors})
             logging.error(result.stdout, extra={'suppress_console': suppress_console_errors})
+            finish_attempt(False)
             if attempt < cur_max_num_retries:
-                time.sleep(RETRY_SLEEP_BASE_SECONDS ** attempt)
+                time.sleep(retry_delay(attempt))
                 continue
             return None, num_retries, False
 
@@ -219,46 +692,55 @@ def run_cli(args, force_interactive=False, stop_on_message=None, override_num_re
             logging.error(f"Command failed (invalid JSON) (attempt {attempt}): {' '.join(sanitized_cmd)}", extra={'suppress_console': suppress_console_errors})
             logging.error(result.stderr, extra={'suppress_console': suppress_console_errors})
             logging.error(result.stdout, extra={'suppress_console': suppress_console_errors})
+            finish_attempt(False)
             if attempt < cur_max_num_retries:
-                time.sleep(RETRY_SLEEP_BASE_SECONDS ** attempt)
+                time.sleep(retry_delay(attempt))
                 continue
             return None, num_retries, False
 
         if out.get("success") is not True:
             msg = out.get("message")
-            if stop_on_message is not None and stop_on_message in msg:
+            if stop_on_message is not None and stop_on_message in (msg or ""):
+                finish_attempt(True)
                 return None, num_retries, True
             logging.error(f"Command failed (attempt {attempt}): {' '.join(sanitized_cmd)}", extra={'suppress_console': suppress_console_errors})
             logging.error(f"Message: {msg}", extra={'suppress_console': suppress_console_errors})
+            finish_attempt(False)
             if attempt < cur_max_num_retries:
-                time.sleep(RETRY_SLEEP_BASE_SECONDS ** attempt)
+                time.sleep(retry_delay(attempt))
                 continue
             return None, num_retries, False
 
         if result.returncode != 0:
             logging.error(f"Command failed with returncode != 0 (attempt {attempt}): {' '.join(sanitized_cmd)}", extra={'suppress_console': suppress_console_errors})
             logging.error(json.dumps(out, indent=2), extra={'suppress_console': suppress_console_errors})
+            finish_attempt(False)
             if attempt < cur_max_num_retries:
-                time.sleep(RETRY_SLEEP_BASE_SECONDS ** attempt)
+                time.sleep(retry_delay(attempt))
                 continue
             return None, num_retries, False
 
         # Success!
+        finish_attempt(True)
         return out, num_retries, False
 
 ################################################################################
 # Log in
 ################################################################################
 
-# Check if we're logged in.
-result, num_retries, stopped_on_message = run_cli(["whoami"], stop_on_message="You are not logged in")
+# Check if we're logged in (unless the caller, e.g. internxt_daemon.py, already did).
+if args.assume_logged_in:
+    result, num_retries, stopped_on_message = {}, 0, False
+else:
+    result, num_retries, stopped_on_message = run_cli(["whoami"], stop_on_message="You are not logged in")
 
 # If something else went wrong, bail out.
 if result is None and not stopped_on_message:
     logging.error(f"whoami failed")
     sys.exit(1)
 
-logged_in = False
+# A full run started by --watch inherits the login of the run before it.
+logged_in = os.environ.pop(WATCH_LOGGED_IN_ENV, None) == "1"
 if stopped_on_message:
     # Not logged in, check for credentials
     if not args.email:
@@ -325,16 +807,569 @@ signal.signal(signal.SIGTERM, signal_handler)  # Termination signal
 if platform.system() != "Windows":
     signal.signal(signal.SIGHUP, signal_handler)  # Hangup signal (Unix only)
 
+################################################################################
+# Transports
+# All remote folder/file operations go through a transport. Results have the
+# same shape as the CLI's JSON output ({"list": ...}, {"folder": ...}, {"file": ...}),
+# and every method returns (result or None on failure, number of retries).
+# Interface: list_folder, create_folder, upload_file, download_file, delete_file,
+# delete_folder, move_file, move_folder, rename_file, rename_folder.
+# upload_file takes max_attempts, uploads are retried through the retry queue instead.
+# benchmarks/fake_internxt.py is a fake CLI for testing without an account.
+################################################################################
+
+class CliTransport:
+    """Runs each operation as an internxt CLI command."""
+    def list_folder(self, folder_id):
+        out, num_retries, _ = run_cli(["list", f"--id={folder_id}"])
+        return out, num_retries
+
+    def create_folder(self, parent_id, name):
+        out, num_retries, _ = run_cli(["create-folder", f"--id={parent_id}", f"--name=\"{name}\""])
+        return out, num_retries
+
+    def upload_file(self, abs_path, folder_id, max_attempts=None):
+        out, num_retries, _ = run_cli(["upload-file", "-f", abs_path, f"--destination={folder_id}"], override_num_retries=max_attempts, suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+    def download_file(self, file_id, abs_path):
+        """Download a file to abs_path. The CLI names the file itself, so it is downloaded into a folder next to abs_path first."""
+        download_dir = abs_path + ".download"
+        os.makedirs(download_dir, exist_ok=True)
+        try:
+            out, num_retries, _ = run_cli(["download-file", f"--id={file_id}", f"--directory={download_dir}", "--overwrite"], suppress_console_errors=ENABLE_SUPPRESS)
+            if out is not None:
+                names = os.listdir(download_dir)
+                if len(names) != 1:
+                    logging.error(f"download-file --id={file_id} left {len(names)} files instead of one", extra={'suppress_console': ENABLE_SUPPRESS})
+                    return None, num_retries
+                os.replace(os.path.join(download_dir, names[0]), abs_path)
+        finally:
+            shutil.rmtree(download_dir, ignore_errors=True)
+        return out, num_retries
+
+    def delete_file(self, file_id):
+        out, num_retries, _ = run_cli(["trash-file" if args.use_trash else "delete-permanently-file", f"--id={file_id}"], suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+    def delete_folder(self, folder_id):
+        out, num_retries, _ = run_cli(["trash-folder" if args.use_trash else "delete-permanently-folder", f"--id={folder_id}"], suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+    def move_file(self, file_id, folder_id):
+        out, num_retries, _ = run_cli(["move-file", f"--id={file_id}", f"--destination={folder_id}"], suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+    def move_folder(self, folder_id, parent_id):
+        out, num_retries, _ = run_cli(["move-folder", f"--id={folder_id}", f"--destination={parent_id}"], suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+    def rename_file(self, file_id, name):
+        """Rename a file, name is without the extension."""
+        out, num_retries, _ = run_cli(["rename-file", f"--id={file_id}", f"--name={name}"], suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+    def rename_folder(self, folder_id, name):
+        out, num_retries, _ = run_cli(["rename-folder", f"--id={folder_id}", f"--name={name}"], suppress_console_errors=ENABLE_SUPPRESS)
+        return out, num_retries
+
+class WebDavError(Exception):
+    pass
+
+class WebDavTransport:
+    """Talks to the CLI's WebDAV server over a pool of keep-alive HTTP connections.
+
+    WebDAV addresses folders/files by path, so the folder/file "UUIDs" used everywhere else are
+    (unquoted) paths here, folders with a trailing slash.
+    """
+    PROPFIND_BODY = (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<d:propfind xmlns:d="DAV:"><d:prop><d:resourcetype/><d:getcontentlength/><d:getlastmodified/></d:prop></d:propfind>'
+    )
+    UPLOAD_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, url, pool_size):
+        parsed = urllib.parse.urlsplit(url)
+        self.scheme = parsed.scheme
+        self.origin = f"{parsed.scheme}://{parsed.netloc}"
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip("/")
+        self.connections = queue.LifoQueue()
+        for _ in range(pool_size):
+            self.connections.put(None)  # Connections are opened on first use.
+
+    @staticmethod
+    def folder_path(folder_id):
+        """Normalize a folder id ("" = root) to a path with leading and trailing slash."""
+        return "/" + folder_id.strip("/") + "/" if folder_id.strip("/") else "/"
+
+    def _connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, context=ssl.create_default_context(), blocksize=self.UPLOAD_BLOCK_SIZE)
+        return http.client.HTTPConnection(self.host, self.port, blocksize=self.UPLOAD_BLOCK_SIZE)
+
+    def _request(self, method, path, body=None, headers=None, sink=None):
+        """Send one request on a pooled connection, returns (status, response body).
+
+        With sink (a file object), a successful response body is streamed to it and b"" is returned.
+        """
+        conn = self.connections.get()
+        try:
+            if conn is None:
+                conn = self._connect()
+            conn.request(method, self.base_path + urllib.parse.quote(path), body=body, headers=headers or {})
+            response = conn.getresponse()
+            if sink is not None and response.status == 200:
+                shutil.copyfileobj(response, sink, self.UPLOAD_BLOCK_SIZE)
+                data = b""
+            else:
+                data = response.read()
+            if response.will_close:
+                conn.close()
+                conn = None
+            return response.status, data
+        except Exception:
+            if conn is not None:
+                conn.close()
+            conn = None
+            raise
+        finally:
+            self.connections.put(conn)
+
+    def _with_retries(self, command, description, operation, max_attempts=None):
+        """Run operation with retries, command is the name of the matching CLI command for the metrics."""
+        max_attempts = max_attempts or MAX_NUM_RETRIES
+        for attempt in range(1, max_attempts + 1):
+            circuit_breaker.before()
+            attempt_start = time.time()
+            try:
+                result = operation()
+            except (OSError, http.client.HTTPException, WebDavError, ElementTree.ParseError) as e:
+                circuit_breaker.after(False)
+                command_metrics.record(command, attempt_start, time.time() - attempt_start, False, attempt, {"request": description})
+                logging.error(f"WebDAV request failed (attempt {attempt}): {description}: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+                if attempt < max_attempts:
+                    time.sleep(retry_delay(attempt))
+                continue
+            except BaseException:
+                circuit_breaker.after(False)
+                raise
+            circuit_breaker.after(True)
+            command_metrics.record(command, attempt_start, time.time() - attempt_start, True, attempt, {"request": description})
+            return result, attempt - 1
+        return None, max_attempts - 1
+
+    @staticmethod
+    def _check_status(method, path, status, expected):
+        if status not in expected:
+            raise WebDavError(f"{method} {path} returned HTTP {status}")
+
+    @staticmethod
+    def _split_file_name(name):
+        base, ext = os.path.splitext(name)
+        return base, ext[1:]
+
+    def list_folder(self, folder_id):
+        path = self.folder_path(folder_id)
+        def operation():
+            status, data = self._request("PROPFIND", path, body=self.PROPFIND_BODY, headers={"Depth": "1", "Content-Type": "application/xml"})
+            self._check_status("PROPFIND", path, status, (207,))
+            folders, files = [], []
+            for response in ElementTree.fromstring(data).iter("{DAV:}response"):
+                href = urllib.parse.unquote(urllib.parse.urlsplit(response.findtext("{DAV:}href", "")).path)
+                item_path = href[len(self.base_path):] if href.startswith(self.base_path) else href
+                if item_path.rstrip("/") == path.rstrip("/"):
+                    continue  # The folder itself.
+                name = item_path.rstrip("/").rsplit("/", 1)[-1]
+                modification_time = response.findtext(".//{DAV:}getlastmodified")
+                if response.find(".//{DAV:}resourcetype/{DAV:}collection") is not None:
+                    folders.append({"type": "folder", "uuid": item_path.rstrip("/") + "/", "plainName": name, "size": 0, "modificationTime": modification_time})
+                else:
+                    base, ext = self._split_file_name(name)
+                    files.append({"type": ext, "uuid": item_path, "plainName": base, "size": response.findtext(".//{DAV:}getcontentlength", "0"), "modificationTime": modification_time})
+            return {"success": True, "list": {"folders": folders, "files": files}}
+        return self._with_retries("list", f"list {path}", operation)
+
+    def create_folder(self, parent_id, name):
+        path = self.folder_path(parent_id) + name + "/"
+        def operation():
+            status, _ = self._request("MKCOL", path)
+            self._check_status("MKCOL", path, status, (201,))
+            return {"success": True, "folder": {"type": "folder", "uuid": path, "plainName": name, "size": 0}}
+        return self._with_retries("create-folder", f"create folder {path}", operation)
+
+    def upload_file(self, abs_path, folder_id, max_attempts=None):
+        name = os.path.basename(abs_path)
+        path = self.folder_path(folder_id) + name
+        def operation():
+            with open(abs_path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                # The file object is streamed in blocks, it is never read into memory as a whole.
+                status, _ = self._request("PUT", path, body=f, headers={"Content-Length": str(size), "Content-Type": "application/octet-stream"})
+            self._check_status("PUT", path, status, (200, 201, 204))
+            base, ext = self._split_file_name(name)
+            return {"success": True, "file": {"uuid": path, "plainName": base, "type": ext, "size": str(size)}}
+        return self._with_retries("upload-file", f"upload {path}", operation, max_attempts)
+
+    def download_file(self, file_id, abs_path):
+        def operation():
+            with open(abs_path, "wb") as f:
+                status, _ = self._request("GET", file_id, sink=f)
+            self._check_status("GET", file_id, status, (200,))
+            return {"success": True, "path": abs_path}
+        return self._with_retries("download-file", f"download {file_id}", operation)
+
+    def _delete(self, command, path):
+        def operation():
+            status, _ = self._request("DELETE", path)
+            self._check_status("DELETE", path, status, (200, 204))
+            return {"success": True}
+        return self._with_retries(command, f"delete {path}", operation)
+
+    def delete_file(self, file_id):
+        return self._delete("delete-file", file_id)
+
+    def delete_folder(self, folder_id):
+        return self._delete("delete-folder", self.folder_path(folder_id))
+
+    def _move(self, command, kind, path, destination):
+        """MOVE path to destination, the new path is the new id of the file/folder."""
+        def operation():
+            headers = {"Destination": self.origin + self.base_path + urllib.parse.quote(destination), "Overwrite": "F"}
+            status, _ = self._request("MOVE", path, headers=headers)
+            self._check_status("MOVE", path, status, (201, 204))
+            return {"success": True, kind: {"uuid": destination}}
+        return self._with_retries(command, f"move {path} to {destination}", operation)
+
+    def move_file(self, file_id, folder_id):
+        return self._move("move-file", "file", file_id, self.folder_path(folder_id) + file_id.rsplit("/", 1)[-1])
+
+    def move_folder(self, folder_id, parent_id):
+        return self._move("move-folder", "folder", self.folder_path(folder_id), self.folder_path(parent_id) + folder_id.strip("/").rsplit("/", 1)[-1] + "/")
+
+    def rename_file(self, file_id, name):
+        folder_path, file_name = file_id.rsplit("/", 1)
+        _, ext = self._split_file_name(file_name)
+        return self._move("rename-file", "file", file_id, f"{folder_path}/{name}.{ext}" if ext else f"{folder_path}/{name}")
+
+    def rename_folder(self, folder_id, name):
+        path = self.folder_path(folder_id)
+        return self._move("rename-folder", "folder", path, path.rstrip("/").rsplit("/", 1)[0] + "/" + name + "/")
+
+if args.transport == "webdav":
+    transport = WebDavTransport(args.webdav_url, NUM_REMOTE_CONNECTIONS)
+else:
+    transport = CliTransport()
+
+################################################################################
+# Adaptive concurrency
+# With --adaptive-jobs, the number of concurrent uploads and folder listings is
+# adjusted between 1 and --jobs (AIMD, like TCP congestion control): it is raised
+# while the aggregate throughput of a measurement window keeps improving, and
+# halved as soon as more than ADAPTIVE_MAX_FAILURE_RATE of the operations of a
+# window fail (at most once per average operation time, so a burst of failures
+# only counts once). Without --adaptive-jobs the limit is --jobs.
+################################################################################
+
+class AdaptiveConcurrency:
+    """Limits the number of concurrent operations of one kind, acquire() before and release() after each one."""
+    def __init__(self, name, unit, max_limit):
+        self.name = name
+        self.unit = unit # Unit of the amounts passed to release(), "B" (bytes) or "folders"
+        self.max_limit = max_limit
+        self.limit = min(2, max_limit) if args.adaptive_jobs else max_limit
+        self.peak_limit = self.limit
+        self.num_decisions = 0
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        self.slow_start = True # Double the limit until the throughput stops improving
+        self.last_throughput = None
+        self.last_decrease = 0
+        self.mean_elapsed = None
+        self._reset_window()
+
+    def _reset_window(self):
+        self.window_start = time.monotonic()
+        self.window_amount = 0
+        self.window_ops = 0
+        self.window_failures = 0
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    def release(self, amount, elapsed, success):
+        """Record an operation that transferred amount (bytes or folders) in elapsed seconds."""
+        with self.cond:
+            self.in_flight -= 1
+            if args.adaptive_jobs:
+                self._record(amount, elapsed, success)
+            self.cond.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = max(1, min(self.max_limit, limit))
+        if limit == self.limit:
+            return
+        logging.info(f"Adaptive concurrency ({self.name}): {self.limit} -> {limit}, {reason}", extra={'suppress_console': ENABLE_SUPPRESS})
+        self.num_decisions += 1
+        self.limit = limit
+        self.peak_limit = max(self.peak_limit, limit)
+
+    def _format_throughput(self, throughput):
+        return f"{format_size(throughput)}/s" if self.unit == "B" else f"{throughput:.1f} {self.unit}/s"
+
+    def _record(self, amount, elapsed, success):
+        now = time.monotonic()
+        self.mean_elapsed = elapsed if self.mean_elapsed is None else 0.8 * self.mean_elapsed + 0.2 * elapsed
+        self.window_ops += 1
+        if not success:
+            self.window_failures += 1
+            # Multiplicative decrease, at most once per average operation time.
+            failure_rate = self.window_failures / max(self.window_ops, 2 * self.limit, 4)
+            if failure_rate > ADAPTIVE_MAX_FAILURE_RATE and now - self.last_decrease >= self.mean_elapsed:
+                self._set_limit(self.limit // 2, f"{self.window_failures}/{self.window_ops} operations failed")
+                self.slow_start = False
+                self.last_decrease = now
+                self.last_throughput = None
+                self._reset_window()
+            return
+        self.window_amount += amount
+
+        window_seconds = now - self.window_start
+        if window_seconds < ADAPTIVE_WINDOW_SECONDS or self.window_ops < 2 * self.limit:
+            return
+        throughput = self.window_amount / window_seconds
+        if self.window_failures / self.window_ops > ADAPTIVE_MAX_FAILURE_RATE:
+            pass # Halved already when the failures occurred.
+        elif self.last_throughput is None or throughput >= self.last_throughput * ADAPTIVE_MIN_IMPROVEMENT:
+            if self.limit < self.max_limit:
+                previous = f", was {self._format_throughput(self.last_throughput)}" if self.last_throughput is not None else ""
+                self._set_limit(self.limit * 2 if self.slow_start else self.limit + 1, f"throughput {self._format_throughput(throughput)}{previous}")
+        else:
+            self.slow_start = False
+            if throughput < self.last_throughput / ADAPTIVE_MIN_IMPROVEMENT and self.limit > 1:
+                self._set_limit(self.limit - 1, f"throughput dropped to {self._format_throughput(throughput)} from {self._format_throughput(self.last_throughput)}")
+            else:
+                logging.info(f"Adaptive concurrency ({self.name}): keeping {self.limit}, throughput {self._format_throughput(throughput)} did not improve", extra={'suppress_console': ENABLE_SUPPRESS})
+        self.last_throughput = throughput
+        self._reset_window()
+
+upload_concurrency = AdaptiveConcurrency("uploads", "B", args.jobs)
+list_concurrency = AdaptiveConcurrency("listings", "folders", args.jobs)
+
+################################################################################
+# Remote manifest
+# Persistent copy of the remote folder listings, keyed by the target UUID.
+# It is updated after each successful upload / folder creation / deletion, so
+# with --trust-manifest unchanged folders don't have to be listed again.
+################################################################################
+
+class RemoteManifest:
+    def __init__(self, path, target):
+        self.target = target
+        self.lock = threading.Lock()
+        # The connection is shared by the worker threads, all accesses are serialized by the lock.
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # A row in remote_folders means that the listing of that folder in remote_items is complete.
+        self.conn.execute("CREATE TABLE IF NOT EXISTS remote_folders (target TEXT, uuid TEXT, local_signature TEXT, PRIMARY KEY (target, uuid))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS remote_items (target TEXT, folder_uuid TEXT, name TEXT, type TEXT, uuid TEXT, size INTEGER, modification_time TEXT, PRIMARY KEY (target, folder_uuid, name))")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS remote_items_uuid ON remote_items (target, uuid)")
+        # The CLI doesn't expose checksums, so we record the content hash of each file we upload.
+        self.conn.execute("CREATE TABLE IF NOT EXISTS remote_hashes (target TEXT, uuid TEXT, hash TEXT, PRIMARY KEY (target, uuid))")
+        # Restore index of --pack-small-files: which file of a folder is stored in which tar bundle, at which offset.
+        self.conn.execute("CREATE TABLE IF NOT EXISTS bundle_members (target TEXT, folder_uuid TEXT, bundle TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, offset INTEGER, PRIMARY KEY (target, folder_uuid, name))")
+        # Reassembly index of --split-size, keyed by the UUID of the parts folder. A split_files row means all parts were uploaded.
+        self.conn.execute("CREATE TABLE IF NOT EXISTS split_files (target TEXT, folder_uuid TEXT, size INTEGER, mtime_ns INTEGER, part_size INTEGER, PRIMARY KEY (target, folder_uuid))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS split_parts (target TEXT, folder_uuid TEXT, part INTEGER, offset INTEGER, size INTEGER, hash TEXT, PRIMARY KEY (target, folder_uuid, part))")
+
+    def clear(self):
+        """Forget everything known about the target."""
+        with self.lock:
+            self.conn.execute("DELETE FROM remote_folders WHERE target=?", (self.target,))
+            self.conn.execute("DELETE FROM remote_items WHERE target=?", (self.target,))
+            # The bundle contents are kept, bundles that no longer exist remotely are dropped by the next remote check.
+
+    def _item_row(self, folder_uuid, name, metadata):
+        try:
+            size = int(metadata.get("size") or 0)
+        except (TypeError, ValueError):
+            size = 0
+        return (self.target, folder_uuid, name, metadata.get("type"), metadata.get("uuid"), size, metadata.get("modificationTime"))
+
+    def store_listing(self, folder_uuid, items):
+        """Replace the stored listing of a folder with a fresh remote listing."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM remote_items WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))
+            self.conn.executemany("INSERT OR REPLACE INTO remote_items VALUES (?, ?, ?, ?, ?, ?, ?)", [self._item_row(folder_uuid, name, metadata) for name, metadata in items.items()])
+            self.conn.execute("INSERT OR REPLACE INTO remote_folders VALUES (?, ?, NULL)", (self.target, folder_uuid))
+            self.conn.execute("COMMIT")
+
+    def load_listing(self, folder_uuid):
+        """Return the stored listing in the same format as list_remote_directory(), or None if unknown."""
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM remote_folders WHERE target=? AND uuid=?", (self.target, folder_uuid)).fetchone() is None:
+                return None
+            rows = self.conn.execute("SELECT name, type, uuid, size, modification_time FROM remote_items WHERE target=? AND folder_uuid=?", (self.target, folder_uuid)).fetchall()
+        return {name: {"type": item_type, "uuid": item_uuid, "size": size, "modificationTime": modification_time} for name, item_type, item_uuid, size, modification_time in rows}
+
+    def get_signature(self, folder_uuid):
+        with self.lock:
+            row = self.conn.execute("SELECT local_signature FROM remote_folders WHERE target=? AND uuid=?", (self.target, folder_uuid)).fetchone()
+        return row[0] if row else None
+
+    def set_signature(self, folder_uuid, signature):
+        """Remember the local folder contents the stored listing was reconciled against."""
+        with self.lock:
+            self.conn.execute("UPDATE remote_folders SET local_signature=? WHERE target=? AND uuid=?", (signature, self.target, folder_uuid))
+
+    def add_item(self, folder_uuid, name, metadata):
+        """Record a newly uploaded file or created folder."""
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO remote_items VALUES (?, ?, ?, ?, ?, ?, ?)", self._item_row(folder_uuid, name, metadata))
+            if metadata.get("type") == "folder":
+                # A new folder is empty, so its (empty) listing is complete.
+                self.conn.execute("INSERT OR REPLACE INTO remote_folders VALUES (?, ?, NULL)", (self.target, metadata.get("uuid")))
+
+    def remove_file(self, file_uuid):
+        with self.lock:
+            self.conn.execute("DELETE FROM remote_items WHERE target=? AND uuid=?", (self.target, file_uuid))
+            self.conn.execute("DELETE FROM remote_hashes WHERE target=? AND uuid=?", (self.target, file_uuid))
+
+    def move_item(self, item_uuid, folder_uuid, name, new_uuid):
+        """Record that a file or folder was moved and/or renamed.
+
+        With WebDAV the UUID is the path, which changes as well. The listings below a moved folder are then dropped.
+        """
+        with self.lock:
+            self.conn.execute("BEGIN")
+            if new_uuid != item_uuid:
+                for uuid in self._subtree(item_uuid):
+                    self._remove_listing(uuid)
+                self.conn.execute("UPDATE OR REPLACE remote_hashes SET uuid=? WHERE target=? AND uuid=?", (new_uuid, self.target, item_uuid))
+            self.conn.execute("UPDATE OR REPLACE remote_items SET folder_uuid=?, name=?, uuid=? WHERE target=? AND uuid=?", (folder_uuid, name, new_uuid, self.target, item_uuid))
+            self.conn.execute("COMMIT")
+
+    def get_hash(self, file_uuid):
+        with self.lock:
+            row = self.conn.execute("SELECT hash FROM remote_hashes WHERE target=? AND uuid=?", (self.target, file_uuid)).fetchone()
+        return row[0] if row else None
+
+    def set_hash(self, file_uuid, file_hash):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO remote_hashes VALUES (?, ?, ?)", (self.target, file_uuid, file_hash))
+
+    def load_bundles(self, folder_uuid):
+        """Return the bundles recorded for a folder as {bundle name: {member name: (size, mtime_ns, offset)}}."""
+        bundles = defaultdict(dict)
+        with self.lock:
+            for bundle, name, size, mtime_ns, offset in self.conn.execute("SELECT bundle, name, size, mtime_ns, offset FROM bundle_members WHERE target=? AND folder_uuid=?", (self.target, folder_uuid)):
+                bundles[bundle][name] = (size, mtime_ns, offset)
+        return bundles
+
+    def store_bundle(self, folder_uuid, bundle, members):
+        """Record an uploaded bundle, members are (name, size, mtime_ns, offset) tuples."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.execute("DELETE FROM bundle_members WHERE target=? AND folder_uuid=? AND bundle=?", (self.target, folder_uuid, bundle))
+            self.conn.executemany("INSERT OR REPLACE INTO bundle_members VALUES (?, ?, ?, ?, ?, ?, ?)", [(self.target, folder_uuid, bundle, *member) for member in members])
+            self.conn.execute("COMMIT")
+
+    def remove_bundle(self, folder_uuid, bundle):
+        with self.lock:
+            self.conn.execute("DELETE FROM bundle_members WHERE target=? AND folder_uuid=? AND bundle=?", (self.target, folder_uuid, bundle))
+
+    def load_split_file(self, folder_uuid):
+        """Return (size, mtime_ns, part_size) of a completely uploaded split file, or None."""
+        with self.lock:
+            return self.conn.execute("SELECT size, mtime_ns, part_size FROM split_files WHERE target=? AND folder_uuid=?", (self.target, folder_uuid)).fetchone()
+
+    def store_split_file(self, folder_uuid, size, mtime_ns, part_size):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO split_files VALUES (?, ?, ?, ?, ?)", (self.target, folder_uuid, size, mtime_ns, part_size))
+
+    def remove_split_file(self, folder_uuid):
+        """Mark a split file as incomplete, the recorded parts are kept."""
+        with self.lock:
+            self.conn.execute("DELETE FROM split_files WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))
+
+    def load_split_parts(self, folder_uuid):
+        """Return the uploaded parts of a split file as {part: (offset, size, hash)}."""
+        with self.lock:
+            return {part: (offset, size, part_hash) for part, offset, size, part_hash in self.conn.execute("SELECT part, offset, size, hash FROM split_parts WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))}
+
+    def set_split_part(self, folder_uuid, part, offset, size, part_hash):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO split_parts VALUES (?, ?, ?, ?, ?, ?)", (self.target, folder_uuid, part, offset, size, part_hash))
+
+    def _subtree(self, folder_uuid):
+        """The UUIDs of a folder and all known subfolders (lock must be held)."""
+        return [row[0] for row in self.conn.execute("""
+            WITH RECURSIVE subtree(uuid) AS (
+                SELECT ?
+                UNION
+                SELECT remote_items.uuid FROM remote_items JOIN subtree ON remote_items.folder_uuid = subtree.uuid
+                WHERE remote_items.target = ? AND remote_items.type = 'folder'
+            )
+            SELECT uuid FROM subtree""", (folder_uuid, self.target)).fetchall()]
+
+    def _remove_listing(self, folder_uuid):
+        """Remove the stored listing of a folder (lock must be held)."""
+        self.conn.execute("DELETE FROM remote_hashes WHERE target=? AND uuid IN (SELECT uuid FROM remote_items WHERE target=? AND folder_uuid=?)", (self.target, self.target, folder_uuid))
+        self.conn.execute("DELETE FROM remote_items WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))
+        self.conn.execute("DELETE FROM remote_folders WHERE target=? AND uuid=?", (self.target, folder_uuid))
+        self.conn.execute("DELETE FROM bundle_members WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))
+        self.conn.execute("DELETE FROM split_files WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))
+        self.conn.execute("DELETE FROM split_parts WHERE target=? AND folder_uuid=?", (self.target, folder_uuid))
+
+    def folder_size(self, folder_uuid):
+        """Total size of the files below a folder as far as the stored listings go.
+
+        Returns (size, number of folders in the subtree whose listing is unknown).
+        """
+        size, num_unknown_folders = 0, 0
+        with self.lock:
+            for uuid in self._subtree(folder_uuid):
+                if self.conn.execute("SELECT 1 FROM remote_folders WHERE target=? AND uuid=?", (self.target, uuid)).fetchone() is None:
+                    num_unknown_folders += 1
+                    continue
+                size += self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM remote_items WHERE target=? AND folder_uuid=? AND type IS NOT 'folder'", (self.target, uuid)).fetchone()[0]
+        return size, num_unknown_folders
+
+    def remove_folder(self, folder_uuid):
+        """Remove a folder, its listing and the listings of all known subfolders."""
+        with self.lock:
+            self.conn.execute("BEGIN")
+            for uuid in self._subtree(folder_uuid):
+                self.conn.execute("DELETE FROM remote_items WHERE target=? AND uuid=?", (self.target, uuid))
+                self._remove_listing(uuid)
+            self.conn.execute("COMMIT")
+
+manifest = RemoteManifest(args.manifest, args.dest_id)
+if args.refresh_remote:
+    logging.info("Refreshing remote state, discarding manifest for this target.")
+    manifest.clear()
+
 ################################################################################
 # Remote Folder Helpers & UUID Cache
 ################################################################################
 
 # Cache for directory listings
+# Upload workers invalidate entries concurrently, so all accesses go through the lock.
 remote_dir_cache = {}
+remote_dir_cache_lock = threading.Lock()
 
 def list_remote_directory(folder_uuid):
     """List contents of remote directory, returns dict of {name: metadata}."""
-    result, num_retries, _ = run_cli(["list", f"--id={folder_uuid}"])
+    list_concurrency.acquire()
+    list_start = time.time()
+    result, num_retries = transport.list_folder(folder_uuid)
+    list_concurrency.release(1, time.time() - list_start, result is not None and num_retries == 0)
 
     if result is None:
         logging.error(f"list failed, exiting")
@@ -343,27 +1378,45 @@ def list_remote_directory(folder_uuid):
     if num_retries > 0:
         logging.info(f"List command required {num_retries} retries: list --id={folder_uuid}")
 
+    # The listing is indexed by canonical name, so it is matched against the local names without normalizing again.
     items = {}
     for item in result.get("list", {}).get("folders", []):
-        if "plainName" in item:  # Use decrypted name if available
-            # Make sure we convert the result to UTF-8, otherwise file name matching is broken.
-            items[normalize_encoding(item["plainName"])] = item
-        else:
-            items[item["name"]] = item
+        # Use decrypted name if available
+        add_canonical_name(items, item["plainName"] if "plainName" in item else item["name"], item, "remote", folder_uuid)
     for item in result.get("list", {}).get("files", []):
         if "plainName" in item:  # Use decrypted name if available
-            # Make sure we convert the result to UTF-8, otherwise file name matching is broken.
-            items[normalize_encoding(item["plainName"]) + "." + item['type']] = item
+            # Files without an extension have an empty type.
+            add_canonical_name(items, item["plainName"] + "." + item['type'] if item.get('type') else item["plainName"], item, "remote", folder_uuid)
         else:
-            items[item["name"]] = item
+            add_canonical_name(items, item["name"], item, "remote", folder_uuid)
 
+    manifest.store_listing(folder_uuid, items)
     return items
 
+def is_ghost(metadata):
+    """Whether a listed file is reported to exist but is not actually stored (it doesn't show up in the web client)."""
+    if metadata.get("deleted") or metadata.get("removed") or metadata.get("status", "EXISTS") != "EXISTS":
+        return True
+    # A file without a storage object, e.g. after an upload that failed on the server side.
+    return metadata.get("type") != "folder" and "fileId" in metadata and not metadata["fileId"]
+
+def is_bundle_name(name):
+    return name.startswith(PACK_BUNDLE_PREFIX) and name.endswith(".tar")
+
 def get_cached_dir_listing(folder_uuid):
     """Get directory listing, using cache if available."""
-    if folder_uuid not in remote_dir_cache:
-        remote_dir_cache[folder_uuid] = list_remote_directory(folder_uuid)
-    return remote_dir_cache[folder_uuid]
+    with remote_dir_cache_lock:
+        items = remote_dir_cache.get(folder_uuid)
+    if items is None:
+        items = list_remote_directory(folder_uuid)
+        with remote_dir_cache_lock:
+            remote_dir_cache[folder_uuid] = items
+    return items
+
+def invalidate_cached_dir_listing(folder_uuid):
+    """Drop the cached listing of a folder after it has been modified."""
+    with remote_dir_cache_lock:
+        remote_dir_cache.pop(folder_uuid, None)
 
 def get_or_create_folder(parent_items, parent_uuid, folder_name, parent_rel):
     """Get existing folder UUID or create new folder and return its UUID."""
@@ -376,7 +1429,7 @@ def get_or_create_folder(parent_items, parent_uuid, folder_name, parent_rel):
         return folder_uuid
 
     # Create new folder if it doesn't exist
-    out, num_retries, _ = run_cli(["create-folder", f"--id={parent_uuid}", f"--name=\"{folder_name}\""])
+    out, num_retries = transport.create_folder(parent_uuid, folder_name)
 
     if out is None:
         logging.error(f"create-folder failed, exiting")
@@ -396,7 +1449,11 @@ def get_or_create_folder(parent_items, parent_uuid, folder_name, parent_rel):
     logging.info(f"Created folder '{folder_name}' in '{parent_rel}' -> ID: {folder_uuid}", extra={'suppress_console': ENABLE_SUPPRESS})
 
     # Invalidate parent's cache since we modified it
-    remote_dir_cache.pop(parent_uuid, None)
+    invalidate_cached_dir_listing(parent_uuid)
+    manifest.add_item(parent_uuid, folder_name, folder_obj)
+    # A freshly created folder is empty, no need to list it.
+    with remote_dir_cache_lock:
+        remote_dir_cache[folder_uuid] = {}
     return folder_uuid
 
 def get_or_create_folder_from_uuid(parent_uuid, folder_name, parent_rel):
@@ -416,31 +1473,859 @@ folder_uuids["."] = DEST_ROOT_ID
 
 # Ensure the base source folder itself exists remotely (so we can nest into it)
 src_name = os.path.basename(os.path.normpath(SRC_DIR))
-DEST_ROOT_ID = get_or_create_folder_from_uuid(DEST_ROOT_ID, normalize_encoding(src_name), ".")
+if args.restore:
+    # Restore from the existing backup folder, never create it.
+    root_item = get_cached_dir_listing(DEST_ROOT_ID).get(canonical_name(src_name))
+    if root_item is None or root_item.get("type") != "folder":
+        logging.error(f"No backup folder '{src_name}' found in the target folder, nothing to restore")
+        sys.exit(1)
+    DEST_ROOT_ID = root_item["uuid"]
+else:
+    DEST_ROOT_ID = get_or_create_folder_from_uuid(DEST_ROOT_ID, canonical_name(src_name), ".")
 
 # re-map "." to the newly created/validated root folder UUID
 folder_uuids["."] = DEST_ROOT_ID
 
+################################################################################
+# Local snapshot
+# Persistent index of the local files (size, mtime, inode) per directory, stored
+# in the manifest file. Directories whose mtime did not change since the last run
+# are not read again, only the files recorded in the snapshot are stat'ed (editing
+# a file in place does not change the mtime of its directory).
+################################################################################
+
+class LocalSnapshot:
+    def __init__(self, path, source):
+        self.source = source
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS local_dirs (source TEXT, rel_dir TEXT, mtime_ns INTEGER, inode INTEGER, ignored INTEGER, subdirs TEXT, PRIMARY KEY (source, rel_dir))")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS local_files (source TEXT, rel_dir TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, inode INTEGER, PRIMARY KEY (source, rel_dir, name))")
+
+    def load_dir(self, rel_dir):
+        """Return (mtime_ns, inode, ignored, subdirs, files) of a directory or None if unknown. files maps name -> (size, mtime_ns, inode)."""
+        row = self.conn.execute("SELECT mtime_ns, inode, ignored, subdirs FROM local_dirs WHERE source=? AND rel_dir=?", (self.source, rel_dir)).fetchone()
+        if row is None:
+            return None
+        mtime_ns, inode, ignored, subdirs = row
+        files = {name: (size, file_mtime_ns, file_inode) for name, size, file_mtime_ns, file_inode in self.conn.execute("SELECT name, size, mtime_ns, inode FROM local_files WHERE source=? AND rel_dir=?", (self.source, rel_dir))}
+        return mtime_ns, inode, bool(ignored), json.loads(subdirs), files
+
+    def all_dirs(self):
+        return {row[0] for row in self.conn.execute("SELECT rel_dir FROM local_dirs WHERE source=?", (self.source,))}
+
+    def removed_files(self, rel_dirs):
+        """Yield the relative paths of all files recorded in the given directories."""
+        for rel_dir in rel_dirs:
+            for (name,) in self.conn.execute("SELECT name FROM local_files WHERE source=? AND rel_dir=?", (self.source, rel_dir)).fetchall():
+                yield normalize_rel_path(rel_dir, name)
+
+    def save(self, dir_entries, removed_dirs, invalidated_dirs):
+        """Store the re-read directories, drop the removed ones and make sure the invalidated ones are read again next time."""
+        self.conn.execute("BEGIN")
+        for rel_dir in removed_dirs:
+            self.conn.execute("DELETE FROM local_dirs WHERE source=? AND rel_dir=?", (self.source, rel_dir))
+            self.conn.execute("DELETE FROM local_files WHERE source=? AND rel_dir=?", (self.source, rel_dir))
+        for rel_dir, (mtime_ns, inode, ignored, subdirs, files) in dir_entries.items():
+            self.conn.execute("INSERT OR REPLACE INTO local_dirs VALUES (?, ?, ?, ?, ?, ?)", (self.source, rel_dir, mtime_ns, inode, int(ignored), json.dumps(subdirs)))
+            self.conn.execute("DELETE FROM local_files WHERE source=? AND rel_dir=?", (self.source, rel_dir))
+            self.conn.executemany("INSERT INTO local_files VALUES (?, ?, ?, ?, ?, ?)", [(self.source, rel_dir, name, size, file_mtime_ns, file_inode) for name, (size, file_mtime_ns, file_inode) in files.items()])
+        self.conn.executemany("UPDATE local_dirs SET mtime_ns=NULL WHERE source=? AND rel_dir=?", [(self.source, rel_dir) for rel_dir in invalidated_dirs])
+        self.conn.execute("COMMIT")
+
+def read_local_dir(abs_dir):
+    """Read a directory, returns (ignored, subdirs, files) with files mapping name -> (size, mtime_ns, inode)."""
+    subdirs = []
+    files = {}
+    with os.scandir(abs_dir) as it:
+        for entry in it:
+            if entry.name.startswith(RESTORE_TEMP_PREFIX):
+                continue  # Incomplete download of an interrupted --restore.
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                    continue
+                if entry.is_dir():
+                    continue  # Symlinks to directories are not followed (a link to a parent would loop forever).
+                st = entry.stat()
+                files[entry.name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            except OSError:
+                logging.error(f"Could not determine size of file {entry.path}")
+                files[entry.name] = (0, 0, 0)
+    return IGNOREFILE_NAME in files, subdirs, files
+
+def scan_local_dir(abs_dir, previous):
+    """Stat a directory and its files, returns (dir_stat, (ignored, subdirs, files), whether the snapshot entry was reused).
+
+    If the directory did not change since the snapshot entry previous (None if unknown), it is not read again,
+    the files recorded in the snapshot are stat'ed instead.
+    """
+    dir_stat = os.stat(abs_dir)
+    if previous is not None and not args.rescan_local and previous[0] == dir_stat.st_mtime_ns and previous[1] == dir_stat.st_ino:
+        _, _, ignored, subdirs, previous_files = previous
+        files = {}
+        try:
+            for name in previous_files:
+                st = os.stat(os.path.join(abs_dir, name))
+                files[name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+        except FileNotFoundError:
+            pass  # The directory changed in the meantime, read it.
+        else:
+            return dir_stat, (ignored, subdirs, files), True
+    return dir_stat, read_local_dir(abs_dir), False
+
+local_snapshot = LocalSnapshot(args.manifest, os.path.abspath(SRC_DIR))
+
+################################################################################
+# Content hashes
+# Hashes are cached in the manifest file keyed by (path, size, mtime_ns), so
+# unchanged files are never hashed again.
+################################################################################
+
+class HashCache:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+
+    def get(self, path, size, mtime_ns):
+        with self.lock:
+            row = self.conn.execute("SELECT hash FROM file_hashes WHERE path=? AND size=? AND mtime_ns=?", (path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def set(self, path, size, mtime_ns, file_hash):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)", (path, size, mtime_ns, file_hash))
+
+hash_cache = HashCache(args.manifest)
+
+def compute_file_hash(abs_path):
+    """SHA-256 of a file. Large files are mapped into memory, smaller ones are read with a large buffer."""
+    file_hash = hashlib.sha256()
+    with open(abs_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= HASH_MMAP_THRESHOLD_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                file_hash.update(mapped)
+        else:
+            while chunk := f.read(HASH_READ_BUFFER_BYTES):
+                file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def get_file_hash(abs_path):
+    """Content hash of a file, from the cache if the file did not change. Returns None if the file can't be read."""
+    try:
+        st = os.stat(abs_path)
+        file_hash = hash_cache.get(abs_path, st.st_size, st.st_mtime_ns)
+        if file_hash is None:
+            file_hash = compute_file_hash(abs_path)
+            hash_cache.set(abs_path, st.st_size, st.st_mtime_ns, file_hash)
+        return file_hash
+    except OSError as e:
+        logging.error(f"Could not hash file {abs_path}: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+        return None
+
+################################################################################
+# Progress bar
+################################################################################
+
+def print_progress_bar(uploaded, total, file, file_size, elapsed_total, num_retried_files, num_failed_files, useBytes=True, bar_len=40, remaining_time=None):
+    percent        = uploaded / total if total else 0
+    filled_len     = int(round(bar_len * percent))
+    bar            = '=' * filled_len + '-' * (bar_len - filled_len)
+    speed          = uploaded / elapsed_total if elapsed_total > 0 else 0
+    if remaining_time is None:
+        remaining_time = ( total - uploaded ) / speed if speed > 0 else 0
+
+    # Create the output string
+    barStr           = f"\r[{bar}] {percent * 100:5.1f}% "
+    progressStr      = f"| {format_size(uploaded)}/{format_size(total)} " if useBytes else f"| {int(uploaded)}/{int(total)} files "
+    numRetriedStr    = f"| retried: {num_retried_files} " if useBytes else f""
+    numFailedStr     = f"| failed: {num_failed_files} " if useBytes else f""
+    speedStr         = f"| avg: {format_size(speed)}/s " if useBytes else f"| avg: {speed:.1f} files/s "
+    elapsedTimeStr   = f"| elapsed: {format_hhmmss(elapsed_total)} "
+    remainingTimeStr = f"| remaining: {format_hhmmss(remaining_time)} "
+    fileStr          = f"| {file} "
+    fileSizeStr      = f"| file size: {format_size(file_size)}" if useBytes else f""
+
+    output = (
+        barStr +
+        progressStr +
+        numRetriedStr +
+        numFailedStr +
+        speedStr +
+        elapsedTimeStr +
+        remainingTimeStr +
+        fileStr +
+        fileSizeStr
+    )
+
+    # Print the output
+    sys.stdout.write(output)
+    sys.stdout.flush()
+
+    # Clear the line if the next file name is shorter
+    # This is done by moving the cursor back to the start of the line
+    # and writing spaces to overwrite the previous output
+    sys.stdout.write('\r' + ' ' * (len(output) - 1) + '\r')
+
+class UploadTimeModel:
+    """Upload time of a file as seconds = overhead per file + size * seconds per byte.
+
+    Fitted by least squares to the timings of the finished uploads. A constant byte rate is far off
+    when many small files (dominated by the overhead of each command) and a few large ones are mixed.
+    """
+    MIN_SAMPLES = 5
+    MIN_SIZE_SPREAD_BYTES = 1024 * 1024 # Smaller differences in size are lost in the latency noise
+    DEFAULT_SECONDS_PER_FILE = 1.0 # Used until enough uploads were timed
+    DEFAULT_SECONDS_PER_BYTE = 1 / (10 * 1024 * 1024)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.num_samples = 0
+        self.mean_bytes = 0.0
+        self.mean_seconds = 0.0
+        self.sum_squares_bytes = 0.0 # Sum of (bytes - mean)^2
+        self.sum_products = 0.0 # Sum of (bytes - mean) * (seconds - mean)
+
+    def add(self, num_bytes, seconds):
+        """Record a successful upload (running update of the means and sums, so no samples are kept)."""
+        with self.lock:
+            self.num_samples += 1
+            delta_bytes = num_bytes - self.mean_bytes
+            self.mean_bytes += delta_bytes / self.num_samples
+            self.mean_seconds += (seconds - self.mean_seconds) / self.num_samples
+            self.sum_squares_bytes += delta_bytes * (num_bytes - self.mean_bytes)
+            self.sum_products += delta_bytes * (seconds - self.mean_seconds)
+
+    def is_fitted(self):
+        return self.num_samples >= self.MIN_SAMPLES
+
+    def coefficients(self):
+        """(seconds per file, seconds per byte), the defaults until enough uploads were timed."""
+        with self.lock:
+            if self.num_samples < self.MIN_SAMPLES:
+                return self.DEFAULT_SECONDS_PER_FILE, self.DEFAULT_SECONDS_PER_BYTE
+            if self.sum_squares_bytes < self.num_samples * self.MIN_SIZE_SPREAD_BYTES ** 2:
+                # The files had (almost) the same size, e.g. with --schedule small-first: only the overhead can be measured.
+                return max(0.0, self.mean_seconds - self.DEFAULT_SECONDS_PER_BYTE * self.mean_bytes), self.DEFAULT_SECONDS_PER_BYTE
+            seconds_per_byte = self.sum_products / self.sum_squares_bytes
+            if seconds_per_byte <= 0:
+                # The size made no difference.
+                return self.mean_seconds, 0.0
+            seconds_per_file = self.mean_seconds - seconds_per_byte * self.mean_bytes
+            if seconds_per_file < 0:
+                return 0.0, self.mean_seconds / self.mean_bytes
+            return seconds_per_file, seconds_per_byte
+
+    def remaining_seconds(self, num_files, num_bytes, parallelism):
+        """Estimated time for the remaining files with the given number of parallel uploads, None until enough uploads were timed."""
+        if not self.is_fitted():
+            return None
+        seconds_per_file, seconds_per_byte = self.coefficients()
+        return (seconds_per_file * max(0, num_files) + seconds_per_byte * max(0, num_bytes)) / parallelism
+
+upload_time_model = UploadTimeModel()
+
+################################################################################
+# Restore
+# With --restore, the backup of --source is downloaded into --source instead.
+# The remote tree is listed level by level (all folders of a level at once) and the
+# local folders are created, then the files are downloaded by --jobs workers.
+# Files that exist locally with the same size are skipped. Downloads are written to
+# a temporary name (RESTORE_TEMP_PREFIX) and renamed once complete, so a restore that
+# was interrupted just continues when it is started again, also within split files.
+# Bundles are extracted, the parts of split files are joined (and checked against
+# their hashes in the manifest). If the local snapshot of the manifest still knows a
+# file, its modification time is restored as well, so the next backup skips it.
+################################################################################
+
+restore_stats = {"folders": 0, "downloaded": 0, "downloaded_size": 0, "skipped": 0, "skipped_size": 0, "failed": 0,
+                 "bundles": 0, "joined": 0, "reused_parts": 0, "retried": 0, "retries": 0, "download_seconds": 0.0}
+restore_bytes_to_download = 0
+restore_start_time = None
+
+# Protects restore_stats and the progress bar output, which are shared by all download workers.
+restore_stats_lock = threading.Lock()
+
+def restore_temp_path(abs_path):
+    return os.path.join(os.path.dirname(abs_path), RESTORE_TEMP_PREFIX + os.path.basename(abs_path))
+
+def print_restore_progress(label, file_size):
+    """Print the progress bar for a download that is starting, the caller holds restore_stats_lock."""
+    elapsed_total = time.time() - restore_start_time
+    print_progress_bar(restore_stats["downloaded_size"], restore_bytes_to_download, label, file_size, elapsed_total, restore_stats["retried"], restore_stats["failed"])
+
+def set_restored_mtime(abs_path, size, snapshot_file, mtime_ns=None):
+    """Set the modification time of a restored file to the one in its snapshot entry (size, mtime_ns) if the size matches, else to mtime_ns."""
+    if snapshot_file is not None and snapshot_file[0] == size:
+        mtime_ns = snapshot_file[1]
+    if mtime_ns is None:
+        return
+    try:
+        os.utime(abs_path, ns=(mtime_ns, mtime_ns))
+    except OSError as e:
+        logging.warning(f"Could not set the modification time of {abs_path}: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+
+def download_to(file_uuid, abs_path, size):
+    """Download a file to a temporary name next to abs_path, renamed to abs_path once complete.
+
+    Returns (number of retries, elapsed seconds), the number of retries is None if the download failed.
+    """
+    temp_path = restore_temp_path(abs_path)
+    file_start = time.time()
+    out, num_retries = transport.download_file(file_uuid, temp_path)
+    elapsed = time.time() - file_start
+    if out is None:
+        return None, elapsed
+    try:
+        downloaded_size = os.path.getsize(temp_path)
+        if downloaded_size != size:
+            logging.error(f"Downloaded {format_size(downloaded_size)} instead of {format_size(size)} for {abs_path}", extra={'suppress_console': ENABLE_SUPPRESS})
+            os.remove(temp_path)
+            return None, elapsed
+        os.replace(temp_path, abs_path)
+    except OSError as e:
+        logging.error(f"Could not store the download of {abs_path}: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+        return None, elapsed
+    with restore_stats_lock:
+        restore_stats["downloaded_size"] += size
+        restore_stats["download_seconds"] += elapsed
+        if num_retries > 0:
+            restore_stats["retried"] += 1
+            restore_stats["retries"] += num_retries
+    return num_retries, elapsed
+
+def restore_failed(rel_path, num_files=1):
+    logging.error(f"download-file failed, skipping {rel_path}")
+    with restore_stats_lock:
+        restore_stats["failed"] += num_files
+
+def restore_file(rel_path, abs_path, file_uuid, size, snapshot_file):
+    """Download a single file. Runs in a download worker thread."""
+    with restore_stats_lock:
+        print_restore_progress(rel_path, size)
+    num_retries, elapsed = download_to(file_uuid, abs_path, size)
+    if num_retries is None:
+        restore_failed(rel_path)
+        return
+    set_restored_mtime(abs_path, size, snapshot_file)
+    mbps = (size / 1024 / 1024) / elapsed if elapsed > 0 else 0
+    logging.info(f"Downloaded file '{rel_path}' ({format_size(size)}) in {elapsed:.2f}s ({mbps:.2f} MB/s)")
+    with restore_stats_lock:
+        restore_stats["downloaded"] += 1
+
+def restore_bundle(rel_dir, abs_dir, folder_uuid, bundle_uuid, bundle, size, local_files_by_name, snapshot_files, members):
+    """Download a bundle and extract the members that don't exist locally with the same size. Runs in a download worker thread."""
+    rel_path = normalize_rel_path(rel_dir, bundle)
+    with restore_stats_lock:
+        print_restore_progress(f"{rel_path} [bundle]", size)
+    temp_dir = tempfile.mkdtemp(prefix=RESTORE_TEMP_PREFIX, dir=abs_dir)
+    try:
+        bundle_path = os.path.join(temp_dir, bundle)
+        num_retries, elapsed = download_to(bundle_uuid, bundle_path, size)
+        if num_retries is None:
+            restore_failed(rel_path, len(members) or 1)
+            return
+        num_extracted = num_skipped = extracted_size = skipped_size = 0
+        restored_members = [] # (name, size, mtime_ns, offset) for the manifest
+        with tarfile.open(bundle_path) as tar:
+            for member in tar:
+                if not member.isfile() or os.path.basename(member.name) != member.name or member.name in ("", ".", ".."):
+                    logging.warning(f"Skipping unexpected member '{member.name}' of bundle {rel_path}", extra={'suppress_console': ENABLE_SUPPRESS})
+                    continue
+                name = canonical_name(member.name)
+                recorded = members.get(name)
+                mtime_ns = recorded[1] if recorded and recorded[0] == member.size else round(member.mtime * 1e9)
+                local_name, local_size = local_files_by_name.get(name, (name, None))
+                if local_size == member.size:
+                    restored_members.append((local_name, member.size, mtime_ns, member.offset_data))
+                    num_skipped += 1
+                    skipped_size += member.size
+                    continue
+                abs_path = os.path.join(abs_dir, local_name)
+                with tar.extractfile(member) as src, open(restore_temp_path(abs_path), "wb") as dst:
+                    shutil.copyfileobj(src, dst, HASH_READ_BUFFER_BYTES)
+                os.replace(restore_temp_path(abs_path), abs_path)
+                set_restored_mtime(abs_path, member.size, snapshot_files.get(name), mtime_ns)
+                restored_members.append((local_name, member.size, os.stat(abs_path).st_mtime_ns, member.offset_data))
+                num_extracted += 1
+                extracted_size += member.size
+        # Record the members like the upload of the bundle did, so the next backup keeps the bundle.
+        manifest.store_bundle(folder_uuid, bundle, restored_members)
+    except (OSError, tarfile.TarError) as e:
+        logging.error(f"Could not extract bundle {rel_path}: {e}")
+        with restore_stats_lock:
+            restore_stats["failed"] += len(members) or 1
+        return
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    logging.info(f"Downloaded bundle '{rel_path}' ({format_size(size)}) in {elapsed:.2f}s, extracted {num_extracted} files ({format_size(extracted_size)}), {num_skipped} already existed")
+    with restore_stats_lock:
+        restore_stats["bundles"] += 1
+        restore_stats["downloaded"] += num_extracted
+        restore_stats["skipped"] += num_skipped
+        restore_stats["skipped_size"] += skipped_size
+
+class SplitRestore:
+    """A file uploaded with --split-size whose parts are downloaded in parallel, the last part to finish joins them."""
+    def __init__(self, rel_path, abs_path, parts_uuid, parts_dir, parts, part_hashes, snapshot_file, mtime_ns, num_missing):
+        self.rel_path = rel_path
+        self.abs_path = abs_path
+        self.parts_uuid = parts_uuid
+        self.parts_dir = parts_dir
+        self.parts = parts # [(part name, uuid, size)] in order
+        self.part_hashes = part_hashes # Part name -> SHA-256 recorded in the manifest
+        self.snapshot_file = snapshot_file
+        self.mtime_ns = mtime_ns
+        self.lock = threading.Lock()
+        self.num_missing = num_missing
+        self.failed = False
+
+def restore_part(split, part, part_uuid, part_size):
+    """Download one part of a split file into its parts folder. Runs in a download worker thread."""
+    with restore_stats_lock:
+        print_restore_progress(f"{split.rel_path} [{part}]", part_size)
+    num_retries, _ = download_to(part_uuid, os.path.join(split.parts_dir, part), part_size)
+    with split.lock:
+        split.failed |= num_retries is None
+        split.num_missing -= 1
+        last = split.num_missing == 0
+    if last:
+        finish_split_restore(split)
+
+def finish_split_restore(split):
+    """Join the downloaded parts of a split file. The parts folder is kept if a part is missing, so the next run only downloads that one."""
+    if split.failed:
+        restore_failed(split.rel_path)
+        return
+    size = sum(part_size for _, _, part_size in split.parts)
+    temp_path = restore_temp_path(split.abs_path)
+    bad_part = None
+    part_hashes = []
+    try:
+        with open(temp_path, "wb") as dst:
+            for part, _, _ in split.parts:
+                part_hash = hashlib.sha256()
+                with open(os.path.join(split.parts_dir, part), "rb") as src:
+                    while block := src.read(HASH_READ_BUFFER_BYTES):
+                        part_hash.update(block)
+                        dst.write(block)
+                part_hashes.append(part_hash.hexdigest())
+                if part in split.part_hashes and part_hashes[-1] != split.part_hashes[part]:
+                    bad_part = part
+                    break
+        if bad_part is None:
+            os.replace(temp_path, split.abs_path)
+        else:
+            os.remove(temp_path)
+            os.remove(os.path.join(split.parts_dir, bad_part))
+    except OSError as e:
+        logging.error(f"Could not join the parts of {split.rel_path}: {e}")
+        with restore_stats_lock:
+            restore_stats["failed"] += 1
+        return
+    if bad_part is not None:
+        logging.error(f"Part {bad_part} of {split.rel_path} does not match its hash in the manifest, it is downloaded again by the next run")
+        with restore_stats_lock:
+            restore_stats["failed"] += 1
+        return
+    shutil.rmtree(split.parts_dir, ignore_errors=True)
+    set_restored_mtime(split.abs_path, size, split.snapshot_file, split.mtime_ns)
+    # Record the parts like their upload did, so the next backup doesn't upload them again.
+    offset = 0
+    for (part, _, part_size), part_hash in zip(split.parts, part_hashes):
+        manifest.set_split_part(split.parts_uuid, int(part[:-len(".part")]), offset, part_size, part_hash)
+        offset += part_size
+    manifest.store_split_file(split.parts_uuid, size, os.stat(split.abs_path).st_mtime_ns, split.parts[0][2])
+    logging.info(f"Joined {len(split.parts)} parts of '{split.rel_path}' ({format_size(size)})")
+    with restore_stats_lock:
+        restore_stats["downloaded"] += 1
+        restore_stats["joined"] += 1
+
+def plan_restore_folder(rel_dir, folder_uuid, items, downloads):
+    """Create a local folder and add the downloads of its files to downloads (function, args, bytes to download).
+
+    Returns the (rel_path, uuid) of its subfolders and the (name, parts uuid, context) of its split files.
+    """
+    abs_dir = SRC_DIR if rel_dir == "." else os.path.join(SRC_DIR, rel_dir)
+    try:
+        if not os.path.isdir(abs_dir):
+            os.makedirs(abs_dir)
+            restore_stats["folders"] += 1
+        _, local_subdirs, local_entries = read_local_dir(abs_dir)
+        # Remove the incomplete downloads of an interrupted run, except the parts of the split files.
+        keep = {RESTORE_TEMP_PREFIX + name[len(PARTS_FOLDER_PREFIX):] + ".parts" for name in items if name.startswith(PARTS_FOLDER_PREFIX)}
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                if entry.name.startswith(RESTORE_TEMP_PREFIX) and entry.name not in keep:
+                    if entry.is_dir(follow_symlinks=False):
+                        shutil.rmtree(entry.path)
+                    else:
+                        os.remove(entry.path)
+    except OSError as e:
+        logging.error(f"Could not create local folder '{abs_dir}', skipping it: {e}")
+        restore_stats["failed"] += sum(1 for metadata in items.values() if metadata.get("type") != "folder")
+        return [], []
+
+    # Existing local names are matched by their canonical form, like in the backup.
+    local_files_by_name = {canonical_name(name): (name, size) for name, (size, _, _) in local_entries.items()}
+    local_dirs_by_name = {canonical_name(name): name for name in local_subdirs}
+    snapshot = local_snapshot.load_dir(rel_dir)
+    snapshot_files = {canonical_name(name): (size, mtime_ns) for name, (size, mtime_ns, _) in snapshot[4].items()} if snapshot else {}
+    bundles = manifest.load_bundles(folder_uuid) if any(is_bundle_name(name) for name in items) else {}
+
+    subfolders = []
+    split_files = []
+    for name, metadata in sorted(items.items()):
+        if metadata.get("type") == "folder":
+            if name.startswith(PARTS_FOLDER_PREFIX):
+                split_files.append((name[len(PARTS_FOLDER_PREFIX):], metadata["uuid"], (rel_dir, abs_dir, local_files_by_name, snapshot_files)))
+            else:
+                subfolders.append((normalize_rel_path(rel_dir, local_dirs_by_name.get(name, name)), metadata["uuid"]))
+            continue
+        rel_path = normalize_rel_path(rel_dir, name)
+        size = int(metadata.get("size") or 0)
+        if is_ghost(metadata):
+            logging.error(f"'{rel_path}' is listed remotely but not stored, it can't be restored")
+            restore_stats["failed"] += 1
+            continue
+        if is_bundle_name(name):
+            members = bundles.get(name, {})
+            if members and all(local_files_by_name.get(member, (None, None))[1] == member_size for member, (member_size, _, _) in members.items()):
+                restore_stats["skipped"] += len(members)
+                restore_stats["skipped_size"] += sum(member_size for member_size, _, _ in members.values())
+                continue
+            downloads.append((restore_bundle, (rel_dir, abs_dir, folder_uuid, metadata["uuid"], name, size, local_files_by_name, snapshot_files, members), size))
+            continue
+        local_name, local_size = local_files_by_name.get(name, (name, None))
+        if local_size == size:
+            restore_stats["skipped"] += 1
+            restore_stats["skipped_size"] += size
+            continue
+        downloads.append((restore_file, (rel_path, os.path.join(abs_dir, local_name), metadata["uuid"], size, snapshot_files.get(name)), size))
+    return subfolders, split_files
+
+def plan_split_restore(name, parts_uuid, context, part_items, downloads):
+    """Add the downloads of the missing parts of a split file to downloads."""
+    rel_dir, abs_dir, local_files_by_name, snapshot_files = context
+    rel_path = normalize_rel_path(rel_dir, name)
+    parts = sorted((part, item["uuid"], int(item.get("size") or 0)) for part, item in part_items.items() if item.get("type") != "folder" and part.endswith(".part") and part[:-len(".part")].isdigit())
+    size = sum(part_size for _, _, part_size in parts)
+    local_name, local_size = local_files_by_name.get(name, (name, None))
+    if local_size == size:
+        restore_stats["skipped"] += 1
+        restore_stats["skipped_size"] += size
+        return
+    if not parts or any(is_ghost(part_items[part]) for part, _, _ in parts):
+        logging.error(f"The parts of '{rel_path}' are missing or not stored remotely, it can't be restored")
+        restore_stats["failed"] += 1
+        return
+    split_file = manifest.load_split_file(parts_uuid)
+    if split_file is not None and split_file[0] != size:
+        logging.warning(f"The parts of '{rel_path}' add up to {format_size(size)} instead of the {format_size(split_file[0])} recorded in the manifest, the last upload was probably interrupted")
+    # Without the manifest (e.g. restoring on a new machine), the parts are joined without checking their hashes.
+    recorded_parts = manifest.load_split_parts(parts_uuid)
+    part_hashes = {}
+    for part, _, part_size in parts:
+        recorded = recorded_parts.get(int(part[:-len(".part")]))
+        if recorded is not None and recorded[2] and recorded[1] == part_size:
+            part_hashes[part] = recorded[2]
+    parts_dir = os.path.join(abs_dir, RESTORE_TEMP_PREFIX + name + ".parts")
+    try:
+        os.makedirs(parts_dir, exist_ok=True)
+    except OSError as e:
+        logging.error(f"Could not create the parts folder of '{rel_path}': {e}")
+        restore_stats["failed"] += 1
+        return
+    # Parts that were completely downloaded by an interrupted run are reused.
+    missing = [(part, part_uuid, part_size) for part, part_uuid, part_size in parts
+               if not os.path.isfile(os.path.join(parts_dir, part)) or os.path.getsize(os.path.join(parts_dir, part)) != part_size]
+    restore_stats["reused_parts"] += len(parts) - len(missing)
+    split = SplitRestore(rel_path, os.path.join(abs_dir, local_name), parts_uuid, parts_dir, parts, part_hashes, snapshot_files.get(name),
+                         split_file[1] if split_file is not None and split_file[0] == size else None, len(missing))
+    for part, part_uuid, part_size in missing:
+        downloads.append((restore_part, (split, part, part_uuid, part_size), part_size))
+    if not missing:
+        downloads.append((finish_split_restore, (split,), 0))
+
+def plan_restore():
+    """List the remote tree level by level and create the local folders, returns the downloads (function, args, bytes to download)."""
+    downloads = []
+    level = [(".", DEST_ROOT_ID)]
+    with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="list") as list_executor:
+        while level:
+            next_level = []
+            split_files = []
+            # map() preserves the order, the folders are processed in sorted order.
+            for (rel_dir, folder_uuid), items in zip(level, list_executor.map(get_cached_dir_listing, [folder_uuid for _, folder_uuid in level])):
+                subfolders, folder_split_files = plan_restore_folder(rel_dir, folder_uuid, items, downloads)
+                next_level.extend(subfolders)
+                split_files.extend(folder_split_files)
+            for (name, parts_uuid, context), part_items in zip(split_files, list_executor.map(get_cached_dir_listing, [parts_uuid for _, parts_uuid, _ in split_files])):
+                plan_split_restore(name, parts_uuid, context, part_items, downloads)
+            level = sorted(next_level)
+    return downloads
+
+if args.restore:
+    logging.info(f"\nListing the backup of '{src_name}' to restore it into '{SRC_DIR}'...")
+    restore_list_start_time = time.time()
+    restore_downloads = plan_restore()
+    command_metrics.record_phase("remote_check", restore_list_start_time)
+    restore_bytes_to_download = sum(size for _, _, size in restore_downloads)
+    logging.info(f"Listed {len(remote_dir_cache)} remote folders in {format_hhmmss(time.time() - restore_list_start_time)}, created {restore_stats['folders']} local folders. "
+                 f"{restore_stats['skipped']} files ({format_size(restore_stats['skipped_size'])}) already exist locally.")
+    logging.info(f"\nDownloading {len(restore_downloads)} files/bundles/parts, total size: {format_size(restore_bytes_to_download)}, {args.jobs} parallel download(s).")
+
+    # From here on, don't print anything except the progress bar to stdout/stderr,
+    # logging only goes to file.
+    SUPPRESS_STDOUT_STDERR = True
+
+    restore_start_time = time.time()
+    pending_downloads = set()
+    with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="download") as download_executor:
+        for function, function_args, _ in restore_downloads:
+            # Only keep a bounded number of downloads queued.
+            if len(pending_downloads) >= args.jobs * 2:
+                done, pending_downloads = wait(pending_downloads, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()  # Re-raise exceptions from the workers.
+            pending_downloads.add(download_executor.submit(function, *function_args))
+        for future in pending_downloads:
+            future.result()
+    command_metrics.record_phase("download", restore_start_time)
+
+    SUPPRESS_STDOUT_STDERR = False
+
+    download_bytes_per_second = {
+        "per_download": round(restore_stats["downloaded_size"] / restore_stats["download_seconds"]) if restore_stats["download_seconds"] > 0 else 0,
+        "overall": round(restore_stats["downloaded_size"] / phase_timings["download"]) if phase_timings["download"] > 0 else 0,
+    }
+    logging.info(f"\nDownload finished. Elapsed time: {format_hhmmss(phase_timings['download'])}")
+    logging.info(f"Folders created: {restore_stats['folders']}")
+    logging.info(f"Files restored:  {restore_stats['downloaded']} ({format_size(restore_stats['downloaded_size'])} downloaded)")
+    logging.info(f"Files skipped:   {restore_stats['skipped']} ({format_size(restore_stats['skipped_size'])})")
+    if restore_stats["bundles"] or restore_stats["joined"]:
+        logging.info(f"Bundles/parts:   {restore_stats['bundles']} bundles extracted, {restore_stats['joined']} split files joined, {restore_stats['reused_parts']} parts reused from an interrupted run")
+    logging.info(f"Files retried:   {restore_stats['retried']} ({restore_stats['retries']} retries total)")
+    if circuit_breaker.num_trips:
+        logging.info(f"Paused:          {circuit_breaker.num_trips} times, the remote service was not responding")
+    logging.info(f"Files failed:    {restore_stats['failed']}")
+    logging.info(f"Throughput:      {format_size(download_bytes_per_second['overall'])}/s overall, {format_size(download_bytes_per_second['per_download'])}/s per download")
+
+    command_stats = command_metrics.summary()
+    for command, stats in command_stats.items():
+        logging.info(f"Command summary: {command} | {stats['count']} calls | {stats['failures']} failed | {stats['retries']} retries | {stats['seconds_total']:.2f}s total | mean {stats['seconds_mean']:.3f}s | p90 <= {stats['seconds_p90']}s | max {stats['seconds_max']:.3f}s", extra={'suppress_console': ENABLE_SUPPRESS})
+
+    if restore_stats["failed"]:
+        logging.error(f"\nRestore finished, but {restore_stats['failed']} files could not be restored (see the log), run it again to retry them. Total time: {format_hhmmss(time.time() - start_time)}")
+    else:
+        logging.info(f"\nRestore successful. Total time: {format_hhmmss(time.time() - start_time)}")
+    command_metrics.record_phase("total", start_time)
+
+    if args.stats_json:
+        stats = {
+            "phases": {phase: round(seconds, 3) for phase, seconds in phase_timings.items()},
+            "peak_rss_bytes": peak_rss_bytes(),
+            "remote_folders": len(remote_dir_cache),
+            "restore": {key: round(value, 3) if isinstance(value, float) else value for key, value in restore_stats.items()},
+            "breaker_trips": circuit_breaker.num_trips,
+            "download_bytes_per_second": download_bytes_per_second,
+            "commands": command_stats,
+        }
+        with open(args.stats_json, "w", encoding="utf-8") as f:
+            json.dump(stats, f, indent=2)
+
+    if args.trace_json:
+        command_metrics.write_trace(args.trace_json)
+
+    graceful_shutdown()
+    sys.exit(1 if restore_stats["failed"] else 0)
+
+################################################################################
+# Local file index
+# Millions of files don't fit in memory as tuples/dicts of path strings, so the
+# local files are numbered in walk order and stored as columns: folder id, size
+# (array-backed) and name. Folder paths are stored once per folder, and the state
+# of each file (skipped, uploaded, failed, ...) is kept in bitsets.
+################################################################################
+
+class Bitset:
+    """Set of file ids, one bit per file."""
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, i):
+        byte, mask = i >> 3, 1 << (i & 7)
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(byte + 1 - len(self.bits)))
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def discard(self, i):
+        byte, mask = i >> 3, 1 << (i & 7)
+        if byte < len(self.bits) and self.bits[byte] & mask:
+            self.bits[byte] ^= mask
+            self.count -= 1
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (i & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for byte_index, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield (byte_index << 3) | bit
+
+class LocalFileIndex:
+    """The local files to back up. The files of a folder have consecutive ids."""
+    def __init__(self):
+        self.folder_rel_paths = [] # Folder id -> normalized relative path
+        self.folder_abs_paths = [] # Folder id -> path on disk
+        self.folder_ids = {} # Normalized relative path -> folder id
+        self.folder_first_file = array("q") # Folder id -> id of its first file
+        self.file_folders = array("I") # File id -> folder id
+        self.file_sizes = array("q")
+        self.file_mtimes = array("q") # Modification times in ns
+        self.file_names = [] # Names on disk
+        self.normalized_names = {} # File id -> normalized name, only where it differs from the name on disk
+        self.remote_uuids = [] # File id -> UUID of the existing remote file, or None
+        self.added = Bitset() # New since the last run (all files in the first run)
+        self.modified = Bitset() # Size or modification time changed since the last run
+        self.existing = Bitset() # Exists remotely and is skipped
+        self.submitted = Bitset() # Handed to the upload workers
+        self.uploaded = Bitset()
+        self.failed = Bitset()
+        self.packed = Bitset() # Stored in a tar bundle (--pack-small-files)
+        self.split = Bitset() # Stored in parts (--split-size)
+
+    def add_folder(self, rel_dir, abs_dir):
+        folder_id = len(self.folder_rel_paths)
+        self.folder_rel_paths.append(rel_dir)
+        self.folder_abs_paths.append(abs_dir)
+        self.folder_ids[rel_dir] = folder_id
+        self.folder_first_file.append(len(self.file_sizes))
+        return folder_id
+
+    def add_file(self, folder_id, name, normalized_name, size, mtime_ns):
+        """Add a file of the folder that was added last."""
+        file_id = len(self.file_sizes)
+        self.file_folders.append(folder_id)
+        self.file_sizes.append(size)
+        self.file_mtimes.append(mtime_ns)
+        self.file_names.append(name)
+        if normalized_name != name:
+            self.normalized_names[file_id] = normalized_name
+        self.remote_uuids.append(None)
+        return file_id
+
+    def __len__(self):
+        return len(self.file_sizes)
+
+    def name(self, file_id):
+        return self.normalized_names.get(file_id, self.file_names[file_id])
+
+    def folder(self, file_id):
+        return self.folder_rel_paths[self.file_folders[file_id]]
+
+    def rel_path(self, file_id):
+        return normalize_rel_path(self.folder(file_id), self.name(file_id))
+
+    def abs_path(self, file_id):
+        return os.path.join(self.folder_abs_paths[self.file_folders[file_id]], self.file_names[file_id])
+
+    def size(self, file_id):
+        return self.file_sizes[file_id]
+
+    def folder_files(self, rel_dir):
+        """Ids of the files in a folder."""
+        folder_id = self.folder_ids.get(rel_dir)
+        if folder_id is None:
+            return range(0)
+        end = self.folder_first_file[folder_id + 1] if folder_id + 1 < len(self.folder_first_file) else len(self.file_sizes)
+        return range(self.folder_first_file[folder_id], end)
+
+    def folder_names(self, rel_dir):
+        """Maps the normalized names of the files in a folder to their ids."""
+        return {self.name(file_id): file_id for file_id in self.folder_files(rel_dir)}
+
+    def entries(self, file_ids=None):
+        """(file id, abs path, rel path, size) of all (or the given) files, in walk order."""
+        for file_id in range(len(self)) if file_ids is None else file_ids:
+            yield file_id, self.abs_path(file_id), self.rel_path(file_id), self.file_sizes[file_id]
+
+    def set_existing(self, file_id, remote_uuid):
+        self.existing.add(file_id)
+        self.remote_uuids[file_id] = remote_uuid
+
+    def clear_existing(self, file_id):
+        self.existing.discard(file_id)
+        self.remote_uuids[file_id] = None
+
 ################################################################################
 # Create list of local files/folders, compute sizes
 ################################################################################
 
-all_local_files = []
+local_files = LocalFileIndex()
 all_local_folders = []
 folder_subdir_map = defaultdict(list) # Maps a parent path -> list of subfolder names
-file_sizes = {}
 folder_sizes = {}
 folder_num_files = {}
+folder_file_digests = {} # Maps a folder path -> digest of its (file name, size) list
 total_local_size = 0
 
-for cur_dir, dirs, files in os.walk(SRC_DIR):
-    cur_dir = normalize_encoding(cur_dir)
-    rel_cur_dir = os.path.relpath(cur_dir, SRC_DIR)
+# Files that were removed since the last snapshot (added/modified files are marked in local_files).
+removed_local_files = set()
+local_dir_entries = {} # Directories that were read or whose files changed in this run, stored in the snapshot at the end
+num_snapshot_dirs = 0
+visited_dirs = set()
+
+local_walk_start_time = time.time()
+
+# With --walk-jobs, the folders on top of the stack (the next ones to be processed) are read ahead
+# by a thread pool. They are still processed in stack order, so the result does not change.
+walk_executor = ThreadPoolExecutor(max_workers=args.walk_jobs, thread_name_prefix="walk") if args.walk_jobs > 1 else None
+walk_prefetch = args.walk_jobs * 4
+
+# Depth-first, top-down, like os.walk().
+# Stack entries: [abs_dir, rel_dir, snapshot entry, future of scan_local_dir() or None].
+walk_stack = [[SRC_DIR, ".", None, None]]
+while walk_stack:
+    if walk_executor is not None:
+        for entry in walk_stack[-walk_prefetch:]:
+            if entry[3] is None:
+                entry[2] = local_snapshot.load_dir(entry[1])
+                entry[3] = walk_executor.submit(scan_local_dir, entry[0], entry[2])
+    abs_dir, rel_cur_dir, previous, scan_future = walk_stack.pop()
+    visited_dirs.add(rel_cur_dir)
+
+    try:
+        if scan_future is None:
+            previous = local_snapshot.load_dir(rel_cur_dir)
+            dir_stat, listing, reused = scan_local_dir(abs_dir, previous)
+        else:
+            dir_stat, listing, reused = scan_future.result()
+    except OSError as e:
+        logging.error(f"Could not read folder {abs_dir}: {e}")
+        continue
+
+    ignored, subdirs, files = listing
+    previous_files = previous[4] if previous is not None else {}
+    num_snapshot_dirs += reused
+    # Folders taken from the snapshot are only stored again if one of their files changed.
+    if not reused or files != previous_files:
+        local_dir_entries[rel_cur_dir] = (dir_stat.st_mtime_ns, dir_stat.st_ino, ignored, subdirs, files)
+    for name in previous_files.keys() - files.keys():
+        removed_local_files.add(normalize_rel_path(rel_cur_dir, canonical_name(name)))
 
     # Check for .internxtignore file and skip traversal
-    if IGNOREFILE_NAME in files:
+    if ignored:
         logging.info(f"Folder contains {IGNOREFILE_NAME}, skipped: {rel_cur_dir}")
-        dirs.clear()  # prevents walking into subdirectories
         continue
 
     all_local_folders.append(rel_cur_dir)
@@ -449,86 +2334,686 @@ for cur_dir, dirs, files in os.walk(SRC_DIR):
     folder_num_files[rel_cur_dir] = len(files)
 
     # Add current dir as subfolder of its parent
-    # If instead we added 'dirs' as subfolders of cur_dir we'd have to check .internxtignore files again
-    if cur_dir != SRC_DIR:
+    # If instead we added 'subdirs' as subfolders of cur_dir we'd have to check .internxtignore files again
+    if rel_cur_dir != ".":
         parent = os.path.dirname(rel_cur_dir)
         parent = '.' if parent == '' else parent
         child = os.path.basename(rel_cur_dir)
         folder_subdir_map[parent].append(child)
 
-    folder_size = 0
-    for file_name in files:
-        file_name = normalize_encoding(file_name)
-        abs_path = os.path.join(cur_dir, file_name)
-        rel_path = normalize_rel_path(rel_cur_dir, file_name)
+    subdir_names = {}
+    for subdir in subdirs:
+        add_canonical_name(subdir_names, subdir, subdir, "local", rel_cur_dir)
+    for subdir_name, subdir in reversed(subdir_names.items()):
+        walk_stack.append([os.path.join(abs_dir, subdir), normalize_rel_path(rel_cur_dir, subdir_name), None, None])
 
-        try:
-            file_size = os.path.getsize(abs_path)
-        except Exception:
-            logging.error(f"Could not determine size of file {abs_path}")
-            file_size = 0
+    folder_id = local_files.add_folder(rel_cur_dir, abs_dir)
+    folder_size = 0
+    folder_digest = hashlib.sha1()
+    file_names = {}
+    for raw_name, (file_size, mtime_ns, _) in files.items():
+        file_name = add_canonical_name(file_names, raw_name, raw_name, "local", rel_cur_dir)
+        if file_name is None:
+            continue
 
         # Skip files that exceed the upload limit
-        if file_size > FILE_SIZE_UPLOAD_LIMIT_BYTES:
-            logging.info(f"File exceeds upload limit size ({format_size(FILE_SIZE_UPLOAD_LIMIT_BYTES)}, found {format_size(file_size)}), skipped: {rel_path}")
+        if file_size > FILE_SIZE_UPLOAD_LIMIT_BYTES and args.split_size is None:
+            logging.info(f"File exceeds upload limit size ({format_size(FILE_SIZE_UPLOAD_LIMIT_BYTES)}, found {format_size(file_size)}), skipped: {normalize_rel_path(rel_cur_dir, file_name)}")
             continue
 
-        all_local_files.append((abs_path, rel_path, file_size))
+        file_id = local_files.add_file(folder_id, raw_name, file_name, file_size, mtime_ns)
+        old = previous_files.get(raw_name)
+        if old is None:
+            local_files.added.add(file_id)
+        elif old[0] != file_size or old[1] != mtime_ns:
+            local_files.modified.add(file_id)
 
-        file_sizes[rel_path] = file_size
         folder_size += file_size
+        folder_digest.update(f"{file_name}\0{file_size}\0".encode("utf-8", "surrogateescape"))
 
     folder_sizes[rel_cur_dir] = folder_size
+    folder_file_digests[rel_cur_dir] = folder_digest.hexdigest()
     total_local_size += folder_size
 
+if walk_executor is not None:
+    walk_executor.shutdown(wait=True)
+
+# Files of directories that no longer exist (or are now inside an ignored directory) were removed.
+removed_local_dirs = local_snapshot.all_dirs() - visited_dirs
+removed_local_files.update(local_snapshot.removed_files(removed_local_dirs))
+command_metrics.record_phase("local_walk", local_walk_start_time)
+
+logging.info(f"Read {len(visited_dirs) - num_snapshot_dirs} local folders, reused the snapshot for {num_snapshot_dirs} unchanged folders.")
+logging.info(f"Local changes since the last run: {len(local_files.added)} added, {len(local_files.modified)} modified, {len(removed_local_files)} removed files.")
+
 # Log total size and folder sizes
 logging.info(f"Total size of local folder(s): {format_size(total_local_size)}")
 logging.info(f"Folder sizes:", extra={'suppress_console': ENABLE_SUPPRESS})
 for folder, folder_size in folder_sizes.items():
     logging.info(f"  {folder}: {format_size(folder_size)}", extra={'suppress_console': ENABLE_SUPPRESS})
 
+def local_folder_signature(rel_dir):
+    """Signature of the local folder contents (file names + sizes, subfolder names), used to decide whether the manifest can be trusted."""
+    subdirs = "\0".join(sorted(folder_subdir_map.get(rel_dir, [])))
+    return hashlib.sha1(f"{folder_file_digests[rel_dir]}\0{subdirs}".encode("utf-8", "surrogateescape")).hexdigest()
+
 ################################################################################
-# Progress bar
+# Upload workers
+# Files are uploaded by a pool of worker threads. They are handed to the workers
+# after the remote check, or with --pipeline as soon as their folder is checked.
 ################################################################################
 
-def print_progress_bar(uploaded, total, file, file_size, elapsed_total, num_retried_files, num_failed_files, useBytes=True, bar_len=40):
-    percent        = uploaded / total if total else 0
-    filled_len     = int(round(bar_len * percent))
-    bar            = '=' * filled_len + '-' * (bar_len - filled_len)
-    speed          = uploaded / elapsed_total if elapsed_total > 0 else 0
-    remaining_time = ( total - uploaded ) / speed if speed > 0 else 0
+uploaded_size = 0
 
-    # Create the output string
-    barStr           = f"\r[{bar}] {percent * 100:5.1f}% "
-    progressStr      = f"| {format_size(uploaded)}/{format_size(total)} " if useBytes else f"| {int(uploaded)}/{int(total)} files "
-    numRetriedStr    = f"| retried: {num_retried_files} " if useBytes else f""
-    numFailedStr     = f"| failed: {num_failed_files} " if useBytes else f""
-    speedStr         = f"| avg: {format_size(speed)}/s " if useBytes else f"| avg: {speed:.1f} files/s "
-    elapsedTimeStr   = f"| elapsed: {format_hhmmss(elapsed_total)} "
-    remainingTimeStr = f"| remaining: {format_hhmmss(remaining_time)} "
-    fileStr          = f"| {file} "
-    fileSizeStr      = f"| file size: {format_size(file_size)}" if useBytes else f""
+# Retry stats
+num_retried_files = 0
+num_total_retries = 0
+num_failed_files = 0
 
-    output = (
-        barStr +
-        progressStr +
-        numRetriedStr +
-        numFailedStr +
-        speedStr +
-        elapsedTimeStr +
-        remainingTimeStr +
-        fileStr +
-        fileSizeStr
-    )
+# For per-folder stats
+folder_upload_stats = {}
 
-    # Print the output
-    sys.stdout.write(output)
-    sys.stdout.flush()
+num_bytes_to_upload = None # Known after the remote check
+upload_start_time = None
 
-    # Clear the line if the next file name is shorter
-    # This is done by moving the cursor back to the start of the line
-    # and writing spaces to overwrite the previous output
-    sys.stdout.write('\r' + ' ' * (len(output) - 1) + '\r')
+
+# Protects the upload stats above and the progress bar output, which are shared by all upload workers.
+upload_stats_lock = threading.Lock()
+
+def print_upload_progress(label, file_size):
+    """Print the progress bar for an upload that is starting, the caller holds upload_stats_lock."""
+    if "first_upload" not in phase_timings:
+        phase_timings["first_upload"] = time.time() - start_time
+    elapsed_total = time.time() - upload_start_time
+    # With --pipeline the totals are estimated until the remote check is finished.
+    bytes_to_upload = num_bytes_to_upload if num_bytes_to_upload is not None else total_local_size - existing_size
+    num_remaining_files = len(local_files) - len(local_files.existing) - len(local_files.uploaded) - len(local_files.failed)
+    parallelism = max(1, min(upload_concurrency.limit, num_remaining_files))
+    remaining_time = upload_time_model.remaining_seconds(num_remaining_files, bytes_to_upload - uploaded_size, parallelism)
+    print_progress_bar(uploaded_size, bytes_to_upload, label, file_size, elapsed_total, num_retried_files, num_failed_files, remaining_time=remaining_time)
+
+def upload_with_concurrency_limit(abs_path, dest_folder_uuid, num_bytes):
+    """Upload a file (one attempt) within the limit of concurrent uploads, returns (result, elapsed seconds)."""
+    out = None
+    upload_concurrency.acquire()
+    upload_start = time.time()
+    try:
+        out, _ = transport.upload_file(abs_path, dest_folder_uuid, max_attempts=1)
+    finally:
+        elapsed = time.time() - upload_start
+        upload_concurrency.release(num_bytes, elapsed, out is not None)
+    if out is not None:
+        upload_time_model.add(num_bytes, elapsed)
+        command_metrics.record_upload(num_bytes, elapsed)
+    return out, elapsed
+
+def upload_local_file(file_id, dest_folder_rel, dest_folder_uuid, attempt=1):
+    """Upload a single file and update the (shared) upload stats. Runs in an upload worker thread.
+
+    A failed upload is put in the retry queue, so the worker can continue with other files in the meantime.
+    """
+    global uploaded_size, num_retried_files, num_total_retries, num_failed_files
+    abs_path, rel_path, file_size = local_files.abs_path(file_id), local_files.rel_path(file_id), local_files.size(file_id)
+
+    # Print progress bar *before* upload so we see what's currently uploading.
+    with upload_stats_lock:
+        print_upload_progress(rel_path, file_size)
+
+    # Hash before uploading, the hash is recorded for the uploaded file.
+    local_hash = get_file_hash(abs_path) if args.content_hash else None
+
+    # Upload the file.
+    out, elapsed_file = upload_with_concurrency_limit(abs_path, dest_folder_uuid, file_size)
+    num_retries = attempt - 1
+
+    if out is None:
+        if attempt < MAX_NUM_RETRIES:
+            logging.info(f"upload-file failed, retrying {rel_path} later (attempt {attempt})", extra={'suppress_console': ENABLE_SUPPRESS})
+            retry_queue.schedule(attempt, upload_local_file, file_id, dest_folder_rel, dest_folder_uuid)
+            return
+        logging.error(f"upload-file failed, skipping {rel_path}")
+        with upload_stats_lock:
+            num_failed_files += 1
+            local_files.failed.add(file_id)
+        return
+
+    # Invalidate folder cache since we modified it
+    invalidate_cached_dir_listing(dest_folder_uuid)
+    if out.get("file"):
+        manifest.add_item(dest_folder_uuid, os.path.basename(rel_path), out["file"])
+        if local_hash is not None and out["file"].get("uuid"):
+            manifest.set_hash(out["file"]["uuid"], local_hash)
+
+    # Log upload to file only, with time and MB/s
+    mbps = (file_size / 1024 / 1024) / elapsed_file if elapsed_file > 0 else 0
+    logging.info(f"Uploaded file '{rel_path}' ({format_size(file_size)}) to folder UUID '{dest_folder_uuid}' in {elapsed_file:.2f}s ({mbps:.2f} MB/s)")
+
+    with upload_stats_lock:
+        if num_retries > 0:
+            num_retried_files += 1
+            num_total_retries += num_retries
+
+        local_files.uploaded.add(file_id)
+        uploaded_size += file_size
+
+        # Per-folder stats
+        stats = folder_upload_stats.setdefault(dest_folder_rel, {'size': 0, 'time': 0, 'files': 0})
+        stats['size'] += file_size
+        stats['time'] += elapsed_file
+        stats['files'] += 1
+
+class RetryQueue:
+    """Failed uploads waiting for their next attempt, ordered by the time they are due."""
+    def __init__(self):
+        self.heap = []
+        self.lock = threading.Lock()
+        self.counter = itertools.count() # Tie breaker, the functions can't be compared
+
+    def schedule(self, attempt, function, *function_args):
+        """Call function(*function_args, attempt + 1) after the (jittered) backoff delay of the failed attempt."""
+        with self.lock:
+            heapq.heappush(self.heap, (time.monotonic() + retry_delay(attempt), next(self.counter), function, function_args + (attempt + 1,)))
+
+    def pop_due(self):
+        """Remove and return the (function, args) of all retries that are due."""
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= time.monotonic():
+                _, _, function, function_args = heapq.heappop(self.heap)
+                due.append((function, function_args))
+        return due
+
+    def seconds_until_next(self):
+        """Seconds until the next retry is due, or None if no retry is waiting."""
+        with self.lock:
+            return max(0, self.heap[0][0] - time.monotonic()) if self.heap else None
+
+retry_queue = RetryQueue()
+
+# Only keep a bounded number of uploads queued so we don't create one future per file up front.
+max_pending_uploads = args.jobs * 2
+pending_uploads = set()
+upload_executor = None
+
+def start_upload_workers():
+    global upload_executor, upload_start_time
+    upload_start_time = time.time()
+    upload_executor = ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="upload")
+
+def wait_for_uploads(timeout=None):
+    """Wait until at least one pending upload is done (or the timeout has passed)."""
+    global pending_uploads
+    done, pending_uploads = wait(pending_uploads, timeout=timeout, return_when=FIRST_COMPLETED)
+    for future in done:
+        future.result()  # Re-raise exceptions from the workers.
+
+def submit_due_retries():
+    for function, function_args in retry_queue.pop_due():
+        pending_uploads.add(upload_executor.submit(function, *function_args))
+
+def submit_to_upload_workers(function, *function_args):
+    """Run function in an upload worker, waits while too many uploads are pending. Due retries go first."""
+    submit_due_retries()
+    if len(pending_uploads) >= max_pending_uploads:
+        wait_for_uploads()
+    pending_uploads.add(upload_executor.submit(function, *function_args))
+
+def finish_uploads():
+    """Wait for all pending uploads and their retries."""
+    while True:
+        submit_due_retries()
+        next_retry = retry_queue.seconds_until_next()
+        if not pending_uploads:
+            if next_retry is None:
+                return
+            time.sleep(next_retry)
+        else:
+            wait_for_uploads(next_retry)
+
+# --priority-file, for each local folder (by folder id)
+def folder_priority(rel_dir):
+    """Priority of the longest --priority-file folder that contains rel_dir (0 if there is none)."""
+    best_len, best_priority = -1, 0
+    for rule_dir, priority in folder_priority_rules:
+        if rule_dir == ".":
+            rule_len = 0
+        elif rel_dir == rule_dir or rel_dir.startswith(rule_dir + os.sep):
+            rule_len = len(rule_dir)
+        else:
+            continue
+        if rule_len > best_len:
+            best_len, best_priority = rule_len, priority
+    return best_priority
+
+folder_priority_rules = [(canonical_name(rule_dir), priority) for rule_dir, priority in folder_priority_rules]
+local_folder_priorities = [folder_priority(rel_dir) for rel_dir in local_files.folder_rel_paths] if folder_priority_rules else None
+
+def mix_large_and_small(file_ids):
+    """Alternate between the largest and the smallest remaining files, so that both are uploading at the same time.
+
+    The next file is taken from the side with the lower estimated upload time so far, so one large file
+    is balanced by as many small files as can be uploaded in the same time.
+    """
+    by_size = sorted(file_ids, key=local_files.file_sizes.__getitem__)
+    small, large = 0, len(by_size) - 1
+    small_seconds = large_seconds = 0.0
+    while small <= large:
+        seconds_per_file, seconds_per_byte = upload_time_model.coefficients()
+        if large_seconds <= small_seconds:
+            file_id = by_size[large]
+            large -= 1
+            large_seconds += seconds_per_file + seconds_per_byte * local_files.size(file_id)
+        else:
+            file_id = by_size[small]
+            small += 1
+            small_seconds += seconds_per_file + seconds_per_byte * local_files.size(file_id)
+        yield file_id
+
+def schedule_uploads(file_ids):
+    """The given files in the order of --schedule."""
+    if args.schedule == "small-first":
+        return sorted(file_ids, key=local_files.file_sizes.__getitem__)
+    if args.schedule == "large-first":
+        return sorted(file_ids, key=local_files.file_sizes.__getitem__, reverse=True)
+    if args.schedule == "mixed":
+        return mix_large_and_small(file_ids)
+    return file_ids
+
+def upload_order(file_ids):
+    """The given files in upload order: by --priority-file priority (highest first), then by --schedule."""
+    if local_folder_priorities is None:
+        yield from schedule_uploads(file_ids)
+        return
+    by_priority = defaultdict(list)
+    for file_id in file_ids:
+        by_priority[local_folder_priorities[local_files.file_folders[file_id]]].append(file_id)
+    for priority in sorted(by_priority, reverse=True):
+        yield from schedule_uploads(by_priority[priority])
+
+def submit_upload(file_id, dest_folder_rel, dest_folder_uuid):
+    """Hand a file to the upload workers (in parts with --split-size)."""
+    if args.split_size is not None and local_files.size(file_id) > args.split_size:
+        submit_split_upload(file_id, dest_folder_rel, dest_folder_uuid)
+        return
+    local_files.submitted.add(file_id)
+    submit_to_upload_workers(upload_local_file, file_id, dest_folder_rel, dest_folder_uuid)
+
+# With --pipeline, the remote check queues each folder once its listing is reconciled, and the
+# dispatcher thread hands the folder's missing files to the upload workers. The queue is bounded,
+# so the remote check waits when the uploads fall behind.
+pipeline_folders = queue.Queue(maxsize=args.jobs * 4)
+pipeline_errors = []
+
+def dispatch_pipeline_uploads():
+    while True:
+        folder = pipeline_folders.get()
+        if folder is None:
+            return
+        if pipeline_errors:
+            continue  # Keep draining the queue so the remote check doesn't block.
+        rel_dir, folder_uuid = folder
+        try:
+            wait_for_replaced_files(folder_uuid)
+            if args.pack_small_files:
+                for bundle_file_ids in plan_bundles(rel_dir):
+                    submit_bundle(bundle_file_ids, "" if rel_dir == "." else rel_dir, folder_uuid)
+            file_ids = [file_id for file_id in local_files.folder_files(rel_dir) if file_id not in local_files.existing and file_id not in local_files.submitted]
+            for file_id in upload_order(file_ids):
+                submit_upload(file_id, "" if rel_dir == "." else rel_dir, folder_uuid)
+        except BaseException as e:
+            # Includes the SystemExit of a failed CLI command: the remote check would otherwise block on the full queue.
+            pipeline_errors.append(e)
+
+################################################################################
+# Small file bundles
+# With --pack-small-files, the small files of a folder are uploaded in tar bundles
+# (PACK_BUNDLE_PREFIX + hash + ".tar") of up to PACK_BUNDLE_MAX_BYTES. The manifest
+# records the members of each bundle with their size, mtime and data offset, so a
+# bundle stays valid as long as none of its members changed. Changed or removed
+# members only invalidate their own bundle: it is deleted, and its unchanged
+# members are packed again together with the new small files.
+# Bundles are plain tar files and can also be extracted with any tar tool.
+################################################################################
+
+bundle_names = [] # (rel_dir, bundle name) of the uploaded bundles
+num_stale_bundles = 0
+
+def reconcile_bundles(rel_cur_dir, folder_uuid, remote_bundles, local_file_ids):
+    """Mark the members of valid remote bundles as existing, delete outdated or unknown bundles.
+
+    remote_bundles maps the bundle names in the remote folder to (uuid, size). Returns the size of the valid members.
+    """
+    packed_size = 0
+    known_bundles = manifest.load_bundles(folder_uuid)
+    for bundle, (bundle_uuid, bundle_size) in sorted(remote_bundles.items()):
+        members = known_bundles.pop(bundle, None)
+        file_ids = [local_file_ids.get(name) for name in members or ()]
+        valid = bool(members) and all(
+            file_id is not None and file_id not in local_files.existing
+            and local_files.size(file_id) == size and local_files.file_mtimes[file_id] == mtime_ns
+            for file_id, (size, mtime_ns, _) in zip(file_ids, members.values()))
+        if valid:
+            for file_id in file_ids:
+                local_files.set_existing(file_id, bundle_uuid)
+                local_files.packed.add(file_id)
+                packed_size += local_files.size(file_id)
+            logging.info(f"Skipped bundle '{normalize_rel_path(rel_cur_dir, bundle)}' ({len(members)} unchanged files)", extra={'suppress_console': ENABLE_SUPPRESS})
+            continue
+        logging.info(f"Remote bundle '{normalize_rel_path(rel_cur_dir, bundle)}' is outdated, deleting", extra={'suppress_console': ENABLE_SUPPRESS})
+        schedule_deletion(delete_outdated_bundle, rel_cur_dir, folder_uuid, bundle, bundle_uuid, bundle_size)
+    # Bundles that were deleted remotely by other means.
+    for bundle in known_bundles:
+        manifest.remove_bundle(folder_uuid, bundle)
+    return packed_size
+
+def delete_outdated_bundle(rel_cur_dir, folder_uuid, bundle, bundle_uuid, bundle_size):
+    global num_stale_bundles
+    if delete_remote_file(normalize_rel_path(rel_cur_dir, bundle), bundle_uuid, bundle_size):
+        manifest.remove_bundle(folder_uuid, bundle)
+        with deletion_lock:
+            num_stale_bundles += 1
+
+def plan_bundles(rel_dir):
+    """Group the small files of a folder that still have to be uploaded into bundles (lists of file ids).
+
+    A single remaining small file is uploaded as it is.
+    """
+    small_files = sorted((local_files.name(file_id), file_id) for file_id in local_files.folder_files(rel_dir)
+                         if local_files.size(file_id) < args.pack_threshold and file_id not in local_files.existing and file_id not in local_files.submitted)
+    bundles = [[]]
+    bundle_size = 0
+    for _, file_id in small_files:
+        if bundles[-1] and bundle_size + local_files.size(file_id) > PACK_BUNDLE_MAX_BYTES:
+            bundles.append([])
+            bundle_size = 0
+        bundles[-1].append(file_id)
+        bundle_size += local_files.size(file_id)
+    return [file_ids for file_ids in bundles if len(file_ids) > 1]
+
+def write_bundle(path, file_ids):
+    """Write the files to a tar file, returns the members (name, size, mtime_ns, offset) and the ids of unreadable files.
+
+    tarfile copies each file in chunks, so the bundle is never held in memory.
+    """
+    members = []
+    unreadable = []
+    with tarfile.open(path, "w", format=tarfile.PAX_FORMAT) as tar:
+        for file_id in file_ids:
+            name = local_files.name(file_id)
+            try:
+                with open(local_files.abs_path(file_id), "rb") as f:
+                    st = os.fstat(f.fileno())
+                    info = tarfile.TarInfo(name)
+                    info.size = st.st_size
+                    info.mtime = st.st_mtime
+                    info.mode = st.st_mode & 0o7777
+                    tar.addfile(info, f)
+            except OSError as e:
+                logging.error(f"Could not read file {local_files.rel_path(file_id)}, not packed: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+                unreadable.append(file_id)
+                continue
+            # The data ends at the current offset, padded to whole blocks.
+            offset = tar.offset - -(-st.st_size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            members.append((name, st.st_size, st.st_mtime_ns, offset))
+    return members, unreadable
+
+def upload_bundle(file_ids, dest_folder_rel, dest_folder_uuid, attempt=1):
+    """Pack files into a bundle and upload it. Runs in an upload worker thread, failed uploads go to the retry queue."""
+    global uploaded_size, num_retried_files, num_total_retries, num_failed_files
+    bundle_digest = hashlib.sha1()
+    for file_id in file_ids:
+        bundle_digest.update(f"{local_files.name(file_id)}\0{local_files.size(file_id)}\0{local_files.file_mtimes[file_id]}\0".encode("utf-8", "surrogateescape"))
+    bundle = f"{PACK_BUNDLE_PREFIX}{bundle_digest.hexdigest()[:16]}.tar"
+    rel_path = normalize_rel_path(dest_folder_rel or ".", bundle)
+    bundle_size = sum(local_files.size(file_id) for file_id in file_ids)
+
+    with upload_stats_lock:
+        print_upload_progress(f"{rel_path} [{len(file_ids)} files]", bundle_size)
+
+    # The CLI uploads from a path, so the bundle is written to a temporary file first.
+    temp_dir = tempfile.mkdtemp(prefix=PACK_BUNDLE_PREFIX)
+    try:
+        file_start = time.time()
+        members, unreadable = write_bundle(os.path.join(temp_dir, bundle), file_ids)
+        out, _ = upload_with_concurrency_limit(os.path.join(temp_dir, bundle), dest_folder_uuid, bundle_size) if members else (None, 0)
+        elapsed_file = time.time() - file_start
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    num_retries = attempt - 1
+
+    if out is None:
+        if members and attempt < MAX_NUM_RETRIES:
+            logging.info(f"upload-file failed, retrying bundle {rel_path} later (attempt {attempt})", extra={'suppress_console': ENABLE_SUPPRESS})
+            retry_queue.schedule(attempt, upload_bundle, file_ids, dest_folder_rel, dest_folder_uuid)
+            return
+        logging.error(f"upload-file failed, skipping bundle {rel_path} ({len(file_ids)} files)")
+        with upload_stats_lock:
+            num_failed_files += len(file_ids)
+            for file_id in file_ids:
+                local_files.failed.add(file_id)
+        return
+
+    invalidate_cached_dir_listing(dest_folder_uuid)
+    if out.get("file"):
+        manifest.add_item(dest_folder_uuid, bundle, out["file"])
+    manifest.store_bundle(dest_folder_uuid, bundle, members)
+
+    packed_size = sum(member[1] for member in members)
+    mbps = (packed_size / 1024 / 1024) / elapsed_file if elapsed_file > 0 else 0
+    logging.info(f"Uploaded bundle '{rel_path}' ({len(members)} files, {format_size(packed_size)}) to folder UUID '{dest_folder_uuid}' in {elapsed_file:.2f}s ({mbps:.2f} MB/s)")
+
+    with upload_stats_lock:
+        if num_retries > 0:
+            num_retried_files += 1
+            num_total_retries += num_retries
+        bundle_names.append((dest_folder_rel or ".", bundle))
+        for file_id in file_ids:
+            if file_id in unreadable:
+                num_failed_files += 1
+                local_files.failed.add(file_id)
+            else:
+                local_files.uploaded.add(file_id)
+                local_files.packed.add(file_id)
+        uploaded_size += bundle_size
+        stats = folder_upload_stats.setdefault(dest_folder_rel, {'size': 0, 'time': 0, 'files': 0})
+        stats['size'] += packed_size
+        stats['time'] += elapsed_file
+        stats['files'] += len(members)
+
+def submit_bundle(file_ids, dest_folder_rel, dest_folder_uuid):
+    """Hand a bundle to the upload workers."""
+    for file_id in file_ids:
+        local_files.submitted.add(file_id)
+    submit_to_upload_workers(upload_bundle, file_ids, dest_folder_rel, dest_folder_uuid)
+
+################################################################################
+# Split uploads
+# With --split-size, large files are uploaded as parts ("00000.part", ...) into a
+# hidden folder next to them (PARTS_FOLDER_PREFIX + file name), one upload job per
+# part. The manifest records the offset, size and SHA-256 of each part, so parts
+# whose content did not change are not uploaded again. Concatenating the parts in
+# order gives the original file.
+################################################################################
+
+split_parts_folders = {} # File id -> UUID of its existing remote parts folder
+num_uploaded_parts = 0
+num_reused_parts = 0
+
+def part_name(part):
+    return f"{part:05d}.part"
+
+def is_split_file(file_id):
+    return args.split_size is not None and local_files.size(file_id) > args.split_size
+
+def split_file_unchanged(file_id, parts_uuid):
+    """Whether all parts of a file were uploaded to the parts folder and the file did not change since."""
+    file_size = local_files.size(file_id)
+    if manifest.load_split_file(parts_uuid) != (file_size, local_files.file_mtimes[file_id], args.split_size):
+        return False
+    parts = manifest.load_split_parts(parts_uuid)
+    listing = get_cached_dir_listing(parts_uuid)
+    for part in range(-(-file_size // args.split_size)):
+        remote = listing.get(part_name(part))
+        if part not in parts or remote is None or str(remote.get("size")) != str(parts[part][1]):
+            return False
+    return True
+
+def copy_file_range_to(src_path, dst_path, offset, size):
+    """Copy size bytes at offset of src_path to the new file dst_path, inside the kernel where supported."""
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        copied = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while copied < size:
+                    num_bytes = os.copy_file_range(src.fileno(), dst.fileno(), size - copied, offset + copied)
+                    if num_bytes == 0:
+                        break
+                    copied += num_bytes
+            except OSError:
+                pass # Not supported by the file systems, copy the rest through user space.
+        src.seek(offset + copied)
+        dst.seek(copied)
+        while copied < size:
+            chunk = src.read(min(HASH_READ_BUFFER_BYTES, size - copied))
+            if not chunk:
+                break
+            dst.write(chunk)
+            copied += len(chunk)
+    if copied != size:
+        raise OSError(f"{src_path} is shorter than expected")
+
+class SplitUpload:
+    """State of a file that is uploaded in parts, shared by the upload jobs of its parts."""
+    def __init__(self, file_id, dest_folder_rel, parts_uuid, num_parts, recorded_parts, remote_parts):
+        self.file_id = file_id
+        self.dest_folder_rel = dest_folder_rel
+        self.parts_uuid = parts_uuid
+        self.num_parts = num_parts
+        self.recorded_parts = recorded_parts # part -> (offset, size, hash) of the uploaded parts
+        self.remote_parts = remote_parts # part name -> metadata of the remote part
+        self.remaining = num_parts
+        self.failed = False
+        self.num_retries = 0
+        self.elapsed = 0
+        self.lock = threading.Lock()
+
+def upload_file_part(split, part, attempt=1):
+    """Upload one part of a file unless the remote part has the same content.
+
+    Runs in an upload worker thread, failed uploads go to the retry queue.
+    """
+    global uploaded_size, num_bytes_to_upload, num_uploaded_parts, num_reused_parts
+    file_id = split.file_id
+    abs_path, rel_path = local_files.abs_path(file_id), local_files.rel_path(file_id)
+    offset = part * args.split_size
+    size = min(args.split_size, local_files.size(file_id) - offset)
+
+    with upload_stats_lock:
+        print_upload_progress(f"{rel_path} [part {part + 1}/{split.num_parts}]", size)
+
+    out = None
+    reused = False
+    read_failed = False
+    file_start = time.time()
+    try:
+        # Hash the part through a memory mapping of the file, without copying it.
+        with open(abs_path, "rb") as f, mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ, offset=offset) as mapped:
+            part_hash = hashlib.sha256(mapped).hexdigest()
+        remote = split.remote_parts.get(part_name(part))
+        recorded = split.recorded_parts.get(part)
+        if remote is not None and recorded == (offset, size, part_hash) and str(remote.get("size")) == str(size):
+            reused = True
+        else:
+            if remote is not None:
+                # Replace the outdated part.
+                delete_remote_file(normalize_rel_path(rel_path, part_name(part)), remote.get("uuid"), size)
+                split.remote_parts.pop(part_name(part), None)
+            temp_dir = tempfile.mkdtemp(prefix="internxt_part_")
+            try:
+                copy_file_range_to(abs_path, os.path.join(temp_dir, part_name(part)), offset, size)
+                out, _ = upload_with_concurrency_limit(os.path.join(temp_dir, part_name(part)), split.parts_uuid, size)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+    except (OSError, ValueError) as e:
+        logging.error(f"Could not read part {part} of {rel_path}: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+        read_failed = True
+
+    if not reused and out is None and not read_failed and attempt < MAX_NUM_RETRIES:
+        logging.info(f"upload-file failed, retrying part {part} of {rel_path} later (attempt {attempt})", extra={'suppress_console': ENABLE_SUPPRESS})
+        with split.lock:
+            split.elapsed += time.time() - file_start
+        retry_queue.schedule(attempt, upload_file_part, split, part)
+        return
+
+    if not reused:
+        if out is None:
+            logging.error(f"upload-file failed for part {part} of {rel_path}")
+        else:
+            invalidate_cached_dir_listing(split.parts_uuid)
+            if out.get("file"):
+                manifest.add_item(split.parts_uuid, part_name(part), out["file"])
+            manifest.set_split_part(split.parts_uuid, part, offset, size, part_hash)
+
+    with upload_stats_lock:
+        if reused:
+            # Not uploaded again, so it no longer counts towards the size to upload.
+            num_reused_parts += 1
+            if num_bytes_to_upload is not None:
+                num_bytes_to_upload -= size
+        elif out is not None:
+            num_uploaded_parts += 1
+            uploaded_size += size
+    with split.lock:
+        split.elapsed += time.time() - file_start
+        split.num_retries += attempt - 1
+        split.failed = split.failed or (not reused and out is None)
+        split.remaining -= 1
+        if split.remaining > 0:
+            return
+    finish_split_upload(split)
+
+def finish_split_upload(split):
+    """Record a split file once the last of its parts is done."""
+    global num_retried_files, num_total_retries, num_failed_files
+    file_id, rel_path, file_size = split.file_id, local_files.rel_path(split.file_id), local_files.size(split.file_id)
+    if not split.failed:
+        manifest.store_split_file(split.parts_uuid, file_size, local_files.file_mtimes[file_id], args.split_size)
+        logging.info(f"Uploaded file '{rel_path}' ({format_size(file_size)}) in {split.num_parts} parts to folder UUID '{split.parts_uuid}' in {split.elapsed:.2f}s (upload time of all parts)")
+    with upload_stats_lock:
+        if split.num_retries > 0:
+            num_retried_files += 1
+            num_total_retries += split.num_retries
+        if split.failed:
+            num_failed_files += 1
+            local_files.failed.add(file_id)
+            return
+        local_files.uploaded.add(file_id)
+        local_files.split.add(file_id)
+        stats = folder_upload_stats.setdefault(split.dest_folder_rel, {'size': 0, 'time': 0, 'files': 0})
+        stats['size'] += file_size
+        stats['time'] += split.elapsed
+        stats['files'] += 1
+
+def submit_split_upload(file_id, dest_folder_rel, dest_folder_uuid):
+    """Hand the parts of a large file to the upload workers."""
+    local_files.submitted.add(file_id)
+    parts_uuid = split_parts_folders.get(file_id)
+    if parts_uuid is None:
+        parts_uuid = get_or_create_folder_from_uuid(dest_folder_uuid, PARTS_FOLDER_PREFIX + local_files.name(file_id), dest_folder_rel or ".")
+    # The file is only complete again once all parts are uploaded.
+    manifest.remove_split_file(parts_uuid)
+
+    num_parts = -(-local_files.size(file_id) // args.split_size)
+    remote_parts = {name: metadata for name, metadata in get_cached_dir_listing(parts_uuid).items() if metadata.get("type") != "folder"}
+    part_names = {part_name(part) for part in range(num_parts)}
+    for name, metadata in remote_parts.items():
+        if name not in part_names:
+            logging.info(f"Deleting remote part '{name}' of '{local_files.rel_path(file_id)}' since the file is shorter now", extra={'suppress_console': ENABLE_SUPPRESS})
+            delete_remote_file(normalize_rel_path(local_files.rel_path(file_id), name), metadata.get("uuid"), int(metadata.get("size") or 0))
+
+    split = SplitUpload(file_id, dest_folder_rel, parts_uuid, num_parts, manifest.load_split_parts(parts_uuid), remote_parts)
+    for part in range(num_parts):
+        submit_to_upload_workers(upload_file_part, split, part)
 
 ################################################################################
 # Folder creation
@@ -540,69 +3025,138 @@ logging.info(f"Checking for existing folders/files, creating missing folders..."
 
 created_folders = []
 existing_folders = []
-existing_files = {}
-existing_size = 0
+existing_size = 0 # Files that exist remotely are marked in local_files.existing
 removed_folders = []
 removed_files = []
 removed_size = 0
 
-# DFS traversal of remote folder tree to create missing folders
-stack = [(".", DEST_ROOT_ID)]
 existing_folders.append((".", DEST_ROOT_ID))
 
+num_unknown_size_folders = 0 # Removed folders whose contents were (partly) not in the manifest
+
+# Protects the removal stats above, deletions run in the deletion workers.
+deletion_lock = threading.Lock()
+
 def delete_remote_folder(rel_path, folder_uuid):
-    global removed_size
-    # TODO: Calculate the size of the folder. This can be an expensive operation so we don't do it for now.
-    # folder_size = calculate_remote_folder_size(rel_path, folder_uuid)
-    folder_size = 0
+    """Delete a remote folder with all its contents, returns whether it was deleted."""
+    global removed_size, num_unknown_size_folders
+    # The size is taken from the listings in the manifest, the folder is not listed again just for that.
+    folder_size, num_unknown_folders = manifest.folder_size(folder_uuid)
 
     # Delete the folder.
-    out, _, _ = run_cli(["delete-permanently-folder", f"--id={folder_uuid}"], suppress_console_errors=ENABLE_SUPPRESS)
+    out, _ = transport.delete_folder(folder_uuid)
     if out is None:
         logging.error(f"Failed to delete folder {rel_path}", extra={'suppress_console': ENABLE_SUPPRESS})
-    else:
-        # Update stats after deletion.
+        return False
+    # Update stats after deletion.
+    with deletion_lock:
         removed_folders.append(rel_path)
         removed_size += folder_size
-        # Remove folder from cache.
-        remote_dir_cache.pop(folder_uuid, None)
+        if num_unknown_folders:
+            num_unknown_size_folders += 1
+    # Remove folder from cache.
+    invalidate_cached_dir_listing(folder_uuid)
+    manifest.remove_folder(folder_uuid)
+    return True
 
 def delete_remote_file(rel_path, file_uuid, file_size):
+    """Delete a remote file, returns whether it was deleted."""
     global removed_size
-    out, _, _ = run_cli(["delete-permanently-file", f"--id={file_uuid}"], suppress_console_errors=ENABLE_SUPPRESS)
+    out, _ = transport.delete_file(file_uuid)
     if out is None:
         logging.error(f"Failed to delete file {rel_path}", extra={'suppress_console': ENABLE_SUPPRESS})
-    else:
-        # Update stats after deletion.
+        return False
+    # Update stats after deletion.
+    with deletion_lock:
         removed_files.append(rel_path)
         removed_size += file_size
+    manifest.remove_file(file_uuid)
+    return True
+
+# Deletions found by the remote check are handed to a pool of deletion workers, so they don't hold
+# up the scan. Only a bounded number is queued at a time. Uploads that replace an outdated file wait
+# for its deletion (the names would clash), all other deletions only have to be done at the end.
+max_pending_deletions = args.jobs * 4
+pending_deletions = set()
+replaced_file_deletions = defaultdict(list) # Folder UUID -> futures of the deletions of its outdated files
+deletion_executor = ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="delete")
+
+def schedule_deletion(function, *function_args, replaced_in_folder=None):
+    """Run a deletion in a deletion worker. With replaced_in_folder, uploads into that folder wait for it."""
+    global pending_deletions
+    if len(pending_deletions) >= max_pending_deletions:
+        done, pending_deletions = wait(pending_deletions, return_when=FIRST_COMPLETED)
+        for future in done:
+            future.result()  # Re-raise exceptions from the workers.
+    future = deletion_executor.submit(function, *function_args)
+    pending_deletions.add(future)
+    if replaced_in_folder is not None:
+        with deletion_lock:
+            replaced_file_deletions[replaced_in_folder].append(future)
+
+def wait_for_replaced_files(folder_uuid):
+    """Wait until the outdated files of a folder are deleted, before their replacements are uploaded."""
+    with deletion_lock:
+        futures = replaced_file_deletions.pop(folder_uuid, [])
+    for future in futures:
+        future.result()
+
+def finish_deletions():
+    """Wait for all scheduled deletions."""
+    global pending_deletions
+    for future in pending_deletions:
+        future.result()
+    pending_deletions = set()
+    with deletion_lock:
+        replaced_file_deletions.clear()
+
+# With --detect-moves, remote files/folders that don't exist locally are not deleted right away.
+# They are kept as move candidates (rel_path, uuid, size, parent_uuid) and matched against new local files/folders after the scan.
+removed_file_candidates = []
+removed_folder_candidates = []
+
+def handle_removed_remote_file(rel_path, file_uuid, file_size, parent_uuid):
+    if args.detect_moves:
+        removed_file_candidates.append((rel_path, file_uuid, file_size, parent_uuid))
+    else:
+        logging.info(f"Deleting remote file '{rel_path}' since it does not exist locally", extra={'suppress_console': ENABLE_SUPPRESS})
+        schedule_deletion(delete_remote_file, rel_path, file_uuid, file_size)
+
+def handle_removed_remote_folder(rel_path, folder_uuid, parent_uuid):
+    if args.detect_moves:
+        removed_folder_candidates.append((rel_path, folder_uuid, 0, parent_uuid))
+    else:
+        logging.info(f"Deleting remote folder '{rel_path}' since it does not exist locally or is ignored", extra={'suppress_console': ENABLE_SUPPRESS})
+        schedule_deletion(delete_remote_folder, rel_path, folder_uuid)
 
 # Variables for progress bar.
 remote_check_file_counter = 0
 remote_check_start_time = time.time()
-remote_check_total_files = len(all_local_files)
+remote_check_total_files = len(local_files)
 
-while stack:
-    rel_cur_dir, folder_uuid = stack.pop()
+def reconcile_remote_folder(rel_cur_dir, folder_uuid, folder_items):
+    """Compare a remote folder listing with the local folder.
 
-    # Delete remote folders not present locally
-    if rel_cur_dir not in folder_sizes:
-        if args.allow_delete:
-            logging.info(f"Deleting remote folder '{rel_cur_dir}' since it does not exist locally or is ignored", extra={'suppress_console': ENABLE_SUPPRESS})
-            delete_remote_folder(rel_cur_dir, folder_uuid)
-        continue
+    Returns the remote subfolders that also exist locally (to be scanned next) and the names of
+    local subfolders that are missing remotely, both sorted by name.
+    """
+    global remote_check_file_counter, existing_size
 
-    folder_uuids[rel_cur_dir] = folder_uuid
-
-    folder_items = get_cached_dir_listing(folder_uuid)
+    subfolders = []
 
     # Initialize missing folders to the set of all subdirs
     # We remove all folders that we also find remotely.
     missing_subfolders = set(folder_subdir_map.get(rel_cur_dir, []))
 
+    # Ids of the local files of this folder by name.
+    local_file_ids = local_files.folder_names(rel_cur_dir)
+    remote_bundles = {}
+    remote_parts_folders = {}
+
     # Check existing files/folders.
-    for name, metadata in folder_items.items():
-        name = normalize_encoding(name)
+    for name in sorted(folder_items):
+        metadata = folder_items[name]
+        name = canonical_name(name)  # Listings stored in the manifest by older versions were not in NFC.
         rel_path = normalize_rel_path(rel_cur_dir, name)
 
         if metadata.get("type") == "folder":
@@ -612,15 +3166,17 @@ while stack:
                 continue
 
             if rel_path in folder_sizes:
-                # The remote folder is also present locally -> recurse.
-                stack.append((rel_path, subfolder_uuid))
+                # The remote folder is also present locally -> scan it on the next level.
+                subfolders.append((rel_path, subfolder_uuid))
                 existing_folders.append((rel_path, subfolder_uuid))
                 # Remove existing folder from the "missing" list.
                 missing_subfolders.remove(name)
+            elif args.split_size is not None and name.startswith(PARTS_FOLDER_PREFIX):
+                # Checked against the local file below.
+                remote_parts_folders[name[len(PARTS_FOLDER_PREFIX):]] = subfolder_uuid
             elif args.allow_delete:
-                # The remote folder does not exist locally -> delete it.
-                logging.info(f"Deleting remote folder '{rel_path}' since it does not exist locally or is ignored", extra={'suppress_console': ENABLE_SUPPRESS})
-                delete_remote_folder(rel_path, subfolder_uuid)
+                # The remote folder does not exist locally -> delete it (or move it, see --detect-moves).
+                handle_removed_remote_folder(rel_path, subfolder_uuid, folder_uuid)
         else:
             file_uuid = metadata.get("uuid")
             if not file_uuid:
@@ -634,51 +3190,384 @@ while stack:
                 logging.error(f"Invalid size format for file {rel_path}: {metadata.get('size')}", extra={'suppress_console': ENABLE_SUPPRESS})
                 continue
 
+            # Bundles are checked against their recorded members below.
+            if args.pack_small_files and is_bundle_name(name):
+                remote_bundles[name] = (file_uuid, remote_size)
+                continue
+
             # Progress bar update for each file
             remote_check_file_counter += 1
-            elapsed_total = time.time() - remote_check_start_time
-            print_progress_bar(remote_check_file_counter, remote_check_total_files, rel_path, remote_size, elapsed_total, 0, 0, False)
+            if not args.pipeline:
+                elapsed_total = time.time() - remote_check_start_time
+                print_progress_bar(remote_check_file_counter, remote_check_total_files, rel_path, remote_size, elapsed_total, 0, 0, False)
 
             # Fetch the local size. Returns None if the file does not exist locally.
-            local_size = file_sizes.get(rel_path)
+            file_id = local_file_ids.get(name)
+            local_size = local_files.size(file_id) if file_id is not None else None
             if local_size is None:
                 if args.allow_delete:
-                    # The remote file does not exist locally -> delete it.
-                    logging.info(f"Deleting remote file '{rel_path}' since it does not exist locally", extra={'suppress_console': ENABLE_SUPPRESS})
-                    delete_remote_file(rel_path, file_uuid, remote_size)
+                    # The remote file does not exist locally -> delete it (or move it, see --detect-moves).
+                    handle_removed_remote_file(rel_path, file_uuid, remote_size, folder_uuid)
                 continue
 
-            # If the size matches, skip the file.
+            # If the size matches and the file was not modified since the last run, skip the file.
             # Otherwise, delete the remote file (= local file will be uploaded)
-            if remote_size == local_size:
+            # With --content-hash, same-size files are compared by hash after the scan instead.
+            # Files that are listed but not stored (see is_ghost()) are uploaded again.
+            ghost = is_ghost(metadata)
+            if remote_size == local_size and not ghost and (args.content_hash or file_id not in local_files.modified):
                 logging.info(f"Skipped file '{rel_path}' (same size)", extra={'suppress_console': ENABLE_SUPPRESS})
                 existing_size += local_size
-                existing_files[rel_path] = file_uuid
+                local_files.set_existing(file_id, file_uuid)
             else:
+                reason = "listed but not stored" if ghost else "different size" if remote_size != local_size else "modified since last run"
                 if args.allow_delete:
-                    logging.info(f"Remote file '{rel_path}' has different size, deleting", extra={'suppress_console': ENABLE_SUPPRESS})
-                    delete_remote_file(rel_path, file_uuid, remote_size)
+                    logging.info(f"Remote file '{rel_path}' is outdated ({reason}), deleting", extra={'suppress_console': ENABLE_SUPPRESS})
+                    schedule_deletion(delete_remote_file, rel_path, file_uuid, remote_size, replaced_in_folder=folder_uuid)
                 else:
-                    logging.info(f"Skipped file '{rel_path}' (different size, overwrite disabled)", extra={'suppress_console': ENABLE_SUPPRESS})
+                    logging.info(f"Skipped file '{rel_path}' ({reason}, overwrite disabled)", extra={'suppress_console': ENABLE_SUPPRESS})
                     existing_size += local_size
-                    existing_files[rel_path] = file_uuid
+                    local_files.set_existing(file_id, file_uuid)
+
+    if remote_bundles:
+        existing_size += reconcile_bundles(rel_cur_dir, folder_uuid, remote_bundles, local_file_ids)
+
+    # Parts folders of files uploaded with --split-size.
+    for name, parts_uuid in sorted(remote_parts_folders.items()):
+        rel_path = normalize_rel_path(rel_cur_dir, PARTS_FOLDER_PREFIX + name)
+        file_id = local_file_ids.get(name)
+        if file_id is None or not is_split_file(file_id) or file_id in local_files.existing:
+            logging.info(f"Deleting remote folder '{rel_path}' since its file does not exist locally or is no longer split", extra={'suppress_console': ENABLE_SUPPRESS})
+            schedule_deletion(delete_remote_folder, rel_path, parts_uuid)
+        elif split_file_unchanged(file_id, parts_uuid):
+            logging.info(f"Skipped file '{normalize_rel_path(rel_cur_dir, name)}' (all parts uploaded, not modified)", extra={'suppress_console': ENABLE_SUPPRESS})
+            existing_size += local_files.size(file_id)
+            local_files.set_existing(file_id, parts_uuid)
+            local_files.split.add(file_id)
+        else:
+            split_parts_folders[file_id] = parts_uuid
+
+    return subfolders, sorted(missing_subfolders)
+
+# Number of folders whose listing was taken from the manifest instead of the CLI.
+num_manifest_listings = 0
+
+def get_scan_listing(folder_to_scan):
+    """Get the listing of a folder to scan, from the manifest if trusted and the local folder did not change."""
+    global num_manifest_listings
+    rel_cur_dir, folder_uuid = folder_to_scan
+    if args.trust_manifest and manifest.get_signature(folder_uuid) == local_folder_signature(rel_cur_dir):
+        items = manifest.load_listing(folder_uuid)
+        if items is not None:
+            with remote_dir_cache_lock:
+                remote_dir_cache[folder_uuid] = items
+                num_manifest_listings += 1
+            return items
+    return get_cached_dir_listing(folder_uuid)
+
+# Breadth-first traversal of the remote folder tree, one level at a time.
+# All folders of a level are listed concurrently, missing subfolders are created concurrently.
+# The results are processed in sorted order so that the outcome does not depend on CLI timing.
+def scan_remote_tree(roots):
+    """Scan the remote tree below the given (rel_path, folder_uuid) roots level by level."""
+    global remote_check_file_counter
+    level = list(roots)
+    while level:
+        next_level = []
+
+        # Delete remote folders not present locally
+        folders_to_scan = []
+        for rel_cur_dir, folder_uuid in sorted(level):
+            if rel_cur_dir not in folder_sizes:
+                if args.allow_delete:
+                    logging.info(f"Deleting remote folder '{rel_cur_dir}' since it does not exist locally or is ignored", extra={'suppress_console': ENABLE_SUPPRESS})
+                    schedule_deletion(delete_remote_folder, rel_cur_dir, folder_uuid)
+                continue
+            folder_uuids[rel_cur_dir] = folder_uuid
+            folders_to_scan.append((rel_cur_dir, folder_uuid))
+
+        # List all folders of this level at once (map() preserves the order).
+        listings = scan_executor.map(get_scan_listing, folders_to_scan)
+
+        folders_to_create = []
+        for (rel_cur_dir, folder_uuid), folder_items in zip(folders_to_scan, listings):
+            subfolders, missing_subfolders = reconcile_remote_folder(rel_cur_dir, folder_uuid, folder_items)
+            manifest.set_signature(folder_uuid, local_folder_signature(rel_cur_dir))
+            if args.pipeline:
+                pipeline_folders.put((rel_cur_dir, folder_uuid))
+            next_level.extend(subfolders)
+            folders_to_create.extend((rel_cur_dir, folder_uuid, folder_items, name) for name in missing_subfolders)
+
+        # Create missing subfolders
+        def create_subfolder(folder_to_create):
+            rel_cur_dir, folder_uuid, folder_items, name = folder_to_create
+            return get_or_create_folder(folder_items, folder_uuid, name, rel_cur_dir)
+
+        for (rel_cur_dir, _, _, name), subfolder_uuid in zip(folders_to_create, scan_executor.map(create_subfolder, folders_to_create)):
+            rel_path = normalize_rel_path(rel_cur_dir, name)
+            created_folders.append((rel_path, subfolder_uuid))
+            # Descend into the new folder so that its own subfolders are created on the next level.
+            next_level.append((rel_path, subfolder_uuid))
+
+            assert(rel_path in folder_num_files)
+            remote_check_file_counter += folder_num_files[rel_path]
+            if not args.pipeline:
+                elapsed_total = time.time() - remote_check_start_time
+                print_progress_bar(remote_check_file_counter, remote_check_total_files, rel_path, 0, elapsed_total, 0, 0, False)
+
+        level = next_level
 
-    # Create missing subfolders
-    for name in missing_subfolders:
-        subfolder_uuid = get_or_create_folder(folder_items, folder_uuid, name, rel_cur_dir)
-        rel_path = normalize_rel_path(rel_cur_dir, name)
-        created_folders.append((rel_path, subfolder_uuid))
+################################################################################
+# Move detection
+# Remote files/folders that no longer exist locally are matched against new local
+# files/folders, and moved/renamed instead of being deleted and uploaded again.
+################################################################################
+
+moved_files = []
+moved_folders = []
+moved_size = 0
+
+def move_remote_item(kind, rel_path, item_uuid, old_parent_uuid, new_parent_uuid, new_name=None):
+    """Move a remote file or folder (kind) into another folder and/or rename it.
+
+    Returns the UUID of the item afterwards (only changes with WebDAV), or None on failure.
+    """
+    new_uuid = item_uuid
+    if old_parent_uuid != new_parent_uuid:
+        out, _ = getattr(transport, f"move_{kind}")(new_uuid, new_parent_uuid)
+        if out is None:
+            logging.error(f"Failed to move {kind} to {rel_path}", extra={'suppress_console': ENABLE_SUPPRESS})
+            return None
+        new_uuid = out.get(kind, {}).get("uuid") or new_uuid
+        invalidate_cached_dir_listing(old_parent_uuid)
+        invalidate_cached_dir_listing(new_parent_uuid)
+    if new_name is not None:
+        out, _ = getattr(transport, f"rename_{kind}")(new_uuid, new_name)
+        if out is None:
+            logging.error(f"Failed to rename {kind} to {rel_path}", extra={'suppress_console': ENABLE_SUPPRESS})
+            return None
+        new_uuid = out.get(kind, {}).get("uuid") or new_uuid
+        invalidate_cached_dir_listing(new_parent_uuid)
+    if new_uuid != item_uuid:
+        invalidate_cached_dir_listing(item_uuid)
+    manifest.move_item(item_uuid, new_parent_uuid, os.path.basename(rel_path), new_uuid)
+    return new_uuid
+
+def parent_rel_path(rel_path):
+    parent = os.path.dirname(rel_path)
+    return '.' if parent == '' else parent
+
+def match_moved_folders():
+    """Replace newly created folders by removed remote folders with the same name and mostly the same files."""
+    global remote_check_file_counter, existing_size, moved_size
+    for rel_path, new_uuid in sorted(created_folders):
+        if (rel_path, new_uuid) not in created_folders:
+            continue  # Removed with a parent that was replaced in an earlier iteration.
+        local_sizes = {name: local_files.size(file_id) for name, file_id in local_files.folder_names(rel_path).items()}
+        best_candidate, best_matches = None, 0
+        for candidate in removed_folder_candidates:
+            if os.path.basename(candidate[0]) != os.path.basename(rel_path):
+                continue
+            remote_files = [(name, metadata.get("size")) for name, metadata in get_cached_dir_listing(candidate[1]).items() if metadata.get("type") != "folder"]
+            matches = sum(1 for name, size in remote_files if local_sizes.get(name) is not None and str(local_sizes[name]) == str(size))
+            if matches > best_matches and matches * 2 >= len(remote_files):
+                best_candidate, best_matches = candidate, matches
+        if best_candidate is None:
+            continue
 
-        assert(rel_path in folder_num_files)
-        remote_check_file_counter += folder_num_files[rel_path]
-        elapsed_total = time.time() - remote_check_start_time
-        print_progress_bar(remote_check_file_counter, remote_check_total_files, rel_path, 0, elapsed_total, 0, 0, False)
+        # Remove the new (empty) folder including the subfolders created below it, then move the old folder in its place.
+        old_rel_path, old_uuid, _, old_parent_uuid = best_candidate
+        out, _ = transport.delete_folder(new_uuid)
+        if out is None:
+            logging.error(f"Failed to delete new folder {rel_path}, not moving '{old_rel_path}'", extra={'suppress_console': ENABLE_SUPPRESS})
+            continue
+        manifest.remove_folder(new_uuid)
+        parent_uuid = folder_uuids[parent_rel_path(rel_path)]
+        invalidate_cached_dir_listing(parent_uuid)
+        for created in [c for c in created_folders if c[0] == rel_path or c[0].startswith(rel_path + os.sep)]:
+            created_folders.remove(created)
+            invalidate_cached_dir_listing(created[1])
+            remote_check_file_counter -= folder_num_files[created[0]]
+        moved_uuid = move_remote_item("folder", rel_path, old_uuid, old_parent_uuid, parent_uuid)
+        if moved_uuid is None:
+            # The folder is gone now, create it again with its subfolders.
+            new_uuid = get_or_create_folder_from_uuid(parent_uuid, os.path.basename(rel_path), parent_rel_path(rel_path))
+            created_folders.append((rel_path, new_uuid))
+            remote_check_file_counter += folder_num_files[rel_path]
+            scan_remote_tree([(rel_path, new_uuid)])
+            continue
 
+        removed_folder_candidates.remove(best_candidate)
+        logging.info(f"Moved remote folder '{old_rel_path}' to '{rel_path}'", extra={'suppress_console': ENABLE_SUPPRESS})
+        moved_folders.append((old_rel_path, rel_path))
+        existing_size_before = existing_size
+        scan_remote_tree([(rel_path, moved_uuid)])
+        moved_size += existing_size - existing_size_before
+
+def collect_nested_file_candidates():
+    """List the remaining removed folders recursively, their files may have been moved elsewhere."""
+    nested_candidates = []
+    level = [(rel_path, folder_uuid) for rel_path, folder_uuid, _, _ in removed_folder_candidates]
+    while level:
+        next_level = []
+        for (rel_cur_dir, folder_uuid), folder_items in zip(level, scan_executor.map(get_cached_dir_listing, [folder_uuid for _, folder_uuid in level])):
+            for name, metadata in sorted(folder_items.items()):
+                rel_path = normalize_rel_path(rel_cur_dir, name)
+                if metadata.get("type") == "folder":
+                    next_level.append((rel_path, metadata.get("uuid")))
+                else:
+                    try:
+                        nested_candidates.append((rel_path, metadata.get("uuid"), int(metadata.get("size", 0)), folder_uuid))
+                    except (TypeError, ValueError):
+                        pass
+        level = next_level
+    return nested_candidates
+
+def match_moved_files(file_candidates):
+    """Match removed remote files to new local files by content hash (if recorded) or by name and size.
+
+    Returns the matched candidates.
+    """
+    global existing_size, moved_size
+    candidates_by_size = defaultdict(list)
+    for candidate in file_candidates:
+        candidates_by_size[candidate[2]].append(candidate)
+    new_local_files = [entry for entry in local_files.entries() if entry[0] not in local_files.existing and entry[3] in candidates_by_size]
+
+    # Content hashes where available, the CLI doesn't provide them so they are only known for files uploaded with --content-hash.
+    candidate_hashes = {}
+    local_hashes = {}
+    if args.content_hash:
+        candidate_hashes = {candidate[1]: manifest.get_hash(candidate[1]) for candidate in file_candidates}
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash") as hash_executor:
+            local_hashes = dict(zip([rel_path for _, _, rel_path, _ in new_local_files], hash_executor.map(get_file_hash, [abs_path for _, abs_path, _, _ in new_local_files])))
+
+    # Name + size matches are only used if they are unambiguous on both sides.
+    def name_key(rel_path, size):
+        return (os.path.basename(rel_path), size)
+    candidate_name_counts = defaultdict(int)
+    for candidate in file_candidates:
+        candidate_name_counts[name_key(candidate[0], candidate[2])] += 1
+    local_name_counts = defaultdict(int)
+    for _, _, rel_path, file_size in new_local_files:
+        local_name_counts[name_key(rel_path, file_size)] += 1
+
+    matches = []
+    used = set()
+    for file_id, _, rel_path, file_size in new_local_files:
+        for candidate in candidates_by_size[file_size]:
+            if candidate[1] in used:
+                continue
+            candidate_hash = candidate_hashes.get(candidate[1])
+            if candidate_hash is not None and local_hashes.get(rel_path) is not None:
+                is_match = candidate_hash == local_hashes[rel_path]
+            else:
+                key = name_key(rel_path, file_size)
+                is_match = key == name_key(candidate[0], candidate[2]) and candidate_name_counts[key] == 1 and local_name_counts[key] == 1
+            # rename-file can't change the file extension.
+            if is_match and os.path.splitext(candidate[0])[1] == os.path.splitext(rel_path)[1]:
+                used.add(candidate[1])
+                matches.append((candidate, file_id, rel_path, file_size))
+                break
+
+    def move_file(match):
+        (old_rel_path, file_uuid, _, old_parent_uuid), _, rel_path, _ = match
+        new_name = None
+        if os.path.basename(old_rel_path) != os.path.basename(rel_path):
+            new_name = os.path.splitext(os.path.basename(rel_path))[0]
+        return move_remote_item("file", rel_path, file_uuid, old_parent_uuid, folder_uuids[parent_rel_path(rel_path)], new_name)
+
+    moved_candidates = []
+    for match, moved_uuid in zip(matches, scan_executor.map(move_file, matches)):
+        if moved_uuid is None:
+            continue
+        candidate, file_id, rel_path, file_size = match
+        logging.info(f"Moved remote file '{candidate[0]}' to '{rel_path}'", extra={'suppress_console': ENABLE_SUPPRESS})
+        moved_files.append((candidate[0], rel_path))
+        moved_candidates.append(candidate)
+        local_files.set_existing(file_id, moved_uuid)
+        existing_size += file_size
+        moved_size += file_size
+    return moved_candidates
+
+def reconcile_moves():
+    """Move remote files/folders where possible, delete the remaining removed files/folders."""
+    match_moved_folders()
+    nested_candidates = collect_nested_file_candidates()
+    moved_candidates = set(match_moved_files(removed_file_candidates + nested_candidates))
+
+    # Files inside removed folders are deleted together with their folder.
+    for candidate in removed_file_candidates:
+        if candidate not in moved_candidates:
+            rel_path, file_uuid, file_size, _ = candidate
+            logging.info(f"Deleting remote file '{rel_path}' since it does not exist locally", extra={'suppress_console': ENABLE_SUPPRESS})
+            schedule_deletion(delete_remote_file, rel_path, file_uuid, file_size)
+    for rel_path, folder_uuid, _, _ in removed_folder_candidates:
+        logging.info(f"Deleting remote folder '{rel_path}' since it does not exist locally or is ignored", extra={'suppress_console': ENABLE_SUPPRESS})
+        schedule_deletion(delete_remote_folder, rel_path, folder_uuid)
+
+scan_executor = ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="scan")
+if args.pipeline:
+    start_upload_workers()
+    pipeline_dispatcher = threading.Thread(target=dispatch_pipeline_uploads, name="pipeline", daemon=True)
+    pipeline_dispatcher.start()
+try:
+    scan_remote_tree([(".", DEST_ROOT_ID)])
+    if args.detect_moves:
+        # Files may be moved to where an outdated file is still being deleted.
+        finish_deletions()
+        reconcile_moves()
+finally:
+    scan_executor.shutdown(wait=True, cancel_futures=True)
+    if args.pipeline:
+        pipeline_folders.put(None)
+        pipeline_dispatcher.join()
+if pipeline_errors:
+    raise pipeline_errors[0]
+
+# Compare the content hashes of all files that exist remotely with the same size.
+# Files uploaded before --content-hash was used have no recorded hash. If they were not modified since the last
+# run, the local hash becomes their baseline, modified ones are treated as outdated (their change can't be ruled out).
+if args.content_hash:
+    # Packed and split files are checked by size and modification time (and the hashes of the parts), they have no single remote file.
+    hash_check_ids = [file_id for file_id in local_files.existing if file_id not in local_files.packed and file_id not in local_files.split]
+    logging.info(f"\nComparing content hashes of {len(hash_check_ids)} existing files...")
+    hash_check_start_time = time.time()
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash") as hash_executor:
+        local_hashes = hash_executor.map(get_file_hash, map(local_files.abs_path, hash_check_ids))
+        for file_counter, ((file_id, _, rel_path, file_size), local_hash) in enumerate(zip(local_files.entries(hash_check_ids), local_hashes), 1):
+            print_progress_bar(file_counter, len(hash_check_ids), rel_path, file_size, time.time() - hash_check_start_time, 0, 0, False)
+            if local_hash is None:
+                continue
+            file_uuid = local_files.remote_uuids[file_id]
+            remote_hash = manifest.get_hash(file_uuid)
+            if remote_hash is None and file_id not in local_files.modified:
+                manifest.set_hash(file_uuid, local_hash)
+            elif remote_hash != local_hash:
+                reason = "modified since last run, no recorded content hash" if remote_hash is None else "different content hash"
+                if args.allow_delete:
+                    logging.info(f"Remote file '{rel_path}' is outdated ({reason}), deleting", extra={'suppress_console': ENABLE_SUPPRESS})
+                    schedule_deletion(delete_remote_file, rel_path, file_uuid, file_size)
+                    local_files.clear_existing(file_id)
+                    existing_size -= file_size
+                else:
+                    logging.info(f"Skipped file '{rel_path}' ({reason}, overwrite disabled)", extra={'suppress_console': ENABLE_SUPPRESS})
+
+# All deletions have to be done before the uploads.
+finish_deletions()
+deletion_executor.shutdown(wait=True)
+
+command_metrics.record_phase("remote_check", remote_check_start_time)
 logging.info(f"\nFolder setup successful. Elapsed time: {format_hhmmss(time.time() - remote_check_start_time)}")
 logging.info(f"Created {len(created_folders)} new folders.")
-logging.info(f"Found {len(existing_files)} existing files in {len(existing_folders)} (sub-)folders")
-logging.info(f"Skipped {len(existing_files)}, size {format_size(existing_size)}.")
-logging.info(f"Removed {len(removed_folders)} folders (with all contained files and subfolders) and {len(removed_files)} files, size {format_size(removed_size)} (w/o folder size).")
+if args.trust_manifest:
+    logging.info(f"Used the manifest for {num_manifest_listings} unchanged folders instead of listing them.")
+logging.info(f"Found {len(local_files.existing)} existing files in {len(existing_folders)} (sub-)folders")
+logging.info(f"Skipped {len(local_files.existing)}, size {format_size(existing_size)}.")
+logging.info(f"Removed {len(removed_folders)} folders (with all contained files and subfolders) and {len(removed_files)} files, size {format_size(removed_size)}"
+             + (f" (without the unknown contents of {num_unknown_size_folders} folders that were never listed)." if num_unknown_size_folders else "."))
+if args.detect_moves:
+    logging.info(f"Moved {len(moved_folders)} folders and {len(moved_files)} files instead of uploading them again, saved {format_size(moved_size)}.")
 
 # Adjust total upload size to account for skipped files
 num_bytes_to_upload = total_local_size - existing_size
@@ -688,73 +3577,183 @@ logging.info(f"Total size to upload without skipped files: {format_size(num_byte
 # File upload
 ################################################################################
 
-uploaded_size = 0
-uploaded_files = []
-
-# Retry stats
-num_retried_files = 0
-num_total_retries = 0
-num_failed_files = 0
-
-# For per-folder stats
-folder_upload_stats = {}
-
-num_files_for_upload = len(all_local_files) - len(existing_files)
+num_files_for_upload = len(local_files) - len(local_files.existing)
 num_folders_for_upload = len(all_local_folders) - len(existing_folders)
-logging.info(f"\nProcessing {num_files_for_upload} files in {num_folders_for_upload} (sub-)folders, total size: {format_size(num_bytes_to_upload)}.")
+logging.info(f"\nProcessing {num_files_for_upload} files in {num_folders_for_upload} (sub-)folders, total size: {format_size(num_bytes_to_upload)}, {args.jobs} parallel upload(s).")
 
-upload_start_time = time.time()
+if upload_executor is None:
+    start_upload_workers()
 
 # From here on, don't print anything except the progress bar to stdout/stderr,
 # logging only goes to file.
 SUPPRESS_STDOUT_STDERR = True
 
-for abs_path, rel_path, file_size in all_local_files:
-    dest_folder_rel = os.path.dirname(rel_path) if rel_path != '.' else '.'
-    dest_folder_uuid = folder_uuids.get(dest_folder_rel, DEST_ROOT_ID)
-    file_name = os.path.basename(rel_path)
+try:
+    if args.pack_small_files:
+        for rel_dir in local_files.folder_rel_paths:
+            for bundle_file_ids in plan_bundles(rel_dir):
+                submit_bundle(bundle_file_ids, "" if rel_dir == "." else rel_dir, folder_uuids.get(rel_dir, DEST_ROOT_ID))
 
     # Skip the upload if file already exists.
-    existing_file = existing_files.get(rel_path)
-    if existing_file:
-        elapsed_total = time.time() - upload_start_time
-        print_progress_bar(uploaded_size, num_bytes_to_upload, f"{rel_path} [SKIP]", file_size, elapsed_total, num_retried_files, num_failed_files)
-        continue
-
-    # Print progress bar *before* upload so we see what's currently uploading.
-    elapsed_total = time.time() - upload_start_time
-    print_progress_bar(uploaded_size, num_bytes_to_upload, rel_path, file_size, elapsed_total, num_retried_files, num_failed_files)
-
-    # Upload the file.
-    file_start = time.time()
-    out, num_retries, _ = run_cli(["upload-file", "-f", abs_path, f"--destination={dest_folder_uuid}"], suppress_console_errors=ENABLE_SUPPRESS)
-    elapsed_file = time.time() - file_start
+    for file_id in local_files.existing:
+        with upload_stats_lock:
+            elapsed_total = time.time() - upload_start_time
+            print_progress_bar(uploaded_size, num_bytes_to_upload, f"{local_files.rel_path(file_id)} [SKIP]", local_files.size(file_id), elapsed_total, num_retried_files, num_failed_files)
+
+    # Files that were already handed to the upload workers by the pipeline are left out.
+    file_ids = (file_id for file_id in range(len(local_files)) if file_id not in local_files.existing and file_id not in local_files.submitted)
+    for file_id in upload_order(file_ids):
+        rel_dir = local_files.folder(file_id)
+        dest_folder_rel = "" if rel_dir == "." else rel_dir
+        submit_upload(file_id, dest_folder_rel, folder_uuids.get(rel_dir, DEST_ROOT_ID))
+
+    finish_uploads()
+finally:
+    upload_executor.shutdown(wait=True, cancel_futures=True)
+
+command_metrics.record_phase("upload", upload_start_time)
+logging.info(f"\nUpload finished. Elapsed time: {format_hhmmss(time.time() - upload_start_time)}")
 
-    if out is None:
-        logging.error(f"upload-file failed, skipping {rel_path}")
-        num_failed_files += 1
+# Store the local snapshot. Failed files keep their previous entry, so that modified files are
+# still detected as modified in the next run.
+for file_id in local_files.failed:
+    rel_dir, file_name = local_files.folder(file_id), local_files.file_names[file_id]
+    entry = local_dir_entries.get(rel_dir)
+    if entry is None:
         continue
+    previous = local_snapshot.load_dir(rel_dir)
+    previous_file = previous[4].get(file_name) if previous is not None else None
+    if previous_file is not None:
+        entry[4][file_name] = previous_file
+    else:
+        entry[4].pop(file_name, None)
+# Folders with uploads are read again in the next run: a file whose size changed in place
+# was uploaded with its current size, which the snapshot of an unchanged folder doesn't know.
+touched_local_dirs = {local_files.folder(file_id) for file_id in local_files.uploaded} | {local_files.folder(file_id) for file_id in local_files.failed}
+local_snapshot.save(local_dir_entries, removed_local_dirs, touched_local_dirs)
 
-    if num_retries > 0:
-        num_retried_files += 1
-        num_total_retries += num_retries
-
-    # Log upload to file only, with time and MB/s
-    mbps = (file_size / 1024 / 1024) / elapsed_file if elapsed_file > 0 else 0
-    action = "Updated" if existing_file is not None else "Uploaded"
-    logging.info(f"{action} file '{rel_path}' ({format_size(file_size)}) to folder UUID '{dest_folder_uuid}' in {elapsed_file:.2f}s ({mbps:.2f} MB/s)")
-    uploaded_files.append((rel_path, file_size))
-    uploaded_size += file_size
-    # Invalidate folder cache since we modified it
-    remote_dir_cache.pop(dest_folder_uuid, None)
+################################################################################
+# Verification
+# With --verify, the remote tree is compared with the local files after the upload.
+# The listings of the remote check are reused, only folders whose cached listing
+# was dropped because they were modified since (uploads, new folders, moves) are
+# listed again, concurrently. Packed files are checked through their bundle, split
+# files through their parts. All discrepancies are written to --verify-report.
+################################################################################
 
-    # Per-folder stats
-    stats = folder_upload_stats.setdefault(dest_folder_rel, {'size': 0, 'time': 0, 'files': 0})
-    stats['size'] += file_size
-    stats['time'] += elapsed_file
-    stats['files'] += 1
+verify_discrepancies = []
 
-logging.info(f"\nUpload finished. Elapsed time: {format_hhmmss(time.time() - upload_start_time)}")
+def listed_size(metadata):
+    try:
+        return int(metadata.get("size", 0))
+    except (TypeError, ValueError):
+        return None
+
+def add_discrepancy(kind, item_type, rel_path, expected_size=None, remote_size=None, remote_uuid=None):
+    """Record a discrepancy: missing, size_mismatch, ghost (listed but not stored) or unexpected."""
+    verify_discrepancies.append({"kind": kind, "type": item_type, "path": rel_path, "expected_size": expected_size, "remote_size": remote_size, "uuid": remote_uuid})
+
+def verify_file(rel_path, expected_size, metadata):
+    """Compare an expected remote file (expected_size None = any size) with its listing entry (None if not listed)."""
+    if metadata is None or metadata.get("type") == "folder":
+        add_discrepancy("missing", "file", rel_path, expected_size)
+    elif is_ghost(metadata):
+        add_discrepancy("ghost", "file", rel_path, expected_size, listed_size(metadata), metadata.get("uuid"))
+    elif expected_size is not None and listed_size(metadata) != expected_size:
+        add_discrepancy("size_mismatch", "file", rel_path, expected_size, listed_size(metadata), metadata.get("uuid"))
+
+def verify_unexpected(rel_dir, items, expected_names, removed_paths):
+    """Remote items that don't exist locally, only with --allow_delete (they should have been deleted)."""
+    if not args.allow_delete:
+        return
+    for name, metadata in sorted(items.items()):
+        rel_path = normalize_rel_path(rel_dir, name)
+        # Cached listings still contain the items that were deleted after they were listed.
+        if name not in expected_names and rel_path not in removed_paths:
+            item_type = "folder" if metadata.get("type") == "folder" else "file"
+            add_discrepancy("unexpected", item_type, rel_path, None, listed_size(metadata) if item_type == "file" else None, metadata.get("uuid"))
+
+def verify_folder(rel_dir, folder_uuid, items, removed_paths):
+    """Compare a remote folder listing with the local folder.
+
+    Returns the parts folders of split files as (rel_path, file id, folder UUID), they are listed next.
+    """
+    expected_names = set(folder_subdir_map.get(rel_dir, []))
+    for name in sorted(expected_names):
+        metadata = items.get(name)
+        if metadata is None or metadata.get("type") != "folder":
+            add_discrepancy("missing", "folder", normalize_rel_path(rel_dir, name))
+
+    # The members of each bundle were recorded when it was uploaded.
+    bundle_member_sizes = {}
+    if args.pack_small_files:
+        for bundle, members in sorted(manifest.load_bundles(folder_uuid).items()):
+            expected_names.add(bundle)
+            verify_file(normalize_rel_path(rel_dir, bundle), None, items.get(bundle))
+            bundle_member_sizes.update((name, size) for name, (size, _, _) in members.items())
+
+    parts_folders = []
+    for file_id in local_files.folder_files(rel_dir):
+        name, rel_path, file_size = local_files.name(file_id), local_files.rel_path(file_id), local_files.size(file_id)
+        if name in bundle_member_sizes:
+            if bundle_member_sizes[name] != file_size:
+                add_discrepancy("size_mismatch", "file", rel_path, file_size, bundle_member_sizes[name])
+        elif is_split_file(file_id):
+            parts_name = PARTS_FOLDER_PREFIX + name
+            expected_names.add(parts_name)
+            metadata = items.get(parts_name)
+            if metadata is None or metadata.get("type") != "folder":
+                add_discrepancy("missing", "folder", normalize_rel_path(rel_dir, parts_name), file_size)
+            else:
+                parts_folders.append((normalize_rel_path(rel_dir, parts_name), file_id, metadata.get("uuid")))
+        else:
+            expected_names.add(name)
+            verify_file(rel_path, file_size, items.get(name))
+
+    verify_unexpected(rel_dir, items, expected_names, removed_paths)
+    return parts_folders
+
+def verify_parts(rel_path, file_id, items, removed_paths):
+    """Compare the listing of a parts folder with the parts the file should have."""
+    file_size = local_files.size(file_id)
+    expected_names = set()
+    for part in range(-(-file_size // args.split_size)):
+        expected_names.add(part_name(part))
+        verify_file(normalize_rel_path(rel_path, part_name(part)), min(args.split_size, file_size - part * args.split_size), items.get(part_name(part)))
+    verify_unexpected(rel_path, items, expected_names, removed_paths)
+
+if args.verify:
+    verify_start_time = time.time()
+    logging.info(f"\nVerifying the remote tree...")
+    removed_paths = set(removed_files) | set(removed_folders)
+    verify_folders = sorted(folder_uuids.items())
+    with remote_dir_cache_lock:
+        num_verify_listings = sum(folder_uuid not in remote_dir_cache for _, folder_uuid in verify_folders)
+    with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="verify") as verify_executor:
+        # Cached listings are returned right away, the others are listed in parallel (map() preserves the order).
+        parts_folders = []
+        listings = verify_executor.map(get_cached_dir_listing, [folder_uuid for _, folder_uuid in verify_folders])
+        for (rel_dir, folder_uuid), items in zip(verify_folders, listings):
+            parts_folders.extend(verify_folder(rel_dir, folder_uuid, items, removed_paths))
+        with remote_dir_cache_lock:
+            num_verify_listings += sum(parts_uuid not in remote_dir_cache for _, _, parts_uuid in parts_folders)
+        listings = verify_executor.map(get_cached_dir_listing, [parts_uuid for _, _, parts_uuid in parts_folders])
+        for (rel_path, file_id, _), items in zip(parts_folders, listings):
+            verify_parts(rel_path, file_id, items, removed_paths)
+
+    verify_counts = Counter(discrepancy["kind"] for discrepancy in verify_discrepancies)
+    with open(args.verify_report, "w", encoding="utf-8") as f:
+        json.dump({
+            "source": SRC_DIR,
+            "target": args.dest_id,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "folders": len(verify_folders) + len(parts_folders),
+            "listed_folders": num_verify_listings,
+            "counts": verify_counts,
+            "discrepancies": verify_discrepancies,
+        }, f, indent=2)
+    command_metrics.record_phase("verify", verify_start_time)
+    logging.info(f"Verification finished. Elapsed time: {format_hhmmss(time.time() - verify_start_time)}")
 
 ################################################################################
 # Re-enable stdout/stderr logging.
@@ -764,18 +3763,419 @@ SUPPRESS_STDOUT_STDERR = False
 logging.info(f"\nAll operations complete.")
 logging.info(f"Folders created: {len(created_folders)}")
 logging.info(f"Folders removed: {len(removed_folders)}")
-logging.info(f"Files uploaded:  {len(uploaded_files)} ({format_size(uploaded_size)})")
-logging.info(f"Files skipped:   {len(existing_files)} ({format_size(existing_size)})")
+if args.detect_moves:
+    logging.info(f"Moved:           {len(moved_folders)} folders, {len(moved_files)} files ({format_size(moved_size)} not uploaded again)")
+logging.info(f"Files uploaded:  {len(local_files.uploaded)} ({format_size(uploaded_size)})")
+logging.info(f"Files skipped:   {len(local_files.existing)} ({format_size(existing_size)})")
+if args.split_size is not None:
+    logging.info(f"Files split:     {len(local_files.split)} in parts, {num_uploaded_parts} parts uploaded, {num_reused_parts} unchanged parts reused")
+if args.pack_small_files:
+    logging.info(f"Files packed:    {len(local_files.packed)} in bundles, {len(bundle_names)} bundles uploaded, {num_stale_bundles} outdated bundles replaced")
 logging.info(f"Files retried:   {num_retried_files} ({num_total_retries} retries total)")
+if args.adaptive_jobs:
+    logging.info(f"Concurrency:     uploads {upload_concurrency.limit} at the end (peak {upload_concurrency.peak_limit}), listings {list_concurrency.limit} (peak {list_concurrency.peak_limit}), max {args.jobs}")
+upload_time_coefficients = upload_time_model.coefficients() if upload_time_model.is_fitted() else None
+if upload_time_coefficients is not None:
+    seconds_per_file, seconds_per_byte = upload_time_coefficients
+    logging.info(f"Upload time:     {seconds_per_file:.2f}s per file + {format_size(1 / seconds_per_byte) + '/s' if seconds_per_byte > 0 else 'size independent'} (fitted to {upload_time_model.num_samples} uploads)")
+if circuit_breaker.num_trips:
+    logging.info(f"Paused:          {circuit_breaker.num_trips} times, the remote service was not responding")
 logging.info(f"Files failed:    {num_failed_files}")
-logging.info(f"Files removed:   {len(removed_files)} ({format_size(removed_size)})")
+logging.info(f"Files removed:   {len(removed_files)} ({format_size(removed_size)} including the removed folders)")
+if args.verify:
+    logging.info(f"Verified:        {len(verify_folders) + len(parts_folders)} folders ({num_verify_listings} listed again), {len(verify_discrepancies)} discrepancies"
+                 + "".join(f", {count} {kind}" for kind, count in sorted(verify_counts.items())) + f" (see {args.verify_report})")
+if name_stats["local_collisions"] or name_stats["remote_collisions"]:
+    logging.info(f"Name clashes:    {name_stats['local_collisions']} local and {name_stats['remote_collisions']} remote names skipped, they are the same as another name after normalization (see the warnings in the log)")
+logging.info(f"Names normalized (NFC / encoding repaired): {name_stats['local_normalized']} local, {name_stats['remote_normalized']} in remote listings", extra={'suppress_console': ENABLE_SUPPRESS})
 
 # Log per-folder summary to log file
 for folder, stats in folder_upload_stats.items():
     mbps = (stats['size'] / 1024 / 1024) / stats['time'] if stats['time'] > 0 else 0
     logging.info(f"Folder summary: '{folder}' | {stats['files']} files | {format_size(stats['size'])} | {stats['time']:.2f}s | {mbps:.2f} MB/s")
 
-logging.info(f"\nBackup successful. Total time: {format_hhmmss(time.time() - start_time)}")
+# Log the command latencies to the log file, to see where the time went.
+upload_bytes_per_second = {
+    "per_upload": round(command_metrics.upload_bytes / command_metrics.upload_seconds) if command_metrics.upload_seconds > 0 else 0,
+    "overall": round(uploaded_size / phase_timings["upload"]) if phase_timings["upload"] > 0 else 0,
+}
+command_stats = command_metrics.summary()
+for command, stats in command_stats.items():
+    logging.info(f"Command summary: {command} | {stats['count']} calls | {stats['failures']} failed | {stats['retries']} retries | {stats['seconds_total']:.2f}s total | mean {stats['seconds_mean']:.3f}s | p90 <= {stats['seconds_p90']}s | max {stats['seconds_max']:.3f}s", extra={'suppress_console': ENABLE_SUPPRESS})
+logging.info(f"Upload throughput: {format_size(upload_bytes_per_second['per_upload'])}/s per upload, {format_size(upload_bytes_per_second['overall'])}/s overall", extra={'suppress_console': ENABLE_SUPPRESS})
+
+if args.verify and verify_discrepancies:
+    logging.error(f"\nBackup finished, but the verification found {len(verify_discrepancies)} discrepancies (see {args.verify_report}). Total time: {format_hhmmss(time.time() - start_time)}")
+else:
+    logging.info(f"\nBackup successful. Total time: {format_hhmmss(time.time() - start_time)}")
+command_metrics.record_phase("total", start_time)
+
+if args.stats_json:
+    stats = {
+        "phases": {phase: round(seconds, 3) for phase, seconds in phase_timings.items()},
+        "peak_rss_bytes": peak_rss_bytes(),
+        "local_files": len(local_files),
+        "local_folders": len(all_local_folders),
+        "local_size": total_local_size,
+        "snapshot_folders": num_snapshot_dirs,
+        "manifest_listings": num_manifest_listings,
+        "created_folders": len(created_folders),
+        "existing_files": len(local_files.existing),
+        "uploaded_files": len(local_files.uploaded),
+        "uploaded_size": uploaded_size,
+        "failed_files": num_failed_files,
+        "retries": num_total_retries,
+        "breaker_trips": circuit_breaker.num_trips,
+        "upload_concurrency": {"final": upload_concurrency.limit, "peak": upload_concurrency.peak_limit, "decisions": upload_concurrency.num_decisions},
+        "upload_time_model": None if upload_time_coefficients is None else {"seconds_per_file": round(upload_time_coefficients[0], 6), "seconds_per_byte": upload_time_coefficients[1], "samples": upload_time_model.num_samples},
+        "list_concurrency": {"final": list_concurrency.limit, "peak": list_concurrency.peak_limit, "decisions": list_concurrency.num_decisions},
+        "removed_files": len(removed_files),
+        "removed_folders": len(removed_folders),
+        "removed_size": removed_size,
+        "names": name_stats,
+        "verify": {"folders": len(verify_folders) + len(parts_folders), "listed_folders": num_verify_listings, "discrepancies": verify_counts} if args.verify else None,
+        "moved_files": len(moved_files),
+        "moved_folders": len(moved_folders),
+        "packed_files": len(local_files.packed),
+        "uploaded_bundles": len(bundle_names),
+        "split_files": len(local_files.split),
+        "uploaded_parts": num_uploaded_parts,
+        "reused_parts": num_reused_parts,
+        "upload_bytes_per_second": upload_bytes_per_second,
+        "commands": command_stats,
+    }
+    with open(args.stats_json, "w", encoding="utf-8") as f:
+        json.dump(stats, f, indent=2)
+
+if args.prometheus_file:
+    command_metrics.write_prometheus(args.prometheus_file, {
+        ("phase_duration_seconds", "Duration of the phases of the last run."): {(("phase", phase),): round(seconds, 3) for phase, seconds in phase_timings.items()},
+        ("files", "Files of the last run by state."): {
+            (("state", "uploaded"),): len(local_files.uploaded),
+            (("state", "skipped"),): len(local_files.existing),
+            (("state", "failed"),): num_failed_files,
+            (("state", "removed"),): len(removed_files),
+        },
+        ("bytes", "Bytes of the last run by state."): {
+            (("state", "uploaded"),): uploaded_size,
+            (("state", "skipped"),): existing_size,
+            (("state", "removed"),): removed_size,
+        },
+        ("upload_bytes_per_second", "Upload throughput of the last run, per upload and overall (all parallel uploads)."): {
+            (("scope", scope),): value for scope, value in upload_bytes_per_second.items()
+        },
+        ("verify_discrepancies", "Discrepancies found by --verify in the last run, by kind."): {
+            (("kind", kind),): verify_counts.get(kind, 0) for kind in ("missing", "size_mismatch", "ghost", "unexpected")
+        } if args.verify else {},
+        ("last_run_timestamp_seconds", "End of the last successful run (Unix time)."): {(): round(time.time())},
+    })
+
+if args.trace_json:
+    command_metrics.write_trace(args.trace_json)
+
+################################################################################
+# Watch mode
+# With --watch (Linux), the source folder is watched with inotify after the backup.
+# Changed paths are collected until no event arrived for WATCH_DEBOUNCE_SECONDS,
+# then only the folders with changes are compared with their remote listing (like
+# the remote check, limited to the changed names), new folders with all their
+# contents. A .internxtignore file appearing or disappearing removes or adds its
+# folder. Every --watch-reconcile seconds, or when the kernel dropped events, the
+# script is started again for a full run, which catches anything that was missed.
+################################################################################
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+INOTIFY_WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+INOTIFY_EVENT_HEADER = struct.Struct("iIII") # wd, mask, cookie, length of the name
+
+class Inotify:
+    """Minimal inotify binding (through ctypes), maps the watch descriptors to (abs_dir, rel_dir)."""
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_init1 failed: {os.strerror(ctypes.get_errno())}")
+        self.watches = {}
+
+    def add_watch(self, abs_dir, rel_dir):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(abs_dir), INOTIFY_WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed: {os.strerror(ctypes.get_errno())}")
+        self.watches[wd] = (abs_dir, rel_dir)
+
+    def remove_watches(self, rel_dir, keep_self=False):
+        """Stop watching a folder (unless keep_self) and all folders below it."""
+        for wd, (_, watched_dir) in list(self.watches.items()):
+            if watched_dir == rel_dir:
+                remove = not keep_self
+            else:
+                remove = rel_dir == "." or watched_dir.startswith(rel_dir + os.sep)
+            if remove:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read_events(self, timeout):
+        """Wait up to timeout seconds for events, returns [(mask, abs_dir, rel_dir, name)]."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + INOTIFY_EVENT_HEADER.size:offset + INOTIFY_EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += INOTIFY_EVENT_HEADER.size + length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            abs_dir, rel_dir = self.watches.get(wd, (None, None))
+            events.append((mask, abs_dir, rel_dir, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+watch_ignored_dirs = set() # Watched folders that contain a .internxtignore file
+watch_stats = {"uploaded": 0, "failed": 0, "deleted": 0, "created_folders": 0}
+watch_stats_lock = threading.Lock()
+
+def list_local_subdirs(abs_dir):
+    """Returns (ignored, {canonical name: raw name} of the subfolders, {canonical name: (raw name, size)} of the files)."""
+    subdirs, files = {}, {}
+    with os.scandir(abs_dir) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    add_canonical_name(subdirs, entry.name, entry.name, "local", abs_dir)
+                elif not entry.is_dir():  # Symlinks to directories are skipped, as in the backup.
+                    add_canonical_name(files, entry.name, (entry.name, entry.stat().st_size), "local", abs_dir)
+            except OSError as e:
+                logging.error(f"Could not read {entry.path}: {e}", extra={'suppress_console': ENABLE_SUPPRESS})
+    return IGNOREFILE_NAME in files, subdirs, files
+
+def add_watches(inotify, abs_dir, rel_dir):
+    """Watch a folder and its subfolders. Ignored folders are watched as well, to notice their ignore file disappearing."""
+    stack = [(abs_dir, rel_dir)]
+    while stack:
+        abs_dir, rel_dir = stack.pop()
+        try:
+            inotify.add_watch(abs_dir, rel_dir)
+            ignored, subdirs, _ = list_local_subdirs(abs_dir)
+        except OSError as e:
+            logging.error(f"Could not watch folder '{rel_dir}', its changes are only picked up by the next full run: {e}"
+                          + (" (raise fs.inotify.max_user_watches)" if e.errno == errno.ENOSPC else ""))
+            continue
+        if ignored:
+            watch_ignored_dirs.add(rel_dir)
+            continue
+        watch_ignored_dirs.discard(rel_dir)
+        for name, raw_name in subdirs.items():
+            stack.append((os.path.join(abs_dir, raw_name), normalize_rel_path(rel_dir, name)))
+
+def forget_remote_folder(rel_dir):
+    """Drop a folder and its subfolders from folder_uuids after the remote folder was deleted."""
+    for rel_path in [rel_path for rel_path in folder_uuids if rel_path == rel_dir or rel_path.startswith(rel_dir + os.sep)]:
+        del folder_uuids[rel_path]
+
+def watch_remote_folder(rel_dir):
+    """UUID of the remote folder of a local folder, created (with its parents) if needed."""
+    folder_uuid = folder_uuids.get(rel_dir)
+    if folder_uuid is None:
+        parent = parent_rel_path(rel_dir)
+        folder_uuid = get_or_create_folder_from_uuid(watch_remote_folder(parent), os.path.basename(rel_dir), parent)
+        folder_uuids[rel_dir] = folder_uuid
+        with watch_stats_lock:
+            watch_stats["created_folders"] += 1
+    return folder_uuid
+
+def watch_upload(abs_path, rel_path, folder_uuid, file_size):
+    """Upload a changed file (with retries), returns whether it was uploaded. Runs in a watch worker thread."""
+    local_hash = get_file_hash(abs_path) if args.content_hash else None
+    upload_start = time.time()
+    out, _ = transport.upload_file(abs_path, folder_uuid)
+    if out is None:
+        logging.error(f"upload-file failed, skipping {rel_path} until the next full run")
+        with watch_stats_lock:
+            watch_stats["failed"] += 1
+        return False
+    invalidate_cached_dir_listing(folder_uuid)
+    if out.get("file"):
+        manifest.add_item(folder_uuid, os.path.basename(rel_path), out["file"])
+        if local_hash is not None and out["file"].get("uuid"):
+            manifest.set_hash(out["file"]["uuid"], local_hash)
+    logging.info(f"Uploaded file '{rel_path}' ({format_size(file_size)}) to folder UUID '{folder_uuid}' in {time.time() - upload_start:.2f}s", extra={'suppress_console': ENABLE_SUPPRESS})
+    with watch_stats_lock:
+        watch_stats["uploaded"] += 1
+    return True
+
+def watch_delete(rel_path, metadata):
+    """Delete a remote file or folder that no longer exists locally (or is in the way)."""
+    if metadata.get("type") == "folder":
+        deleted = delete_remote_folder(rel_path, metadata.get("uuid"))
+        forget_remote_folder(rel_path)
+    else:
+        deleted = delete_remote_file(rel_path, metadata.get("uuid"), int(metadata.get("size") or 0))
+    if deleted:
+        logging.info(f"Deleted remote {'folder' if metadata.get('type') == 'folder' else 'file'} '{rel_path}' since it does not exist locally or is ignored", extra={'suppress_console': ENABLE_SUPPRESS})
+        with watch_stats_lock:
+            watch_stats["deleted"] += 1
+    return deleted
+
+def sync_watched_folder(inotify, executor, uploads, abs_dir, rel_dir, names):
+    """Sync the given (canonical) names of a local folder, or all its contents if names is None.
+
+    Changed files are handed to the executor, (future, rel_dir, raw name) is added to uploads. New
+    subfolders are synced with all their contents. Returns the synced folders as {rel_dir: abs_dir}.
+    """
+    if not os.path.isdir(abs_dir):
+        return {} # Synced as a removed name of its parent.
+    ignored, local_subdirs, local_file_entries = list_local_subdirs(abs_dir)
+    if ignored:
+        if rel_dir not in watch_ignored_dirs:
+            logging.info(f"Folder contains {IGNOREFILE_NAME} now, skipped: {rel_dir}")
+            watch_ignored_dirs.add(rel_dir)
+            inotify.remove_watches(rel_dir, keep_self=True)
+            if args.allow_delete and rel_dir != "." and rel_dir in folder_uuids:
+                parent_items = get_cached_dir_listing(folder_uuids[parent_rel_path(rel_dir)])
+                metadata = parent_items.get(os.path.basename(rel_dir))
+                if metadata is not None and watch_delete(rel_dir, metadata):
+                    invalidate_cached_dir_listing(folder_uuids[parent_rel_path(rel_dir)])
+        return {rel_dir: abs_dir}
+    if rel_dir in watch_ignored_dirs:
+        logging.info(f"Folder no longer contains {IGNOREFILE_NAME}, adding it: {rel_dir}")
+        watch_ignored_dirs.discard(rel_dir)
+        add_watches(inotify, abs_dir, rel_dir)
+        names = None
+
+    folder_uuid = watch_remote_folder(rel_dir)
+    folder_items = get_cached_dir_listing(folder_uuid)
+    modified = False
+    synced_dirs = {rel_dir: abs_dir}
+    for name in sorted(set(local_subdirs) | set(local_file_entries) | set(folder_items) if names is None else names):
+        rel_path = normalize_rel_path(rel_dir, name)
+        metadata = folder_items.get(name)
+        if name in local_subdirs:
+            if metadata is not None and metadata.get("type") != "folder":
+                if not args.allow_delete:
+                    logging.info(f"Skipped folder '{rel_path}' (a remote file has the same name, overwrite disabled)")
+                    continue
+                modified |= watch_delete(rel_path, metadata)
+            elif metadata is not None:
+                folder_uuids.setdefault(rel_path, metadata.get("uuid"))
+            sub_abs_dir = os.path.join(abs_dir, local_subdirs[name])
+            # New (or moved) folders are synced with all their contents.
+            add_watches(inotify, sub_abs_dir, rel_path)
+            synced_dirs.update(sync_watched_folder(inotify, executor, uploads, sub_abs_dir, rel_path, None))
+        elif name in local_file_entries:
+            raw_name, file_size = local_file_entries[name]
+            if file_size > FILE_SIZE_UPLOAD_LIMIT_BYTES:
+                logging.info(f"File exceeds upload limit size ({format_size(FILE_SIZE_UPLOAD_LIMIT_BYTES)}, found {format_size(file_size)}), skipped: {rel_path}")
+                continue
+            if metadata is not None:
+                # Names with events were written to, the remote file is outdated even if the size is the same.
+                if metadata.get("type") != "folder" and names is None and int(metadata.get("size") or 0) == file_size and not is_ghost(metadata):
+                    continue
+                if not args.allow_delete:
+                    logging.info(f"Skipped file '{rel_path}' (changed, overwrite disabled)", extra={'suppress_console': ENABLE_SUPPRESS})
+                    continue
+                if not watch_delete(rel_path, metadata):
+                    continue
+                modified = True
+            uploads.append((executor.submit(watch_upload, os.path.join(abs_dir, raw_name), rel_path, folder_uuid, file_size), rel_dir, raw_name))
+        elif metadata is not None and args.allow_delete:
+            modified |= watch_delete(rel_path, metadata)
+    if modified:
+        invalidate_cached_dir_listing(folder_uuid)
+    return synced_dirs
+
+def restart_full_run():
+    """Start the script again (same arguments) for a full run, which then continues watching."""
+    logging.info(f"\nStarting a full run to catch changes that were missed...")
+    if cli_bridge_pool is not None:
+        cli_bridge_pool.close()
+    if logged_in:
+        os.environ[WATCH_LOGGED_IN_ENV] = "1"
+    logging.shutdown()
+    os.execv(sys.executable, [sys.executable] + sys.argv)
+
+def watch_source():
+    """Watch SRC_DIR and sync the changes until the next full run."""
+    inotify = Inotify()
+    add_watches(inotify, SRC_DIR, ".")
+    reconcile_time = time.time() + args.watch_reconcile
+    logging.info(f"\nWatching {len(inotify.watches)} folders of '{SRC_DIR}' for changes, next full run in {format_hhmmss(args.watch_reconcile)}.")
+
+    pending = {} # rel_dir -> [abs_dir, set of changed canonical names, or None for all]
+    first_event_time = last_event_time = None
+    with ThreadPoolExecutor(max_workers=args.jobs, thread_name_prefix="watch") as executor:
+        while time.time() < reconcile_time:
+            now = time.time()
+            timeout = max(0, reconcile_time - now) # The time may have passed since the loop condition was checked.
+            if pending:
+                timeout = min(timeout, max(0, min(last_event_time + WATCH_DEBOUNCE_SECONDS, first_event_time + WATCH_MAX_DELAY_SECONDS) - now))
+            events = inotify.read_events(timeout)
+            for mask, abs_dir, rel_dir, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    logging.warning(f"Too many changes at once, the kernel dropped events")
+                    reconcile_time = 0
+                    break
+                if abs_dir is None:
+                    continue
+                if name == IGNOREFILE_NAME:
+                    pending[rel_dir] = [abs_dir, None]
+                    continue
+                if rel_dir in watch_ignored_dirs or (mask & IN_CREATE and not mask & IN_ISDIR):
+                    continue # Files are synced once they are written (IN_CLOSE_WRITE).
+                if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    inotify.remove_watches(normalize_rel_path(rel_dir, canonical_name(name)))
+                entry = pending.setdefault(rel_dir, [abs_dir, set()])
+                if entry[1] is not None:
+                    entry[1].add(canonical_name(name))
+            if events:
+                last_event_time = time.time()
+                first_event_time = first_event_time or last_event_time
+            if pending and reconcile_time and (time.time() - last_event_time >= WATCH_DEBOUNCE_SECONDS or time.time() - first_event_time >= WATCH_MAX_DELAY_SECONDS):
+                sync_start = time.time()
+                uploads = []
+                synced_dirs = {}
+                # Parents first, so that new folders exist before their contents are synced.
+                for rel_dir, (abs_dir, names) in sorted(pending.items(), key=lambda item: (item[0].count(os.sep), item[0] != ".", item[0])):
+                    synced_dirs.update(sync_watched_folder(inotify, executor, uploads, abs_dir, rel_dir, names))
+                failed_files = [(rel_dir, raw_name) for future, rel_dir, raw_name in uploads if not future.result()]
+                # Store the synced folders in the local snapshot, so the next full run doesn't see their files as modified.
+                # Failed files are left out, the next full run treats them as new.
+                snapshot_entries = {}
+                for rel_dir, abs_dir in synced_dirs.items():
+                    try:
+                        dir_stat = os.stat(abs_dir)
+                        snapshot_entries[rel_dir] = (dir_stat.st_mtime_ns, dir_stat.st_ino, *read_local_dir(abs_dir))
+                    except OSError:
+                        continue # Removed in the meantime, the next batch syncs that.
+                for rel_dir, raw_name in failed_files:
+                    if rel_dir in snapshot_entries:
+                        snapshot_entries[rel_dir][4].pop(raw_name, None)
+                local_snapshot.save(snapshot_entries, set(), set())
+                logging.info(f"Synced changes in {len(pending)} folders in {time.time() - sync_start:.1f}s, totals since watching: {watch_stats['uploaded']} uploaded, {watch_stats['failed']} failed, {watch_stats['deleted']} deleted, {watch_stats['created_folders']} folders created")
+                pending = {}
+                first_event_time = last_event_time = None
+    inotify.close()
+    restart_full_run()
+
+if args.watch:
+    watch_source()
 
 # Ensure graceful shutdown on normal completion
 graceful_shutdown()
+
+if args.verify and verify_discrepancies:
+    sys.exit(2)
@@ -0,0 +1,83 @@
+#!/usr/bin/env node
+// Keeps the internxt CLI loaded in a single Node.js process and runs commands sent as JSON lines on stdin.
+// Used by internxt_backup.py --cli-bridge "node internxt_bridge.js" to avoid the Node.js startup cost per command.
+//
+// Protocol: writes {"ready": true} once the CLI is loaded. Each request {"args": ["list", "--id=...", "--json", "-x"]}
+// is answered by {"stdout": "...", "stderr": "...", "returncode": N}. Commands are run one at a time.
+//
+// The CLI package is looked up in the global npm modules, set INTERNXT_CLI_ROOT to override.
+
+const path = require('path');
+const readline = require('readline');
+const { execSync } = require('child_process');
+
+function findCliRoot() {
+  if (process.env.INTERNXT_CLI_ROOT) {
+    return process.env.INTERNXT_CLI_ROOT;
+  }
+  const globalRoot = execSync('npm root -g').toString().trim();
+  return path.join(globalRoot, '@internxt', 'cli');
+}
+
+class ExitCalled extends Error {
+  constructor(code) {
+    super(`exit ${code}`);
+    this.code = code;
+  }
+}
+
+async function main() {
+  const root = findCliRoot();
+  const oclif = require(require.resolve('@oclif/core', { paths: [root] }));
+  const config = await oclif.Config.load(root);
+
+  const writeStdout = process.stdout.write.bind(process.stdout);
+  const writeStderr = process.stderr.write.bind(process.stderr);
+  const exit = process.exit;
+  const send = (message) => writeStdout(JSON.stringify(message) + '\n');
+
+  send({ ready: true });
+
+  const lines = readline.createInterface({ input: process.stdin, terminal: false });
+  for await (const line of lines) {
+    let request;
+    try {
+      request = JSON.parse(line);
+    } catch (err) {
+      send({ stdout: '', stderr: `invalid request: ${err.message}`, returncode: 1 });
+      continue;
+    }
+
+    // Capture the command output, commands must not terminate the bridge.
+    let stdout = '';
+    let stderr = '';
+    let returncode = 0;
+    process.stdout.write = (chunk) => { stdout += chunk; return true; };
+    process.stderr.write = (chunk) => { stderr += chunk; return true; };
+    process.exit = (code) => { throw new ExitCalled(code ?? 0); };
+    try {
+      await oclif.run(request.args, config);
+    } catch (err) {
+      if (err instanceof ExitCalled) {
+        returncode = err.code;
+      } else {
+        returncode = (err.oclif && err.oclif.exit !== undefined) ? err.oclif.exit : 1;
+        stderr += `${err.message}\n`;
+      }
+    } finally {
+      process.stdout.write = writeStdout;
+      process.stderr.write = writeStderr;
+      process.exit = exit;
+    }
+    if (returncode === 0 && process.exitCode) {
+      returncode = process.exitCode;
+    }
+    process.exitCode = undefined;
+    send({ stdout, stderr, returncode });
+  }
+}
+
+main().catch((err) => {
+  process.stderr.write(`${err.stack || err}\n`);
+  process.exit(1);
+});
@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""Run several backup sets with internxt_backup.py on schedules, with one login and a shared worker budget.
+
+The backup sets are read from an INI file. The [daemon] section holds the global settings, every
+other section is one backup set (the section name is used for its state folder):
+
+    [daemon]
+    max_workers = 8          # CLI workers (--jobs) of all running backups together
+    state_dir = state        # relative to the config file, one subfolder per backup set
+
+    [photos]
+    source = /data/photos
+    target = <folder UUID>
+    every = 6h               # s, m, h or d (default: 1d)
+    jobs = 4                 # --jobs of this backup set (default: 1)
+    args = --allow_delete --trust-manifest --cli-bridge "node internxt_bridge.js"
+
+The daemon checks the login once (and again before starting backups if the last check is older than
+SESSION_CHECK_SECONDS), logs in with --email/--password if needed and logs out on exit. The backups
+are started with --assume-logged-in, so they don't check the login again. Each backup set runs in its
+own state folder, which keeps its manifest (remote listings), local snapshot and log files between
+runs, so every run after the first one is incremental.
+
+A backup set is started when it is due and enough workers of max_workers are free. Due backup sets
+are started in the order they became due, a large one is not overtaken by smaller ones.
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import signal
+import getpass
+import logging
+import argparse
+import platform
+import threading
+import subprocess
+import configparser
+
+INTERNXT_CLI_BINARY = os.environ.get("INTERNXT_CLI_BINARY", r"internxt")
+BACKUP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "internxt_backup.py")
+SESSION_CHECK_SECONDS = 300 # Check the login again before starting backups if the last check is older
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+################################################################################
+# Argument parsing
+################################################################################
+
+parser = argparse.ArgumentParser(description="Run several backup sets on schedules with one login.")
+parser.add_argument("-c", "--config", dest="config", required=True, help="INI file with the [daemon] settings and one section per backup set")
+parser.add_argument("--once", dest="once", action='store_true', help="Run every backup set once (as if all were due) and exit")
+parser.add_argument("-v", "--verbose", dest="verbose_mode", action='store_true', help="Enable verbose logging")
+parser.add_argument("-e", "--email", dest="email", required=False, help="Email for Internxt login")
+parser.add_argument("-p", "--password", dest="password", required=False, help="Password for Internxt login (not recommended to use on CLI)")
+args = parser.parse_args()
+
+def parse_duration(text):
+    """Parse a duration such as "90", "30m", "6h" or "1d" into seconds."""
+    text = text.strip().lower()
+    unit = DURATION_UNITS.get(text[-1:]) if text else None
+    seconds = float(text[:-1] if unit else text) * (unit or 1)
+    if seconds <= 0:
+        raise ValueError(text)
+    return seconds
+
+config = configparser.ConfigParser(inline_comment_prefixes=("#", ";"), interpolation=None)
+try:
+    if not config.read(args.config, encoding="utf-8"):
+        parser.error(f"--config: can't read {args.config}")
+except configparser.Error as e:
+    parser.error(f"--config: {e}")
+
+config_dir = os.path.dirname(os.path.abspath(args.config))
+daemon_config = config["daemon"] if config.has_section("daemon") else {}
+try:
+    MAX_WORKERS = int(daemon_config.get("max_workers", "4"))
+except ValueError:
+    parser.error("--config: [daemon] max_workers must be a number")
+if MAX_WORKERS < 1:
+    parser.error("--config: [daemon] max_workers must be at least 1")
+STATE_DIR = os.path.join(config_dir, daemon_config.get("state_dir", "."))
+
+class BackupSet:
+    """One [section] of the config file and the state of its runs."""
+    def __init__(self, name, section):
+        self.name = name
+        for key in ("source", "target"):
+            if key not in section:
+                parser.error(f"--config: [{name}] has no {key}")
+        self.source = os.path.join(config_dir, section["source"])
+        self.target = section["target"]
+        try:
+            self.every = parse_duration(section.get("every", "1d"))
+            self.jobs = int(section.get("jobs", "1"))
+            self.extra_args = shlex.split(section.get("args", ""))
+        except ValueError as e:
+            parser.error(f"--config: [{name}]: invalid value {e}")
+        if not 1 <= self.jobs <= MAX_WORKERS:
+            parser.error(f"--config: [{name}] jobs must be between 1 and max_workers ({MAX_WORKERS})")
+        self.state_dir = os.path.join(STATE_DIR, name)
+        self.last_start = None
+        self.last_status = None
+        self.running = False
+
+    def next_run(self):
+        return self.last_start + self.every if self.last_start is not None else 0
+
+    def command(self):
+        return [sys.executable, BACKUP_SCRIPT, "-s", self.source, "-t", self.target, "-j", str(self.jobs), "--assume-logged-in"] + self.extra_args
+
+backup_sets = []
+for name in config.sections():
+    if name == "daemon":
+        continue
+    if not name or any(c in name for c in '/\\:*?"<>|') or name in (".", ".."):
+        parser.error(f"--config: [{name}] can't be used as a folder name")
+    backup_sets.append(BackupSet(name, config[name]))
+if not backup_sets:
+    parser.error("--config: no backup sets (sections other than [daemon])")
+
+################################################################################
+# Logging
+################################################################################
+
+os.makedirs(STATE_DIR, exist_ok=True)
+file_handler = logging.FileHandler(os.path.join(STATE_DIR, "internxt_daemon.log"), mode='a', encoding='utf-8')
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+logging.basicConfig(level=logging.DEBUG if args.verbose_mode else logging.INFO, handlers=[file_handler, console_handler])
+
+################################################################################
+# Run state
+# The start time and exit status of the last run of each backup set are kept in
+# STATE_DIR/daemon_state.json, so a restarted daemon doesn't run everything again.
+################################################################################
+
+state_path = os.path.join(STATE_DIR, "daemon_state.json")
+
+def load_state():
+    try:
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read {state_path}, running all backup sets: {e}")
+        return
+    for backup_set in backup_sets:
+        entry = state.get(backup_set.name, {})
+        backup_set.last_start, backup_set.last_status = entry.get("last_start"), entry.get("last_status")
+
+def save_state():
+    state = {backup_set.name: {"last_start": backup_set.last_start, "last_status": backup_set.last_status} for backup_set in backup_sets}
+    with open(state_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(state_path + ".tmp", state_path)
+
+################################################################################
+# Log in
+################################################################################
+
+def run_cli(cli_args, force_interactive=False):
+    """Run a CLI command, returns (parsed JSON output or None, message)."""
+    cmd = [INTERNXT_CLI_BINARY] + cli_args + ["--json"] + ([] if force_interactive else ["-x"])
+    # Use shell=True on Windows to get proper command resolution (e.g., internxt -> internxt.cmd)
+    if platform.system() == "Windows":
+        result = subprocess.run(' '.join(cmd), shell=True, capture_output=True, text=True)
+    else:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        out = json.loads(result.stdout)
+    except ValueError:
+        return None, (result.stderr or result.stdout).strip()
+    if not isinstance(out, dict) or out.get("success") is not True:
+        return None, out.get("message", "") if isinstance(out, dict) else ""
+    return out, out.get("message", "")
+
+logged_in = False # Whether the daemon logged in itself (and has to log out)
+last_session_check = None
+password = args.password
+
+def ensure_logged_in():
+    """Check the login (at most every SESSION_CHECK_SECONDS) and log in if needed, returns whether we are logged in."""
+    global logged_in, last_session_check, password
+    if last_session_check is not None and time.time() - last_session_check < SESSION_CHECK_SECONDS:
+        return True
+    out, message = run_cli(["whoami"])
+    if out is None:
+        if "You are not logged in" not in message:
+            logging.error(f"whoami failed: {message}")
+            return False
+        if not args.email:
+            logging.error("Not logged in and no email provided. Please provide --email (and optionally --password) to log in.")
+            return False
+        if password is None:
+            password = getpass.getpass(prompt=f"Password for {args.email}: ")
+        logging.info("Attempting login...")
+        out, message = run_cli(["login", f"-e={args.email}", f"-p={password}"])
+        if out is None:
+            logging.error(f"login failed: {message}")
+            return False
+        logging.info("Login successful")
+        logged_in = True
+    last_session_check = time.time()
+    return True
+
+def logout():
+    if logged_in:
+        logging.info("Attempting to log out from Internxt...")
+        # Logout doesn't have -x so we must run it in "interactive" mode
+        out, message = run_cli(["logout"], force_interactive=True)
+        if out is not None:
+            logging.info("Successfully logged out from Internxt")
+        else:
+            logging.warning(f"Failed to log out from Internxt: {message}")
+
+################################################################################
+# Scheduling
+# Each running backup set takes its --jobs workers from the shared budget of
+# max_workers. The scheduler thread starts due backup sets (oldest due first) as
+# long as their workers are free, and wakes up when one finishes or the next
+# backup set becomes due.
+################################################################################
+
+schedule_lock = threading.Condition()
+free_workers = MAX_WORKERS
+running_processes = {} # Backup set name -> Popen
+stopping = False
+
+def run_backup_set(backup_set):
+    """Run one backup of a backup set in its state folder. Runs in its own thread."""
+    global free_workers
+    os.makedirs(backup_set.state_dir, exist_ok=True)
+    logging.info(f"[{backup_set.name}] Starting backup of '{backup_set.source}' with {backup_set.jobs} workers ({MAX_WORKERS - free_workers} of {MAX_WORKERS} in use)")
+    start = time.time()
+    status = None
+    try:
+        # The progress bar of the backup goes to console.log, its own log file is in the state folder.
+        with open(os.path.join(backup_set.state_dir, "console.log"), "w", encoding="utf-8") as console_log:
+            process = subprocess.Popen(backup_set.command(), cwd=backup_set.state_dir, stdin=subprocess.DEVNULL, stdout=console_log, stderr=subprocess.STDOUT)
+            with schedule_lock:
+                running_processes[backup_set.name] = process
+            status = process.wait()
+    except OSError as e:
+        logging.error(f"[{backup_set.name}] Could not start the backup: {e}")
+    finally:
+        with schedule_lock:
+            running_processes.pop(backup_set.name, None)
+            backup_set.running = False
+            backup_set.last_status = status
+            free_workers += backup_set.jobs
+            save_state()
+            schedule_lock.notify_all()
+    elapsed = time.time() - start
+    if status == 0:
+        logging.info(f"[{backup_set.name}] Backup successful in {elapsed:.0f}s")
+    else:
+        logging.error(f"[{backup_set.name}] Backup failed with exit status {status} after {elapsed:.0f}s, see the log in {backup_set.state_dir}")
+
+def due_backup_sets(now):
+    """Backup sets that are due and not running, oldest due first."""
+    return sorted((backup_set for backup_set in backup_sets if not backup_set.running and backup_set.next_run() <= now), key=BackupSet.next_run)
+
+def schedule():
+    """Start due backup sets until stopped (or, with --once, until every backup set ran once).
+
+    Returns False if --once gave up because the login failed.
+    """
+    global free_workers
+    started = set()
+    with schedule_lock:
+        while not stopping:
+            now = time.time()
+            due = [backup_set for backup_set in due_backup_sets(now) if not (args.once and backup_set.name in started)]
+            if args.once and not due and len(started) == len(backup_sets) and not any(backup_set.running for backup_set in backup_sets):
+                break
+            # Only the oldest due backup set may start next, so large ones are not starved by small ones.
+            if due and due[0].jobs <= free_workers:
+                backup_set = due[0]
+                # The login check may ask for the password or wait for the CLI, finishing backup sets
+                # must still be able to return their workers in the meantime.
+                schedule_lock.release()
+                try:
+                    login_ok = ensure_logged_in()
+                finally:
+                    schedule_lock.acquire()
+                if not login_ok:
+                    if args.once:
+                        logging.error("Could not log in, not starting the remaining backup sets")
+                        return False
+                    # Try again later, the service or the network may be down.
+                    schedule_lock.wait(SESSION_CHECK_SECONDS)
+                    continue
+                # Other threads ran while the lock was released, decide again.
+                if stopping or backup_set.running or backup_set.jobs > free_workers or due_backup_sets(time.time())[:1] != [backup_set]:
+                    continue
+                backup_set.running = True
+                backup_set.last_start = now
+                free_workers -= backup_set.jobs
+                started.add(backup_set.name)
+                save_state()
+                threading.Thread(target=run_backup_set, args=(backup_set,), name=backup_set.name, daemon=True).start()
+                continue
+            next_due = min((backup_set.next_run() for backup_set in backup_sets if not backup_set.running), default=None)
+            schedule_lock.wait(None if next_due is None or due else max(0, next_due - now))
+    return True
+
+def signal_handler(signum, frame):
+    """Stop scheduling and let the running backups shut down gracefully."""
+    global stopping
+    logging.info(f"Received signal {signum}, stopping the running backups...")
+    with schedule_lock:
+        stopping = True
+        for process in running_processes.values():
+            process.terminate()
+        schedule_lock.notify_all()
+
+signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
+
+load_state()
+if args.once:
+    for backup_set in backup_sets:
+        backup_set.last_start = None
+logging.info(f"Running {len(backup_sets)} backup sets with up to {MAX_WORKERS} workers, state in '{STATE_DIR}'")
+for backup_set in backup_sets:
+    logging.info(f"[{backup_set.name}] every {backup_set.every:.0f}s, {backup_set.jobs} workers, next run {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(max(backup_set.next_run(), time.time())))}")
+try:
+    scheduled = schedule()
+    # Wait for the running backups (after a signal they are shutting down).
+    with schedule_lock:
+        while running_processes or any(backup_set.running for backup_set in backup_sets):
+            schedule_lock.wait()
+finally:
+    logout()
+sys.exit(0 if scheduled and all(backup_set.last_status == 0 for backup_set in backup_sets if backup_set.last_start is not None) else 1)